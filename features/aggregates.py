@@ -0,0 +1,463 @@
+"""
+Cached per-collection aggregates.
+
+Each FeatureCollection gets a CollectionAggregate row summarizing its
+contents, so folder counts and zoom-to-folder extents don't need a
+recursive feature_set. A collection's row is computed from its direct
+children plus the rows of its child collections. On PostGIS and SpatiaLite
+the counts, extents, areas and lengths of the direct children are summed
+in the database, so no geometry is loaded to compute a row.
+
+Rows are computed on first use. With the COLLECTION_AGGREGATES setting on
+(it is off by default) the receivers below then keep them current
+incrementally: saving, moving or deleting a feature applies the difference
+it makes to the rows of the collections above it, and a row is only
+recomputed when its extent may have shrunk. Bulk moves, which don't go
+through save(), recompute each collection they touched once.
+``rebuild_aggregates`` backs the ``rebuild_collection_aggregates``
+management command.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from features import copy_on_write
+from features.models import FeatureCollection, CollectionAggregate
+from features.registry import registered_models, get_collection_models, \
+    get_model_by_content_type_id
+from features.signals import collection_changed, features_deleted
+from features.tree import quote
+
+AREAL = ('POLYGON', 'MULTIPOLYGON')
+LINEAR = ('LINESTRING', 'MULTILINESTRING')
+PUNCTUAL = ('POINT', 'MULTIPOINT')
+
+
+def is_enabled():
+    return getattr(settings, 'COLLECTION_AGGREGATES', False)
+
+
+def _has_geometry(model):
+    return 'geometry_final' in [f.name for f in model._meta.fields]
+
+
+def _key(instance):
+    return (ContentType.objects.get_for_model(instance).pk, instance.pk)
+
+
+def _merge(extents):
+    extents = [e for e in extents if e]
+    if not extents:
+        return None
+    return (min([e[0] for e in extents]), min([e[1] for e in extents]),
+            max([e[2] for e in extents]), max([e[3] for e in extents]))
+
+
+def _measure(model, connection):
+    """
+    The SQL function summing the measure of ``model``'s geometry_final
+    ('' for points, which have none), or None when the sums have to be
+    taken in python: other backends, or geometry fields of mixed type.
+    """
+    ops = connection.ops
+    if not (getattr(ops, 'postgis', False) or getattr(ops, 'spatialite', False)):
+        return None
+    geom_type = model._meta.get_field('geometry_final').geom_type
+    if geom_type in AREAL:
+        return ops.area
+    if geom_type in LINEAR:
+        return ops.length
+    if geom_type in PUNCTUAL:
+        return ''
+    return None
+
+
+def measure(geom):
+    """
+    (extent, area, length) of a single geometry.
+    """
+    if geom is None:
+        return None, 0.0, 0.0
+    if geom.dims == 2:
+        return geom.extent, geom.area, 0.0
+    if geom.dims == 1:
+        return geom.extent, 0.0, geom.length
+    return geom.extent, 0.0, 0.0
+
+
+def totals(model, queryset, times=1):
+    """
+    (count, extent, area, length) of the rows of ``queryset``, a queryset
+    of ``model`` reading geometry_final as stored. Area and length are
+    counted ``times`` over.
+    """
+    connection = connections[queryset.db]
+    function = _measure(model, connection)
+    if function is None:
+        geoms = list(queryset.values_list('geometry_final', flat=True))
+        measures = [measure(geom) for geom in geoms]
+        return (len(geoms), _merge([m[0] for m in measures]),
+                sum([m[1] for m in measures]) * times,
+                sum([m[2] for m in measures]) * times)
+
+    opts = model._meta
+    column = quote(connection, opts.db_table, opts.get_field('geometry_final').column)
+    subquery, params = queryset.order_by().values('pk').query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*), %s FROM %s WHERE %s IN (%s)" % (
+        "SUM(%s(%s))" % (function, column) if function else '0',
+        quote(connection, opts.db_table),
+        quote(connection, opts.db_table, opts.pk.column), subquery), params)
+    count, total = cursor.fetchone()
+    extent = queryset.extent(field_name='geometry_final') if count else None
+    area = length = 0.0
+    if function == connection.ops.area:
+        area = (total or 0.0) * times
+    elif function:
+        length = (total or 0.0) * times
+    return count, extent, area, length
+
+
+def _borrowed_totals(model, children):
+    """
+    (extent, area, length) of the geometry borrowed by the children that
+    are copy-on-write copies (see features.copy_on_write).
+    """
+    pks = list(children.filter(geometry_final__isnull=True).values_list('pk', flat=True))
+    uses = Counter(copy_on_write.source_keys(model, pks).values())
+    groups = {}
+    for (ct_id, pk), times in uses.items():
+        groups.setdefault((ct_id, times), []).append(pk)
+    extents, area, length = [], 0.0, 0.0
+    for (ct_id, times), pks in groups.items():
+        owner = get_model_by_content_type_id(ct_id)
+        count, extent, owner_area, owner_length = totals(
+            owner, copy_on_write.stored(owner).filter(pk__in=pks), times)
+        extents.append(extent)
+        area += owner_area
+        length += owner_length
+    return _merge(extents), area, length
+
+
+def summarize(collection, seen=None):
+    """
+    Computes the aggregate values of ``collection`` as a dict. Leaf
+    children cost one or two queries per feature class; child collections
+    contribute their own rows, which are computed first if missing.
+    """
+    ct = ContentType.objects.get_for_model(collection)
+    seen = (seen or set()) | set([(ct.pk, collection.pk)])
+    values = {'direct_count': 0, 'recursive_count': 0, 'area': 0.0, 'length': 0.0}
+    extents = []
+
+    for model in set(collection.get_options().get_valid_children()):
+        # Copy-on-write querysets refuse to read the geometry columns
+        children = copy_on_write.stored(model).filter(
+            content_type=ct, object_id=collection.pk)
+        if issubclass(model, FeatureCollection):
+            child_ct = ContentType.objects.get_for_model(model).pk
+            pks = [pk for pk in children.values_list('pk', flat=True)
+                   if (child_ct, pk) not in seen]
+            rows = list(CollectionAggregate.objects.filter(
+                content_type=child_ct, object_id__in=pks))
+            found = set([row.object_id for row in rows])
+            for child in model.objects.filter(pk__in=[p for p in pks if p not in found]):
+                rows.append(store(child, seen))
+            values['direct_count'] += len(pks)
+            values['recursive_count'] += len(pks)
+            for row in rows:
+                values['recursive_count'] += row.recursive_count
+                values['area'] += row.area
+                values['length'] += row.length
+                extents.append(row.extent)
+        elif _has_geometry(model):
+            count, extent, area, length = totals(model, children)
+            extents.append(extent)
+            if copy_on_write.is_enabled(model):
+                extent, borrowed_area, borrowed_length = _borrowed_totals(model, children)
+                extents.append(extent)
+                area += borrowed_area
+                length += borrowed_length
+            values['direct_count'] += count
+            values['recursive_count'] += count
+            values['area'] += area
+            values['length'] += length
+        else:
+            count = children.count()
+            values['direct_count'] += count
+            values['recursive_count'] += count
+
+    extent = _merge(extents) or (None, None, None, None)
+    values['minx'], values['miny'], values['maxx'], values['maxy'] = extent
+    return values
+
+
+def store(collection, seen=None):
+    """
+    Recompute and save the row of ``collection`` alone.
+    """
+    row, created = CollectionAggregate.objects.update_or_create(
+        content_type=ContentType.objects.get_for_model(collection),
+        object_id=collection.pk,
+        defaults=summarize(collection, seen))
+    return row
+
+
+def get(collection):
+    """
+    The CollectionAggregate row of ``collection``, computed on first use.
+    """
+    try:
+        return CollectionAggregate.objects.get(
+            content_type=ContentType.objects.get_for_model(collection),
+            object_id=collection.pk)
+    except CollectionAggregate.DoesNotExist:
+        return store(collection)
+
+
+def _chain(collection):
+    """
+    ``collection`` followed by every collection above it, bottom up.
+    """
+    chain = []
+    seen = set()
+    while collection is not None:
+        key = _key(collection)
+        if key in seen:
+            break
+        seen.add(key)
+        chain.append(collection)
+        collection = collection.collection
+    return chain
+
+
+def refresh(*collections):
+    """
+    Recompute the rows of ``collections`` and of every collection above
+    them, each once and each after any of the others below it.
+    """
+    rank = {}
+    nodes = {}
+    for collection in collections:
+        for i, node in enumerate(_chain(collection)):
+            key = _key(node)
+            nodes[key] = node
+            rank[key] = max(rank.get(key, 0), i)
+    for key in sorted(nodes, key=lambda k: rank[k]):
+        store(nodes[key])
+
+
+def refresh_subtree(root):
+    """
+    Recompute the rows of ``root``, every collection below it (bottom up)
+    and every collection above it; e.g. after the subtree was written in
+    bulk without signals.
+    """
+    from features.tree import load_subtree
+    children = load_subtree(root)
+    order = []
+    stack = [root]
+    seen = set()
+    while stack:
+        collection = stack.pop()
+        key = _key(collection)
+        if key in seen:
+            continue
+        seen.add(key)
+        order.append(collection)
+        for model, instances in children.get(key, {}).items():
+            if issubclass(model, FeatureCollection):
+                stack.extend(instances)
+    for collection in reversed(order[1:]):
+        store(collection)
+    refresh(root)
+
+
+def rebuild_aggregates():
+    """
+    Recompute every row from scratch. Returns the number of rows written.
+    """
+    count = 0
+    with transaction.atomic():
+        CollectionAggregate.objects.all()._raw_delete(CollectionAggregate.objects.db)
+        for model in get_collection_models():
+            for collection in model.objects.all():
+                get(collection)
+                count += 1
+    return count
+
+
+def contribution(instance, geom=None):
+    """
+    What ``instance`` adds to the rows above it, as (recursive count,
+    extent, area, length). For leaf features the measures are those of
+    ``geom``.
+    """
+    if isinstance(instance, FeatureCollection):
+        row = get(instance)
+        return 1 + row.recursive_count, row.extent, row.area, row.length
+    extent, area, length = measure(geom)
+    return 1, extent, area, length
+
+
+def apply(collection, direct=0, recursive=0, area=0.0, length=0.0,
+          added=None, removed=None):
+    """
+    Apply a change below ``collection`` to its row and to the rows of
+    every collection above it: ``direct`` to its direct count, the rest
+    to all of them. A row is recomputed instead when the ``removed``
+    extent reached its edge, i.e. when its extent may shrink. Rows that
+    don't exist yet are left to be computed on first use.
+    """
+    chain = _chain(collection)
+    by_ct = {}
+    for node in chain:
+        ct_id, pk = _key(node)
+        by_ct.setdefault(ct_id, []).append(pk)
+    rows = {}
+    for ct_id, pks in by_ct.items():
+        for row in CollectionAggregate.objects.filter(content_type=ct_id,
+                                                      object_id__in=pks):
+            rows[(ct_id, row.object_id)] = row
+    for i, node in enumerate(chain):
+        row = rows.get(_key(node))
+        if row is None:
+            continue
+        old = row.extent
+        if removed and old and (removed[0] <= old[0] or removed[1] <= old[1] or
+                                removed[2] >= old[2] or removed[3] >= old[3]):
+            # Counts are included; the database already holds the change
+            store(node)
+            continue
+        if i == 0:
+            row.direct_count += direct
+        row.recursive_count += recursive
+        row.area += area
+        row.length += length
+        extent = _merge([old, added])
+        if extent:
+            row.minx, row.miny, row.maxx, row.maxy = extent
+        row.save()
+
+
+def _stored_geometry(model, pk):
+    geom = copy_on_write.stored(model).filter(pk=pk).values_list(
+        'geometry_final', flat=True)[0]
+    if geom is None and copy_on_write.is_enabled(model):
+        key = copy_on_write.source_keys(model, [pk]).get(pk)
+        if key is not None:
+            geom = copy_on_write.geometries([key]).get(key, (None, None))[1]
+    return geom
+
+
+def feature_saving(sender, instance, raw=False, **kwargs):
+    # What the rows currently account for
+    if not is_enabled() or raw or instance.pk is None:
+        return
+    rows = copy_on_write.stored(sender).filter(pk=instance.pk).values_list(
+        'content_type_id', 'object_id')
+    if not rows:
+        return
+    ct_id, object_id = rows[0]
+    geom = None
+    if not isinstance(instance, FeatureCollection) and _has_geometry(sender):
+        geom = _stored_geometry(sender, instance.pk)
+    instance.__dict__['_aggregates_before'] = (ct_id, object_id, geom)
+
+
+def feature_saved(sender, instance, created, raw=False, **kwargs):
+    before = instance.__dict__.pop('_aggregates_before', None)
+    if not is_enabled() or raw or (before is None and not created):
+        return
+    leaf = not isinstance(instance, FeatureCollection)
+    geom = instance.geometry_final if leaf and _has_geometry(sender) else None
+    now = (instance.content_type_id, instance.object_id) \
+        if instance.object_id is not None else None
+    # Lets membership_changed skip what was already applied here
+    instance.__dict__['_aggregated'] = now
+
+    if created:
+        if now is not None:
+            count, extent, area, length = contribution(instance, geom)
+            apply(instance.collection, 1, count, area, length, added=extent)
+        return
+
+    then = before[:2] if before[1] is not None else None
+    old_geom = before[2]
+    if then == now:
+        if now is None or not leaf or old_geom == geom:
+            return
+        count, old_extent, old_area, old_length = contribution(instance, old_geom)
+        count, extent, area, length = contribution(instance, geom)
+        apply(instance.collection, 0, 0, area - old_area, length - old_length,
+              added=extent, removed=old_extent)
+        return
+
+    if then is not None:
+        previous = get_model_by_content_type_id(then[0]).objects.filter(pk=then[1])
+        count, extent, area, length = contribution(instance, old_geom)
+        for collection in previous:
+            apply(collection, -1, -count, -area, -length, removed=extent)
+    if now is not None:
+        count, extent, area, length = contribution(instance, geom)
+        apply(instance.collection, 1, count, area, length, added=extent)
+
+
+def feature_deleted(sender, instance, **kwargs):
+    if not is_enabled():
+        return
+    if isinstance(instance, FeatureCollection):
+        row = CollectionAggregate.objects.filter(
+            content_type=ContentType.objects.get_for_model(sender),
+            object_id=instance.pk).first()
+        if row is not None:
+            row.delete()
+        if instance.object_id is not None and instance.collection is not None:
+            if row is None:
+                refresh(instance.collection)
+            else:
+                apply(instance.collection, -1, -1 - row.recursive_count,
+                      -row.area, -row.length, removed=row.extent)
+        return
+    if instance.object_id is not None and instance.collection is not None:
+        geom = instance.geometry_final if _has_geometry(sender) else None
+        count, extent, area, length = contribution(instance, geom)
+        apply(instance.collection, -1, -count, -area, -length, removed=extent)
+
+
+@receiver(features_deleted)
+def features_removed(sender, pks, **kwargs):
+    if is_enabled() and issubclass(sender, FeatureCollection):
+        CollectionAggregate.objects.filter(
+            content_type=ContentType.objects.get_for_model(sender),
+            object_id__in=pks).delete()
+
+
+@receiver(collection_changed)
+def membership_changed(sender, instances, collection, previous, **kwargs):
+    if not is_enabled():
+        return
+    # Moves that went through save() were applied by feature_saved
+    pending = False
+    for instance in instances:
+        now = (instance.content_type_id, instance.object_id) \
+            if instance.object_id is not None else None
+        if instance.__dict__.pop('_aggregated', False) != now:
+            pending = True
+    if pending:
+        refresh(*[c for c in [collection] + list(previous) if c is not None])
+
+
+def connect_signals():
+    """
+    Hook the aggregates up to every registered feature class.
+    """
+    for model in registered_models:
+        uid = 'features.aggregates.%s' % model.__name__
+        pre_save.connect(feature_saving, sender=model, dispatch_uid=uid)
+        post_save.connect(feature_saved, sender=model, dispatch_uid=uid)
+        post_delete.connect(feature_deleted, sender=model, dispatch_uid=uid)
@@ -0,0 +1,18 @@
+from django.apps import AppConfig
+
+
+class FeaturesConfig(AppConfig):
+    name = 'features'
+    verbose_name = 'Features'
+
+    def ready(self):
+        # closure before visibility: the visibility receivers read the
+        # ancestors recorded by the closure table
+        from features import registry, closure, visibility, copy_on_write, \
+            aggregates
+        registry.freeze()
+        registry.connect_signals()
+        closure.connect_signals()
+        visibility.connect_signals()
+        copy_on_write.connect_signals()
+        aggregates.connect_signals()
@@ -0,0 +1,502 @@
+"""
+Set-based operations over many features at once.
+
+The per-instance methods on Feature issue a handful of queries each; the
+functions here do the same work with a fixed number of queries per feature
+class, whatever the number of instances.
+"""
+from copy import copy as shallow_copy
+
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Max
+from django.db.models.base import Model, ModelState
+from django.utils import timezone
+
+from features.registry import sharing_cache, get_model_by_content_type_id
+from features.signals import sharing_changed, features_deleted, collection_changed
+from features.touch import touch, coalesced_touches
+from features.tree import children_queryset, iter_chunked
+
+# Keeps ``__in`` lists under SQLite's bind variable limit
+CHUNK_SIZE = 500
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def group_by_model(instances):
+    """
+    Returns a list of (model, instances) pairs, in first-seen order.
+    """
+    by_model = []
+    index = {}
+    for instance in instances:
+        model = instance.__class__
+        if model not in index:
+            index[model] = len(by_model)
+            by_model.append((model, []))
+        by_model[index[model]][1].append(instance)
+    return by_model
+
+
+def group_list(groups):
+    """
+    ``groups`` -- None, a Group or an iterable of them -- as a list.
+    """
+    if groups is None:
+        groups = []
+    elif isinstance(groups, Group):
+        groups = [groups]
+    groups = list(groups)
+    for group in groups:
+        assert isinstance(group, Group)
+    return groups
+
+
+def check_sharing_groups(instances, groups):
+    """
+    Validates a share the way Feature.share_with does: every owner must
+    belong to every group and every group must hold the can_share_features
+    permission. Costs two queries however many instances and groups.
+    """
+    group_ids = set([g.pk for g in groups])
+    owner_ids = set([i.user_id for i in instances])
+    memberships = set(User.groups.through.objects.filter(
+        user__in=owner_ids, group__in=group_ids).values_list('user_id', 'group_id'))
+    for owner_id in owner_ids:
+        for group_id in group_ids:
+            assert (owner_id, group_id) in memberships
+
+    perm_id = sharing_cache.permission_id()
+    sharable_ids = set()
+    if perm_id is not None:
+        sharable_ids = set(Group.objects.filter(pk__in=group_ids,
+                permissions=perm_id).values_list('pk', flat=True))
+    if group_ids - sharable_ids:
+        raise Exception("The group you are trying to share with "
+                "does not have can_share permission")
+
+
+def share_features(instances, groups, append=False, touch=True):
+    """
+    Share every instance with ``groups`` (a Group or a list of them).
+
+    Unless ``append`` is True, groups the instances are currently shared
+    with but which are not in ``groups`` are removed. Only the difference
+    with the current sharing_groups rows is written: one bulk_create and
+    one delete per feature class, all in a single transaction. With
+    ``touch`` the date_modified of each instance is bumped, with an
+    UPDATE rather than a save().
+
+    Receivers of m2m_changed are not called; ``sharing_changed`` is sent
+    once per feature class instead. Feature.share_with, which shares a
+    single instance, still goes through the m2m manager.
+    """
+    groups = group_list(groups)
+    instances = list(instances)
+    if groups:
+        check_sharing_groups(instances, groups)
+    group_ids = set([g.pk for g in groups])
+
+    with transaction.atomic():
+        for model, model_instances in group_by_model(instances):
+            field = model._meta.get_field('sharing_groups')
+            through = field.rel.through
+            source = field.m2m_field_name()
+            target = field.m2m_reverse_field_name()
+            added = set()
+            removed = set()
+            for batch in chunks(model_instances):
+                pks = [i.pk for i in batch]
+                current = set(through.objects.filter(**{'%s__in' % source: pks}
+                    ).values_list(source, target))
+                wanted = set([(pk, gid) for pk in pks for gid in group_ids])
+                stale = set() if append else current - wanted
+                if stale:
+                    through.objects.filter(**{'%s__in' % source: pks}).exclude(
+                        **{'%s__in' % target: group_ids}).delete()
+                    removed.update([gid for pk, gid in stale])
+                new = wanted - current
+                if new:
+                    through.objects.bulk_create([
+                        through(**{'%s_id' % source: pk, '%s_id' % target: gid})
+                        for pk, gid in new])
+                    added.update([gid for pk, gid in new])
+                if touch and (stale or new):
+                    model.objects.filter(pk__in=pks).update(
+                        date_modified=timezone.now())
+            if added or removed:
+                sharing_changed.send(sender=model, instances=model_instances,
+                        added=added, removed=removed)
+    return True
+
+
+def load_collections(keys):
+    """
+    Returns a dict mapping (content type id, pk) keys to collection
+    instances, with one query per collection model.
+    """
+    by_ct = {}
+    for ct_id, pk in keys:
+        by_ct.setdefault(ct_id, set()).add(pk)
+    found = {}
+    for ct_id, pks in by_ct.items():
+        model = get_model_by_content_type_id(ct_id)
+        for batch in chunks(pks):
+            for instance in model.objects.filter(pk__in=batch):
+                found[(ct_id, instance.pk)] = instance
+    return found
+
+
+def move_features(instances, collection):
+    """
+    Put every instance in ``collection``, or take them out of whatever
+    collection they are in when ``collection`` is None.
+
+    Applies the checks of Feature.add_to_collection once per feature class
+    rather than once per instance, then rewrites the content_type/object_id
+    pointers with one UPDATE per feature class. The target collection and
+    the collections the instances came from are touched once each (see
+    features.touch). Nothing is save()d, so manipulators do not run;
+    ``collection_changed`` is sent once per feature class.
+    """
+    from features import closure
+    from features.models import FeatureCollection
+
+    instances = list(instances)
+    if collection is not None:
+        assert issubclass(collection.__class__, FeatureCollection)
+        valid_children = collection.get_options().get_valid_children()
+        lineage = None
+        for model, model_instances in group_by_model(instances):
+            assert model in valid_children
+            for instance in model_instances:
+                assert instance.user_id == collection.user_id
+            if issubclass(model, FeatureCollection):
+                if lineage is None:
+                    lineage = closure.lineage(collection)
+                for instance in model_instances:
+                    if closure._key(instance) in lineage:
+                        raise Exception("Can't add a collection to itself or "
+                                "to a collection nested inside it")
+
+    previous = load_collections(set([(i.content_type_id, i.object_id)
+            for i in instances if i.object_id is not None]))
+    now = timezone.now()
+    with coalesced_touches():
+        for model, model_instances in group_by_model(instances):
+            if collection is None:
+                pointer = {'content_type': None, 'object_id': None}
+            else:
+                pointer = {'content_type': ContentType.objects.get_for_model(collection),
+                           'object_id': collection.pk}
+            for batch in chunks([i.pk for i in model_instances]):
+                model.objects.filter(pk__in=batch).update(date_modified=now, **pointer)
+            model_previous = []
+            for instance in model_instances:
+                parent = previous.get((instance.content_type_id, instance.object_id))
+                if parent is not None and parent not in model_previous:
+                    model_previous.append(parent)
+                instance.collection = collection
+                instance.date_modified = now
+            collection_changed.send(sender=model, instances=model_instances,
+                    collection=collection, previous=model_previous)
+
+        touch(collection, *previous.values())
+    return instances
+
+
+def _func(method):
+    return getattr(method, '__func__', method)
+
+
+def has_custom_copy(instance):
+    """
+    True if the feature class overrides the stock Feature/FeatureCollection
+    copy() and so has to be copied one instance at a time.
+    """
+    from features.models import Feature, FeatureCollection
+    return _func(instance.__class__.copy) not in (
+        _func(Feature.copy), _func(FeatureCollection.copy))
+
+
+def has_custom_save(instance):
+    """
+    True if the feature class overrides save() beyond the stock Feature,
+    SpatialFeature and FeatureCollection ones. The bulk paths below insert
+    rows directly or call Model.save, which would skip such an override, so
+    these classes are copied one instance at a time with their own save().
+    """
+    from features.models import Feature, SpatialFeature, FeatureCollection
+    return _func(instance.__class__.save) not in (
+        _func(Feature.save), _func(SpatialFeature.save),
+        _func(FeatureCollection.save))
+
+
+def copied_m2m_fields(model):
+    """
+    Many-to-many fields carried over to copies; sharing_groups never is,
+    and neither is anything with a custom through model.
+    """
+    return [f for f in model._meta.many_to_many
+            if f.name != 'sharing_groups' and f.rel.through._meta.auto_created]
+
+
+def clone(instance, user, parent=None):
+    """
+    An unsaved copy of ``instance`` owned by ``user`` and contained in
+    ``parent``, named the way Feature.copy names copies.
+    """
+    new = shallow_copy(instance)
+    new._state = ModelState()
+    new.pk = None
+    new.id = None
+    new.user = user
+    new.name = instance.name + " (copy)"
+    new.collection = parent
+    return new
+
+
+def _insert(model, clones):
+    """
+    Insert ``clones`` with bulk_create. Their pks are only needed to copy
+    m2m rows and to share geometry. Elsewhere classes that need them are
+    saved one by one; on SQLite they are read back as the rows above the
+    previous maximum pk.
+
+    That relies on SQLite allowing a single writer: inside the transaction
+    nobody else can insert between the bulk_create and the read back, and
+    new rowids are always above every existing one, in insertion order.
+    They need not be consecutive, as AUTOINCREMENT never reuses the pk of
+    a deleted newest row. Anything committed by another connection between
+    the maximum being read and the insert shows up as extra rows, and
+    raises DatabaseError rather than mismatching pks.
+
+    Model.save is called unbound and manipulators never run: geometry_final
+    is copied as is. Classes overriding save() never get here; see
+    has_custom_save.
+    """
+    from features import copy_on_write
+    if not clones:
+        return
+    if not (copied_m2m_fields(model) or copy_on_write.is_enabled(model)):
+        model.objects.bulk_create(clones)
+        return
+    connection = connections[model.objects.db]
+    if connection.vendor != 'sqlite':
+        for new in clones:
+            Model.save(new)
+        return
+    assert connection.in_atomic_block, "_insert must run inside a transaction"
+    before = model.objects.aggregate(top=Max('pk'))['top'] or 0
+    model.objects.bulk_create(clones)
+    pks = list(model.objects.filter(pk__gt=before).order_by('pk').values_list(
+        'pk', flat=True))
+    if len(pks) != len(clones):
+        raise DatabaseError("Concurrent inserts into %s while copying"
+                % model._meta.db_table)
+    for new, pk in zip(clones, pks):
+        new.pk = pk
+
+
+def _copy_m2m(model, pairs):
+    """
+    Copy the m2m rows of each (original, copy) pair with one bulk_create
+    per field.
+    """
+    new_pks = dict((old.pk, new.pk) for old, new in pairs)
+    for field in copied_m2m_fields(model):
+        through = field.rel.through
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        rows = []
+        for batch in chunks(new_pks.keys()):
+            rows.extend([
+                through(**{'%s_id' % source: new_pks[pk], '%s_id' % target: tid})
+                for pk, tid in through.objects.filter(
+                    **{'%s__in' % source: batch}).values_list(source, target)])
+        through.objects.bulk_create(rows)
+
+
+def copy_collection(collection, user):
+    """
+    Copy ``collection`` and everything nested below it for ``user``, in a
+    single transaction.
+
+    The tree is cloned level by level: each level's children are loaded
+    with one query per feature class and inserted with one bulk_create per
+    class, their content_type/object_id pointing at the new parents.
+    Collections are inserted one at a time, since their children need
+    their new pks. Children whose class overrides copy() or save() are
+    copied with copy(), then added to their new parent. Children of copy-on-write classes
+    are inserted without geometry and borrow their original's.
+    """
+    from features import aggregates, closure, copy_on_write
+    from features.models import FeatureCollection
+
+    with transaction.atomic():
+        root = clone(collection, user)
+        if has_custom_save(root):
+            root.save()
+        else:
+            Model.save(root)
+        _copy_m2m(collection.__class__, [(collection, root)])
+
+        using = root._state.db
+        seen = set([(collection.__class__, collection.pk)])
+        level = [(collection, root)]
+        while level:
+            parents = {}
+            new_parents = {}
+            for old, new in level:
+                parents.setdefault(old.__class__, []).append(old.pk)
+                new_parents[(ContentType.objects.get_for_model(old).pk, old.pk)] = new
+            child_models = []
+            for parent_model in parents:
+                for model in parent_model.get_options().get_valid_children():
+                    if model not in child_models:
+                        child_models.append(model)
+
+            next_level = []
+            for model in child_models:
+                queryset = children_queryset(model, dict(
+                    (parent_model, pks) for parent_model, pks in parents.items()
+                    if model in parent_model.get_options().get_valid_children()), using)
+                pairs = []
+                for child in iter_chunked(queryset):
+                    if (model, child.pk) in seen:
+                        continue
+                    seen.add((model, child.pk))
+                    parent = new_parents[(child.content_type_id, child.object_id)]
+                    if has_custom_copy(child) or has_custom_save(child):
+                        child.copy(user).add_to_collection(parent)
+                    elif isinstance(child, FeatureCollection):
+                        new = clone(child, user, parent)
+                        Model.save(new)
+                        pairs.append((child, new))
+                        next_level.append((child, new))
+                    else:
+                        new = clone(child, user, parent)
+                        if copy_on_write.is_enabled(model):
+                            copy_on_write.strip(new)
+                        pairs.append((child, new))
+                _insert(model, [new for old, new in pairs
+                                if not isinstance(old, FeatureCollection)])
+                _copy_m2m(model, pairs)
+                if copy_on_write.is_enabled(model):
+                    copy_on_write.share(model, [(old.pk, new) for old, new in pairs])
+            level = next_level
+
+        if closure.is_enabled():
+            closure.refresh_subtree(root)
+        if aggregates.is_enabled():
+            aggregates.refresh_subtree(root)
+    return root
+
+
+def has_custom_delete(instance):
+    """
+    True if the feature class overrides delete(), so it has to be deleted
+    one instance at a time.
+    """
+    from features.models import FeatureCollection
+    return _func(instance.__class__.delete) not in (
+        _func(Model.delete), _func(FeatureCollection.delete))
+
+
+def can_raw_delete(model):
+    """
+    True if nothing references ``model`` rows, so they (and their auto-created
+    m2m rows) can be removed without going through Django's collector.
+    The hidden relations from the model's own auto-created m2m through
+    tables don't count, as delete_trees deletes those rows itself.
+    Copy-on-write classes never can: their copies must be handed the
+    geometry first.
+    """
+    from features import copy_on_write
+    if copy_on_write.is_enabled(model):
+        return False
+    opts = model._meta
+    throughs = set(f.rel.through for f in opts.many_to_many
+                   if f.rel.through._meta.auto_created)
+    related = [r for r in opts.get_all_related_objects(include_hidden=True)
+               if r.model not in throughs]
+    return not (related or opts.get_all_related_many_to_many_objects())
+
+
+def delete_features(instances):
+    """
+    Delete ``instances`` and everything nested below them. Classes that
+    override delete() get their own delete() called; the rest goes
+    through delete_trees.
+    """
+    instances = list(instances)
+    with transaction.atomic():
+        for instance in instances:
+            if has_custom_delete(instance):
+                instance.delete()
+        delete_trees([i for i in instances if not has_custom_delete(i)])
+
+
+def delete_trees(roots):
+    """
+    Delete ``roots`` and every feature nested below them, with one streamed
+    pass over each root's subtree and, per feature class, one DELETE for each m2m through
+    table and one for the feature rows, all in a single transaction.
+
+    Descendants whose class overrides delete() are deleted with it. Classes
+    that other models point at fall back to QuerySet.delete() so Django can
+    cascade. Raw deletes skip pre_delete/post_delete; ``features_deleted``
+    is sent once per class and batch instead.
+    """
+    from features import aggregates
+    from features.models import FeatureCollection
+
+    parents = [r.collection for r in roots if r.object_id is not None]
+    parents = [p for p in parents if p is not None]
+    nodes = []
+    index = {}
+    def add(instance):
+        model = instance.__class__
+        if model not in index:
+            index[model] = len(nodes)
+            nodes.append((model, set()))
+        nodes[index[model]][1].add(instance.pk)
+
+    with transaction.atomic():
+        # Only pks are kept; the subtree itself is streamed
+        for root in roots:
+            add(root)
+            if isinstance(root, FeatureCollection):
+                for instance in root.iter_feature_set(recurse=True):
+                    if has_custom_delete(instance):
+                        instance.delete()
+                    else:
+                        add(instance)
+
+        for model, instances in nodes:
+            if not instances:
+                continue
+            using = model.objects.db
+            if not can_raw_delete(model):
+                for batch in chunks(sorted(instances)):
+                    model.objects.filter(pk__in=batch).delete()
+                continue
+            for batch in chunks(sorted(instances)):
+                for field in model._meta.many_to_many:
+                    if field.rel.through._meta.auto_created:
+                        field.rel.through.objects.filter(**{
+                            '%s__in' % field.m2m_field_name(): batch
+                        })._raw_delete(using)
+                model.objects.filter(pk__in=batch)._raw_delete(using)
+                features_deleted.send(sender=model, pks=batch)
+
+        # Collections that held a deleted root, and weren't deleted themselves
+        if aggregates.is_enabled():
+            aggregates.refresh(*[p for p in parents
+                                 if p.pk not in dict(nodes).get(p.__class__, {})])
@@ -0,0 +1,281 @@
+"""
+Closure table for collection hierarchies.
+
+When the COLLECTION_CLOSURE_TABLE setting is enabled, every feature nested
+in a collection gets one CollectionClosure row per ancestor collection, so
+"everything below this folder" and "every folder above this feature" are
+single indexed queries instead of walks over content_type/object_id
+pointers.
+
+The table is kept current by the receivers below. ``rebuild_closure`` and
+``check_closure`` back the ``rebuild_collection_closure`` management command.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from features.models import CollectionClosure
+from features.registry import registered_models
+from features.signals import collection_changed, features_deleted
+
+
+def is_enabled():
+    return getattr(settings, 'COLLECTION_CLOSURE_TABLE', False)
+
+
+def _key(instance):
+    return ContentType.objects.get_for_model(instance).pk, instance.pk
+
+
+def descendant_pks(collection, model):
+    """
+    Returns a values queryset of the pks of ``model`` instances nested, at
+    any depth, below ``collection``; usable as a ``pk__in`` subquery.
+    """
+    ct_id, pk = _key(collection)
+    return CollectionClosure.objects.filter(
+        ancestor_type=ct_id, ancestor_id=pk,
+        descendant_type=ContentType.objects.get_for_model(model),
+    ).values('descendant_id')
+
+
+def ancestor_keys(instance):
+    """
+    (content type id, pk) of every collection above ``instance``, nearest
+    first.
+    """
+    ct_id, pk = _key(instance)
+    return list(CollectionClosure.objects.filter(
+        descendant_type=ct_id, descendant_id=pk,
+    ).order_by('depth').values_list('ancestor_type_id', 'ancestor_id'))
+
+
+def lineage(collection):
+    """
+    Keys of ``collection`` and of every collection above it.
+    """
+    keys = set([_key(collection)])
+    if is_enabled():
+        keys.update(ancestor_keys(collection))
+        return keys
+    parent = collection.collection
+    while parent is not None and _key(parent) not in keys:
+        keys.add(_key(parent))
+        parent = parent.collection
+    return keys
+
+
+def is_nested_in(instance, collection):
+    """
+    True if ``collection`` is ``instance`` itself or nested below it.
+    """
+    if _key(instance) == _key(collection):
+        return True
+    if is_enabled():
+        ct_id, pk = _key(instance)
+        descendant_ct, descendant_pk = _key(collection)
+        return CollectionClosure.objects.filter(
+            ancestor_type=ct_id, ancestor_id=pk,
+            descendant_type=descendant_ct, descendant_id=descendant_pk,
+        ).exists()
+    return _key(instance) in lineage(collection)
+
+
+def move(instance, collection):
+    """
+    Rewrite the rows of ``instance`` and its whole subtree after it was
+    moved into ``collection`` (or out of any collection, when None).
+    """
+    move_subtrees([instance], collection)
+
+
+def move_subtrees(instances, collection):
+    """
+    Rewrite the rows of every subtree rooted at ``instances`` after they
+    were all moved into ``collection`` (or out of any collection, when
+    None). The number of queries depends on the number of feature classes
+    and the depth of the subtrees, not on the number of instances.
+    """
+    from features.bulk import chunks
+    roots = {}
+    for instance in instances:
+        ct_id, pk = _key(instance)
+        roots.setdefault(ct_id, set()).add(pk)
+
+    # Each node hangs below its nearest moved root; a root moved along with
+    # a collection it was in is no longer nested in that collection
+    subtree = {}
+    for ct_id, pks in roots.items():
+        for pk in pks:
+            subtree[(ct_id, pk)] = 0
+        for batch in chunks(pks):
+            for d_ct, d_pk, depth in CollectionClosure.objects.filter(
+                    ancestor_type=ct_id, ancestor_id__in=batch,
+            ).values_list('descendant_type_id', 'descendant_id', 'depth'):
+                if subtree.get((d_ct, d_pk), depth) >= depth:
+                    subtree[(d_ct, d_pk)] = depth
+
+    # A node's ancestors outside the moved subtree are exactly those further
+    # away than its subtree root
+    by_depth = {}
+    for (d_ct, d_pk), depth in subtree.items():
+        by_depth.setdefault((d_ct, depth), []).append(d_pk)
+    for (d_ct, depth), pks in by_depth.items():
+        for batch in chunks(pks):
+            CollectionClosure.objects.filter(descendant_type=d_ct,
+                    descendant_id__in=batch, depth__gt=depth).delete()
+
+    if collection is None:
+        return
+    parent_ct, parent_pk = _key(collection)
+    ancestors = [(parent_ct, parent_pk, 1)] + [
+        (a_ct, a_pk, depth + 1) for a_ct, a_pk, depth in
+        CollectionClosure.objects.filter(
+            descendant_type=parent_ct, descendant_id=parent_pk,
+        ).values_list('ancestor_type_id', 'ancestor_id', 'depth')]
+    CollectionClosure.objects.bulk_create([
+        CollectionClosure(ancestor_type_id=a_ct, ancestor_id=a_pk,
+                          descendant_type_id=d_ct, descendant_id=d_pk,
+                          depth=a_depth + d_depth)
+        for a_ct, a_pk, a_depth in ancestors
+        for (d_ct, d_pk), d_depth in subtree.items()])
+
+
+def refresh_subtree(root):
+    """
+    Recompute the rows of every feature nested below ``root`` from the
+    containment pointers, e.g. after the subtree was written in bulk
+    without signals.
+    """
+    from features.tree import load_subtree
+    children = load_subtree(root, use_closure=False)
+    root_key = _key(root)
+    above = [(a_ct, a_pk, depth) for a_ct, a_pk, depth in
+             CollectionClosure.objects.filter(
+                 descendant_type=root_key[0], descendant_id=root_key[1],
+             ).values_list('ancestor_type_id', 'ancestor_id', 'depth')]
+
+    rows = []
+    nodes = {}
+    stack = [(root_key, [(root_key[0], root_key[1], 0)] + above)]
+    seen = set([root_key])
+    while stack:
+        key, ancestors = stack.pop()
+        for model, instances in children.get(key, {}).items():
+            for instance in instances:
+                child_key = _key(instance)
+                if child_key in seen:
+                    continue
+                seen.add(child_key)
+                nodes.setdefault(child_key[0], []).append(child_key[1])
+                rows.extend([
+                    CollectionClosure(ancestor_type_id=a_ct, ancestor_id=a_pk,
+                                      descendant_type_id=child_key[0],
+                                      descendant_id=child_key[1], depth=depth + 1)
+                    for a_ct, a_pk, depth in ancestors])
+                stack.append((child_key, [child_key + (0,)] + [
+                    (a_ct, a_pk, depth + 1) for a_ct, a_pk, depth in ancestors]))
+
+    with transaction.atomic():
+        for ct_id, pks in nodes.items():
+            CollectionClosure.objects.filter(descendant_type=ct_id,
+                    descendant_id__in=pks).delete()
+        CollectionClosure.objects.bulk_create(rows)
+
+
+def expected_rows():
+    """
+    Computes the full closure from scratch as a set of (ancestor_type_id,
+    ancestor_id, descendant_type_id, descendant_id, depth) tuples. Only pks
+    and containment pointers are loaded.
+    """
+    parents = {}
+    for model in registered_models:
+        ct_id = ContentType.objects.get_for_model(model).pk
+        for pk, pct, poid in model.objects.values_list(
+                'pk', 'content_type_id', 'object_id'):
+            if pct and poid:
+                parents[(ct_id, pk)] = (pct, poid)
+
+    rows = set()
+    for node in parents:
+        seen = set([node])
+        ancestor = parents[node]
+        depth = 1
+        while ancestor is not None and ancestor not in seen:
+            rows.add(ancestor + node + (depth,))
+            seen.add(ancestor)
+            ancestor = parents.get(ancestor)
+            depth += 1
+    return rows
+
+
+def rebuild_closure(batch_size=1000):
+    """
+    Replace the entire closure table. Returns the number of rows written.
+    """
+    rows = expected_rows()
+    with transaction.atomic():
+        CollectionClosure.objects.all()._raw_delete(CollectionClosure.objects.db)
+        CollectionClosure.objects.bulk_create([
+            CollectionClosure(ancestor_type_id=a_ct, ancestor_id=a_pk,
+                              descendant_type_id=d_ct, descendant_id=d_pk,
+                              depth=depth)
+            for a_ct, a_pk, d_ct, d_pk, depth in rows], batch_size=batch_size)
+    return len(rows)
+
+
+def check_closure():
+    """
+    Compare the closure table against a from-scratch computation.
+    Returns a (missing, stale) pair of row sets; both empty when consistent.
+    """
+    expected = expected_rows()
+    actual = set(CollectionClosure.objects.values_list(
+        'ancestor_type_id', 'ancestor_id', 'descendant_type_id',
+        'descendant_id', 'depth'))
+    return expected - actual, actual - expected
+
+
+def feature_saved(sender, instance, created, **kwargs):
+    if created and is_enabled() and instance.object_id is not None:
+        move(instance, instance.collection)
+
+
+def feature_deleted(sender, instance, **kwargs):
+    if is_enabled():
+        ct_id, pk = _key(instance)
+        CollectionClosure.objects.filter(
+            descendant_type=ct_id, descendant_id=pk).delete()
+        CollectionClosure.objects.filter(
+            ancestor_type=ct_id, ancestor_id=pk).delete()
+
+
+@receiver(features_deleted)
+def features_removed(sender, pks, **kwargs):
+    if is_enabled():
+        ct_id = ContentType.objects.get_for_model(sender).pk
+        CollectionClosure.objects.filter(
+            descendant_type=ct_id, descendant_id__in=pks).delete()
+        CollectionClosure.objects.filter(
+            ancestor_type=ct_id, ancestor_id__in=pks).delete()
+
+
+@receiver(collection_changed)
+def membership_changed(sender, instances, collection, **kwargs):
+    if is_enabled():
+        move_subtrees(instances, collection)
+
+
+def connect_signals():
+    """
+    Hook the closure table up to every registered feature class. Must run
+    before features.visibility connects, since its receivers read the
+    ancestors recorded here.
+    """
+    for model in registered_models:
+        uid = 'features.closure.%s' % model.__name__
+        post_save.connect(feature_saved, sender=model, dispatch_uid=uid)
+        post_delete.connect(feature_deleted, sender=model, dispatch_uid=uid)
@@ -0,0 +1,333 @@
+"""
+Copy-on-write geometry for copied features.
+
+Feature classes whose Options set ``copy_on_write = True`` are copied
+without their geometry columns. The copy's row keeps both columns null
+and a SharedGeometry row points it at the feature that owns the geometry.
+Reading ``geometry_orig`` or ``geometry_final`` on such an instance loads
+the owner's geometry on first access (``borrow`` does the same for many
+instances at once, with two queries per feature class).
+
+A copy gets geometry of its own the first time it is saved with geometry
+other than what it borrowed, i.e. on its first geometry edit; its link is
+dropped then. Saving it with the borrowed geometry unchanged (a rename, say)
+leaves both columns null. When an owner's geometry is changed or the owner
+is deleted, its borrowers are first given their own copy of the geometry as
+it was, so copies never see later edits.
+
+Since the columns of unedited copies are null, anything reading them in SQL
+would silently skip or blank those copies. The querysets of copy-on-write
+classes (see CopyOnWriteQuerySet) therefore raise CopyOnWriteError on
+geometry lookups, on selecting the geometry columns with
+``values()``/``values_list()`` and on the GeoQuerySet spatial methods;
+classes that need spatial queries must leave ``copy_on_write`` off. ``stored`` gives an unguarded queryset over the
+columns as they are.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.db.models.query import GeoQuerySet
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, pre_delete
+
+from features.models import SharedGeometry
+from features.registry import registered_models, get_model_by_content_type_id
+
+GEOMETRY_FIELDS = ('geometry_orig', 'geometry_final')
+
+# Keeps ``__in`` lists under SQLite's bind variable limit
+CHUNK_SIZE = 500
+
+
+def is_enabled(model):
+    try:
+        options = model.get_options()
+    except KeyError:
+        # Not registered (yet)
+        return False
+    if not getattr(options, 'copy_on_write', False):
+        return False
+    names = [f.name for f in model._meta.fields]
+    return all(name in names for name in GEOMETRY_FIELDS)
+
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+def stored(model):
+    """
+    A queryset over ``model`` that reads the geometry columns as stored,
+    i.e. with nulls for copies that still borrow their geometry.
+    """
+    return GeoQuerySet(model=model)
+
+
+class CopyOnWriteError(Exception):
+    """
+    Raised for queries a copy-on-write class refuses to run in SQL.
+    """
+    pass
+
+
+def _refuse(model, what):
+    raise CopyOnWriteError("%s on %s would skip the copies that still "
+            "share their geometry; see features.copy_on_write" % (
+                what, model.__name__))
+
+
+def _lookup_keys(args, kwargs):
+    keys = list(kwargs.keys())
+    pending = [a for a in args if isinstance(a, Q)]
+    while pending:
+        for child in pending.pop().children:
+            if isinstance(child, Q):
+                pending.append(child)
+            else:
+                keys.append(child[0])
+    return keys
+
+
+class CopyOnWriteQuerySet(GeoQuerySet):
+    """
+    Queryset of copy-on-write feature classes. Refuses anything that would
+    read the geometry columns in SQL, where unedited copies hold nulls.
+    """
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        for key in _lookup_keys(args, kwargs):
+            if key.split('__')[0] in GEOMETRY_FIELDS:
+                _refuse(self.model, "Filtering on %s" % key)
+        return super(CopyOnWriteQuerySet, self)._filter_or_exclude(
+            negate, *args, **kwargs)
+
+    def _check_fields(self, fields):
+        if not fields or [f for f in fields if f in GEOMETRY_FIELDS]:
+            _refuse(self.model, "Selecting the geometry columns")
+
+    def values(self, *fields):
+        self._check_fields(fields)
+        return super(CopyOnWriteQuerySet, self).values(*fields)
+
+    def values_list(self, *fields, **kwargs):
+        self._check_fields(fields)
+        return super(CopyOnWriteQuerySet, self).values_list(*fields, **kwargs)
+
+    def _spatial_setup(self, att, *args, **kwargs):
+        _refuse(self.model, "GeoQuerySet.%s()" % att)
+
+    def _spatial_aggregate(self, aggregate, *args, **kwargs):
+        _refuse(self.model, "The %s aggregate" % aggregate.__name__)
+
+
+def _unloaded(instance):
+    return instance.pk is not None and \
+        '_geometry_source' not in instance.__dict__ and \
+        all(instance.__dict__.get(name) is None for name in GEOMETRY_FIELDS)
+
+
+class SharedGeometryProxy(object):
+    """
+    Wraps the GeometryProxy of a geometry field so an instance without
+    geometry of its own borrows its owner's on first access.
+    """
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        if _unloaded(instance):
+            borrow([instance])
+        return self.proxy.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        self.proxy.__set__(instance, value)
+
+
+def install(model):
+    for name in GEOMETRY_FIELDS:
+        proxy = model.__dict__.get(name)
+        if proxy is not None and not isinstance(proxy, SharedGeometryProxy):
+            setattr(model, name, SharedGeometryProxy(proxy))
+
+
+def source_keys(model, pks):
+    """
+    Returns a dict mapping each of ``pks`` that borrows its geometry to
+    the (content type id, pk) of the owner.
+    """
+    ct_id = ContentType.objects.get_for_model(model).pk
+    sources = {}
+    for batch in _chunks(pks):
+        for object_id, source_type, source_id in SharedGeometry.objects.filter(
+                content_type=ct_id, object_id__in=batch).values_list(
+                'object_id', 'source_type_id', 'source_id'):
+            sources[object_id] = (source_type, source_id)
+    return sources
+
+
+def geometries(keys):
+    """
+    Returns a dict mapping (content type id, pk) keys to their
+    (geometry_orig, geometry_final) pair, with one query per feature class.
+    """
+    by_ct = {}
+    for ct_id, pk in keys:
+        by_ct.setdefault(ct_id, set()).add(pk)
+    found = {}
+    for ct_id, pks in by_ct.items():
+        model = get_model_by_content_type_id(ct_id)
+        for batch in _chunks(pks):
+            for row in stored(model).filter(pk__in=batch).values_list(
+                    'pk', *GEOMETRY_FIELDS):
+                found[(ct_id, row[0])] = row[1:]
+    return found
+
+
+def borrow(instances):
+    """
+    Load the owner's geometry into every instance (of copy-on-write
+    classes) that has none of its own and hasn't looked it up yet.
+    """
+    by_model = {}
+    for instance in instances:
+        if is_enabled(instance.__class__) and _unloaded(instance):
+            instance.__dict__['_geometry_source'] = None
+            by_model.setdefault(instance.__class__, []).append(instance)
+    if not by_model:
+        return
+    sources = {}
+    for model, model_instances in by_model.items():
+        keys = source_keys(model, [i.pk for i in model_instances])
+        for instance in model_instances:
+            if instance.pk in keys:
+                sources[instance] = keys[instance.pk]
+    found = geometries(set(sources.values()))
+    for instance, key in sources.items():
+        if key in found:
+            # Kept apart so saving can tell an edit from the borrowed values
+            instance.__dict__['_borrowed'] = found[key]
+            for name, value in zip(GEOMETRY_FIELDS, found[key]):
+                instance.__dict__[name] = value and value.clone()
+            instance.__dict__['_geometry_source'] = key
+
+
+def share(model, pairs):
+    """
+    Link each (original pk, copy) pair of ``model`` so the copy borrows the
+    original's geometry, or whatever the original itself borrows from. The
+    copies must be saved with their geometry columns left null.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return
+    ct_id = ContentType.objects.get_for_model(model).pk
+    sources = source_keys(model, [pk for pk, copy in pairs])
+    links = []
+    for pk, copy in pairs:
+        source_type, source_id = sources.get(pk, (ct_id, pk))
+        links.append(SharedGeometry(content_type_id=ct_id, object_id=copy.pk,
+                source_type_id=source_type, source_id=source_id))
+        # Borrowed on next access
+        copy.__dict__.pop('_geometry_source', None)
+    SharedGeometry.objects.bulk_create(links)
+
+
+def strip(copy):
+    """
+    Clear the geometry of an unsaved copy before it is saved and shared.
+    """
+    for name in GEOMETRY_FIELDS:
+        setattr(copy, name, None)
+    copy.__dict__['_geometry_source'] = None
+    copy.__dict__.pop('_borrowed', None)
+
+
+def release(model, pks):
+    """
+    Give everything borrowing geometry from ``pks`` its own copy of that
+    geometry, as currently stored, and drop their links.
+    """
+    ct_id = ContentType.objects.get_for_model(model).pk
+    for batch in _chunks(pks):
+        links = list(SharedGeometry.objects.filter(source_type=ct_id,
+                source_id__in=batch).values_list(
+                'pk', 'content_type_id', 'object_id', 'source_id'))
+        if not links:
+            continue
+        owned = geometries([(ct_id, source_id) for _, _, _, source_id in links])
+        borrowers = {}
+        for _, borrower_ct, object_id, source_id in links:
+            borrowers.setdefault((borrower_ct, source_id), []).append(object_id)
+        for (borrower_ct, source_id), object_ids in borrowers.items():
+            borrower_model = get_model_by_content_type_id(borrower_ct)
+            borrower_model.objects.filter(pk__in=object_ids).update(
+                **dict(zip(GEOMETRY_FIELDS, owned[(ct_id, source_id)])))
+        SharedGeometry.objects.filter(pk__in=[pk for pk, _, _, _ in links]).delete()
+
+
+def _current(instance):
+    return tuple(instance.__dict__.get(name) for name in GEOMETRY_FIELDS)
+
+
+def feature_saving(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None or _unloaded(instance):
+        return
+    borrowed = instance.__dict__.get('_borrowed')
+    if instance.__dict__.get('_geometry_source') and borrowed == _current(instance):
+        # Unchanged borrowed geometry is not written; the copy stays light
+        instance.__dict__['_geometry_restore'] = _current(instance)
+        for name in GEOMETRY_FIELDS:
+            instance.__dict__[name] = None
+        return
+    # Borrowers keep the geometry they were copied with
+    ct_id = ContentType.objects.get_for_model(sender).pk
+    if not SharedGeometry.objects.filter(source_type=ct_id,
+                                         source_id=instance.pk).exists():
+        return
+    stored = geometries([(ct_id, instance.pk)]).get((ct_id, instance.pk))
+    if stored is not None and stored != _current(instance):
+        release(sender, [instance.pk])
+
+
+def feature_saved(sender, instance, created, raw=False, **kwargs):
+    restore = instance.__dict__.pop('_geometry_restore', None)
+    if restore is not None:
+        for name, value in zip(GEOMETRY_FIELDS, restore):
+            instance.__dict__[name] = value
+        return
+    # Saving geometry of its own ends the borrowing
+    if created or raw:
+        return
+    if instance.__dict__.get('_geometry_source', True) is None:
+        return
+    if any(instance.__dict__.get(name) is not None for name in GEOMETRY_FIELDS):
+        SharedGeometry.objects.filter(
+            content_type=ContentType.objects.get_for_model(sender),
+            object_id=instance.pk).delete()
+        instance.__dict__['_geometry_source'] = None
+        instance.__dict__.pop('_borrowed', None)
+
+
+def feature_deleting(sender, instance, **kwargs):
+    # The deleted instance keeps what it borrowed, for post_delete receivers
+    borrow([instance])
+    release(sender, [instance.pk])
+    SharedGeometry.objects.filter(
+        content_type=ContentType.objects.get_for_model(sender),
+        object_id=instance.pk).delete()
+
+
+def connect_signals():
+    """
+    Install the borrowing descriptors and receivers on every registered
+    copy-on-write feature class.
+    """
+    for model in registered_models:
+        if not is_enabled(model):
+            continue
+        install(model)
+        uid = 'features.copy_on_write.%s' % model.__name__
+        pre_save.connect(feature_saving, sender=model, dispatch_uid=uid)
+        post_save.connect(feature_saved, sender=model, dispatch_uid=uid)
+        pre_delete.connect(feature_deleting, sender=model, dispatch_uid=uid)
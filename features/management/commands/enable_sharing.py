@@ -39,7 +39,7 @@ class Command(BaseCommand):
             return
 
         enable_sharing()
-        print(""")
+        print("""
 The site is now configured to allow sharing.
 For a group to share features, you must grant this permission explictly to group:
 
@@ -48,4 +48,4 @@ For a group to share features, you must grant this permission explictly to group
 OR to grant sharing permissions to all groups:
 
     $ python manage.py enable_sharing --all
-"""
+""")
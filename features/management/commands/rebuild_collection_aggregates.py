@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from features.aggregates import rebuild_aggregates
+
+
+class Command(BaseCommand):
+    help = "Recomputes the cached counts, extents, area and length of every collection"
+
+    def handle(self, *args, **options):
+        count = rebuild_aggregates()
+        print("Aggregates rebuilt for %d collections" % count)
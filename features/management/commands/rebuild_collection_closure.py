@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from features.closure import rebuild_closure, check_closure
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the collection closure table from the containment pointers"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check',
+            help="Only compare the closure table against the live containment data"),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help="Rows per INSERT when rebuilding (default 1000)"),
+        )
+
+    def handle(self, *args, **options):
+        if options.get('check'):
+            missing, stale = check_closure()
+            print("%d missing rows, %d stale rows" % (len(missing), len(stale)))
+            for row in sorted(missing)[:20]:
+                print("  missing %s_%s > %s_%s depth=%s" % row)
+            for row in sorted(stale)[:20]:
+                print("  stale   %s_%s > %s_%s depth=%s" % row)
+            if missing or stale:
+                raise CommandError("Collection closure table is inconsistent; "
+                        "run `manage.py rebuild_collection_closure`")
+            return
+
+        count = rebuild_closure(batch_size=options.get('batch_size'))
+        print("Collection closure table rebuilt with %d rows" % count)
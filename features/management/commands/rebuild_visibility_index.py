@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from features.visibility import rebuild_index, check_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the sharing visibility index from scratch"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check',
+            help="Only compare the index against the live sharing data"),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help="Rows per INSERT when rebuilding (default 1000)"),
+        )
+
+    def handle(self, *args, **options):
+        if options.get('check'):
+            missing, stale = check_index()
+            print("%d missing rows, %d stale rows" % (len(missing), len(stale)))
+            for row in sorted(missing)[:20]:
+                print("  missing group=%s content_type=%s object_id=%s" % row)
+            for row in sorted(stale)[:20]:
+                print("  stale   group=%s content_type=%s object_id=%s" % row)
+            if missing or stale:
+                raise CommandError("Visibility index is inconsistent; "
+                        "run `manage.py rebuild_visibility_index`")
+            return
+
+        count = rebuild_index(batch_size=options.get('batch_size'))
+        print("Visibility index rebuilt with %d rows" % count)
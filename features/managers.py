@@ -1,8 +1,121 @@
-from django.contrib.gis.db import models
-from django.contrib.auth.models import Group, Permission
+import calendar
+from datetime import datetime, timedelta
+
 from django.conf import settings
+from django.contrib.gis.db import models
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.utils import timezone
+from features.tree import supports_recursive_cte, contained_pks_sql, quote, \
+    pointer_in_sql, filter_pk_in
+from features.registry import sharing_group_ids, cache_version, \
+    SHARING_GROUPS_CACHE_TIMEOUT
+
+
+def shared_pks_sql(model, group_ids, connection):
+    """
+    Returns (sql, params) selecting the pks of ``model`` instances whose
+    sharing_groups include any of ``group_ids``.
+    """
+    field = model._meta.get_field('sharing_groups')
+    sql = "SELECT %s FROM %s WHERE %s IN (%s)" % (
+        quote(connection, field.m2m_column_name()),
+        quote(connection, field.m2m_db_table()),
+        quote(connection, field.m2m_reverse_name()),
+        ', '.join(['%s'] * len(group_ids)))
+    return sql, list(group_ids)
+
+
+def shared_keys_sql(collection_models, group_ids, connection):
+    """
+    Returns a SELECT of ``(ct, oid)`` rows for the instances of
+    ``collection_models`` shared with any of ``group_ids``. The group ids
+    are inlined, as the statement may be repeated within a larger one.
+    """
+    selects = []
+    for model in collection_models:
+        field = model._meta.get_field('sharing_groups')
+        selects.append("SELECT DISTINCT %d AS ct, %s AS oid FROM %s WHERE %s IN (%s)" % (
+            ContentType.objects.get_for_model(model).pk,
+            quote(connection, field.m2m_column_name()),
+            quote(connection, field.m2m_db_table()),
+            quote(connection, field.m2m_reverse_name()),
+            ', '.join([str(int(pk)) for pk in group_ids])))
+    return ' UNION ALL '.join(selects)
+
+
+def collection_levels(group_ids, using='default'):
+    """
+    Walks the collections visible to ``group_ids`` breadth first, one query
+    per collection model per level. Returns a list with a dict per level,
+    mapping each collection model to the set of pks first reached there:
+    level 0 holds the collections shared directly, level 1 those nested in
+    them, and so on. Only collection pks are ever held in memory.
+    """
+    from features.registry import get_collection_models
+    collection_models = get_collection_models()
+    connection = connections[using]
+    visible = dict((m, set()) for m in collection_models)
+    frontier = dict((m, set(m.objects.using(using).filter(
+        sharing_groups__in=group_ids).values_list('pk', flat=True)))
+        for m in collection_models)
+    levels = []
+    while any(frontier.values()):
+        levels.append(frontier)
+        for model, pks in frontier.items():
+            visible[model].update(pks)
+        next_frontier = {}
+        for model in collection_models:
+            clauses = [pointer_in_sql(model, parent, frontier[parent], connection)
+                       for parent in set(model.get_options().get_potential_parents())
+                       if frontier.get(parent)]
+            pks = set()
+            if clauses:
+                pks = set(model.objects.using(using).extra(where=[' OR '.join(clauses)]
+                    ).values_list('pk', flat=True))
+            # Already visited collections stop a containment cycle
+            next_frontier[model] = pks - visible[model]
+        frontier = next_frontier
+    return levels
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(instance):
+    """
+    Keyset pagination cursor for an instance: "<date_modified as
+    microseconds since the epoch, negative before it>-<pk>". Safe to pass
+    in a query string.
+    """
+    modified = instance.date_modified
+    if timezone.is_aware(modified):
+        modified = timezone.make_naive(modified, timezone.utc)
+    micros = calendar.timegm(modified.timetuple()) * 1000000 + modified.microsecond
+    return '%d-%d' % (micros, instance.pk)
+
+
+def decode_cursor(cursor):
+    """
+    Inverse of encode_cursor; returns a (date_modified, pk) pair.
+    Raises ValueError on a malformed cursor.
+    """
+    # Dates before the epoch have a negative first part
+    micros, pk = [int(x) for x in cursor.rsplit('-', 1)]
+    modified = EPOCH + timedelta(microseconds=micros)
+    if settings.USE_TZ:
+        modified = timezone.make_aware(modified, timezone.utc)
+    return modified, pk
+
 
 class ShareableGeoManager(models.GeoManager):
+    def get_queryset(self):
+        from features import copy_on_write
+        if copy_on_write.is_enabled(self.model):
+            return copy_on_write.CopyOnWriteQuerySet(self.model, using=self._db)
+        return super(ShareableGeoManager, self).get_queryset()
+
     def shared_with_user(self, user, filter_groups=None, exclude_models=None):
         """
         Returns a queryset containing any objects that have been
@@ -11,90 +124,147 @@ class ShareableGeoManager(models.GeoManager):
         Assumes that the model has been setup according to the instructions
         for implementing a shared model.
         """
-        app_name = self.model._meta.app_label
-        model_name = self.model.__name__.lower()
-        try:
-            perm = Permission.objects.get(codename='can_share_features')
-        except Exception as e:
-            print("ERROR: Feature sharing not enabled. Please run `manage.py enable_sharing`")
-
-        if user.is_anonymous() or not user.is_authenticated():
-            # public users get special treatment -
-            # ONLY get to see anything shared with a public group
-            groups = Group.objects.filter(name__in=settings.SHARING_TO_PUBLIC_GROUPS)
-        else:
-            if user.is_staff:
-                # Staff users get their groups,plus 'shared_to_staff_groups',  plus public groups
-                groups = Group.objects.filter(
-                            models.Q(
-                                pk__in=[x.pk for x in user.groups.all()]
-                            ) |
-                            models.Q(
-                                name__in=settings.SHARING_TO_PUBLIC_GROUPS
-                            ) |
-                            models.Q(
-                                name__in=settings.SHARING_TO_STAFF_GROUPS
-                            )
-                        ).distinct()
-            else:
-                # Non-staff authenticated users get their groups plus public groups, MINUS shared_to_staff groups
-                groups = Group.objects.filter(
-                            models.Q(
-                                pk__in=[x.pk for x in user.groups.all()]
-                            ) |
-                            models.Q(
-                                name__in=settings.SHARING_TO_PUBLIC_GROUPS
-                            )
-                        ).distinct().exclude(name__in=settings.SHARING_TO_STAFF_GROUPS)
+        anonymous = user.is_anonymous() or not user.is_authenticated()
+        if anonymous and not filter_groups and not exclude_models:
+            # Anonymous traffic all sees the same tree, walked once
+            group_ids = sharing_group_ids(user)
+            return self._shared_with_group_ids(group_ids,
+                    levels=self.public_levels(group_ids))
 
+        group_ids = sharing_group_ids(user)
         if filter_groups and len(filter_groups) > 0:
-            groups = groups.filter(pk__in=[x.pk for x in filter_groups])
-        else:
-            filter_groups = None
+            filter_ids = set([x.pk for x in filter_groups])
+            group_ids = [pk for pk in group_ids if pk in filter_ids]
 
-        # Check for a Container
-        potential_parents = self.model.get_options().get_potential_parents()
-        if potential_parents:
-            contained_ids = []
-            for collection_model in potential_parents:
-                # Avoid infinite recursion
-                if exclude_models and collection_model in exclude_models:
-                    continue
-
-                exclude_models = None
-                if collection_model == self.model:
-                    # On the next recurisive go-round, avoid infinite recursion
-                    exclude_models = [self.model]
-
-                # Get container objects shared with user
-                if filter_groups:
-                    shared_containers = collection_model.objects.shared_with_user(user,filter_groups=filter_groups,exclude_models=exclude_models)
-                else:
-                    shared_containers = collection_model.objects.shared_with_user(user,exclude_models=exclude_models)
-
-                # Create list of contained object ids
-                for sc in shared_containers:
-                    #contained = sc.__getattribute__(shared_content_type.container_set_property)
-                    contained = sc.feature_set(recurse=True,feature_classes=[self.model])
-                    contained_ids.extend([x.id for x in contained])
-
-            return self.filter(
-                models.Q(
-                    sharing_groups__permissions=perm,
-                    sharing_groups__in=groups
-                ) |
-                models.Q(
-                    pk__in=contained_ids
-                )
-            ).distinct()
-        else:
+        return self._shared_with_group_ids(group_ids, exclude_models)
+
+    def shared_with_user_page(self, user, page_size=100, after=None):
+        """
+        One page of ``shared_with_user``, ordered by (date_modified, pk) and
+        starting just after the ``after`` cursor (see encode_cursor).
+
+        Returns a (instances, next_cursor) pair; next_cursor is None on the
+        last page. Only page_size + 1 rows are ever fetched, with their
+        users.
+        """
+        qs = self.shared_with_user(user)
+        if after:
+            modified, pk = decode_cursor(after)
+            qs = qs.filter(models.Q(date_modified__gt=modified) |
+                           models.Q(date_modified=modified, pk__gt=pk))
+        qs = qs.select_related('user').order_by('date_modified', 'pk')
+        page = list(qs[:page_size + 1])
+        if len(page) > page_size:
+            page = page[:page_size]
+            return page, encode_cursor(page[-1])
+        return page, None
+
+    def iter_shared_with_user(self, user, page_size=100, after=None):
+        """
+        Iterate over everything shared with ``user`` a page at a time, so
+        large shares never have to be loaded into memory at once.
+        """
+        while True:
+            page, after = self.shared_with_user_page(user, page_size, after)
+            for instance in page:
+                yield instance
+            if after is None:
+                return
+
+    def public_levels(self, group_ids):
+        """
+        Number of levels of collections visible to the public ``group_ids``
+        (see collection_levels), so the non-CTE fallback doesn't have to
+        walk the public tree for every anonymous request.
+
+        Kept in the Django cache under the 'public' cache version, which is
+        bumped whenever something is shared to or unshared from a public
+        group, or moved in or out of a publicly visible collection. Only a
+        count is cached, whatever the number of public features; a stale
+        count left by a deletion is too deep, which is harmless.
+        """
+        key = 'features:public-levels:%s:%s:%s' % (self.db,
+                cache_version('public'), ','.join([str(pk) for pk in group_ids]))
+        levels = cache.get(key)
+        if levels is None:
+            levels = len(collection_levels(group_ids, self.db))
+            cache.set(key, levels, SHARING_GROUPS_CACHE_TIMEOUT)
+        return levels
+
+    def _shared_with_group_ids(self, group_ids, exclude_models=None, levels=None):
+        """
+        Objects shared with any of ``group_ids``, directly or through a
+        collection. ``levels``, the number of levels of visible collections,
+        saves the non-CTE fallback its walk when already known.
+        """
+        if not group_ids:
+            # Nothing can be shared with this user
+            return self.none()
+
+        from features import visibility
+        if visibility.is_enabled():
+            return self.filter(pk__in=visibility.visible_pks(self.model, group_ids))
+
+        if supports_recursive_cte(self.db):
+            return self._shared_with_groups_cte(group_ids)
+
+        direct = models.Q(sharing_groups__in=group_ids)
+        potential_parents = [m for m in self.model.get_options().get_potential_parents()
+                             if not (exclude_models and m in exclude_models)]
+        if not potential_parents:
             # No containers, just a straight 'is it shared' query
-            return self.filter(
-                models.Q(
-                    sharing_groups__permissions=perm,
-                    sharing_groups__in=groups
-                )
-            ).distinct()
+            return self.filter(direct).distinct()
+
+        # Without a recursive CTE the walk is unrolled to the depth of the
+        # visible collections, so the statement grows with the depth of the
+        # tree but never with the number of collections or features in it
+        from features.registry import get_collection_models
+        if levels is None:
+            walked = collection_levels(group_ids, self.db)
+            if not any(level.get(m) for level in walked for m in potential_parents):
+                return self.filter(direct).distinct()
+            levels = len(walked)
+        if not levels:
+            return self.filter(direct).distinct()
+        connection = connections[self.db]
+        collection_models = get_collection_models()
+        direct_sql, params = shared_pks_sql(self.model, group_ids, connection)
+        contained_sql = contained_pks_sql(self.model,
+                shared_keys_sql(collection_models, group_ids, connection),
+                collection_models, connection, depth=levels - 1,
+                parent_models=potential_parents)
+        return filter_pk_in(self.all(), [direct_sql, contained_sql], params)
+
+    def _shared_with_groups_cte(self, group_ids):
+        """
+        Single-statement version of shared_with_user: an object is visible
+        if it is shared directly with one of ``group_ids``, or if it sits
+        anywhere below a collection that is. Containment is resolved with a
+        recursive CTE over the content_type/object_id pointers of every
+        potential parent model.
+        """
+        connection = connections[self.db]
+        direct_sql, params = shared_pks_sql(self.model, group_ids, connection)
+        sqls = [direct_sql]
+
+        potential_parents = []
+        for model in self.model.get_options().get_potential_parents():
+            if model not in potential_parents:
+                potential_parents.append(model)
+
+        if potential_parents:
+            anchors = []
+            for model in potential_parents:
+                sql, anchor_params = shared_pks_sql(model, group_ids, connection)
+                anchors.append("SELECT %d AS ct, shared.%s AS oid FROM (%s) shared" % (
+                    ContentType.objects.get_for_model(model).pk,
+                    quote(connection, model._meta.get_field('sharing_groups').m2m_column_name()),
+                    sql))
+                params.extend(anchor_params)
+            sqls.append(contained_pks_sql(self.model, ' UNION ALL '.join(anchors),
+                    potential_parents, connection))
+
+        return filter_pk_in(self.all(), sqls, params)
 
 #     if not settings.ENABLE_SHARABLE_OBJECTS:
 #         def nothing(self, *args, **kwargs):
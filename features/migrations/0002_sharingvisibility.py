@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0001_initial'),
+        ('contenttypes', '0001_initial'),
+        ('features', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharingVisibility',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+                ('group', models.ForeignKey(related_name='+', to='auth.Group')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sharingvisibility',
+            unique_together=set([('group', 'content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sharingvisibility',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('features', '0002_sharingvisibility'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionClosure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('ancestor_id', models.PositiveIntegerField()),
+                ('descendant_id', models.PositiveIntegerField()),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+                ('descendant_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='collectionclosure',
+            unique_together=set([('ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='collectionclosure',
+            index_together=set([('descendant_type', 'descendant_id')]),
+        ),
+    ]
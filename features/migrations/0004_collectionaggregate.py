@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('features', '0003_collectionclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionAggregate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('direct_count', models.PositiveIntegerField(default=0)),
+                ('recursive_count', models.PositiveIntegerField(default=0)),
+                ('minx', models.FloatField(null=True, blank=True)),
+                ('miny', models.FloatField(null=True, blank=True)),
+                ('maxx', models.FloatField(null=True, blank=True)),
+                ('maxy', models.FloatField(null=True, blank=True)),
+                ('area', models.FloatField(default=0)),
+                ('length', models.FloatField(default=0)),
+                ('content_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='collectionaggregate',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+    ]
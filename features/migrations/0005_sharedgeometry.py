@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('features', '0004_collectionaggregate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedGeometry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('object_id', models.PositiveIntegerField()),
+                ('source_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+                ('source_type', models.ForeignKey(related_name='+', to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sharedgeometry',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sharedgeometry',
+            index_together=set([('source_type', 'source_id')]),
+        ),
+    ]
@@ -6,7 +6,14 @@ from django.http import HttpResponse
 from django.utils.html import escape
 from .managers import ShareableGeoManager
 from .forms import FeatureForm
-from features.registry import get_model_options
+from features.registry import get_model_options, model_uid, url_for, \
+    feature_class
+from features.signals import collection_changed
+from features.bulk import group_list, check_sharing_groups, copy_collection, \
+    delete_trees
+from features.touch import touch, coalesced_touches
+from features.tree import load_subtree, descendant_models, children_queryset, \
+    iter_chunked, project, projection_fields
 from manipulators.geometry import ensure_clean
 import logging
 from manipulators.manipulators import manipulatorsDict, NullManipulator
@@ -71,18 +78,15 @@ class Feature(models.Model):
         if form is not None:
             form.save_m2m()
 
-    @models.permalink
     def get_absolute_url(self):
-        return ('%s_resource' % (self.get_options().slug, ), (), {
-            'uid': self.uid
-        })
+        return url_for('%s_resource' % (self.get_options().slug, ), uid=self.uid)
 
     @classmethod
     def get_options(klass):
         """
         Returns model class Options object
         """
-        return get_model_options(klass.__name__)
+        return get_model_options(feature_class(klass).__name__)
 
     @classmethod
     def css(klass):
@@ -119,8 +123,7 @@ class Feature(models.Model):
         """
         class method providing the uid for the model class.
         """
-        ct = ContentType.objects.get_for_model(klass)
-        return "%s_%s" % (ct.app_label, ct.model)
+        return model_uid(klass)
 
     @property
     def hash(self):
@@ -174,18 +177,30 @@ class Feature(models.Model):
         assert issubclass(collection.__class__, FeatureCollection)
         assert self.__class__ in collection.get_options().get_valid_children()
         assert self.user == collection.user
-        self.collection = collection
-        self.save(rerun=False)
+        from features.closure import is_nested_in
+        if isinstance(self, FeatureCollection) and is_nested_in(self, collection):
+            raise Exception("Can't add a collection to itself or to a "
+                    "collection nested inside it")
+        previous = self.collection
+        with coalesced_touches():
+            self.collection = collection
+            self.save(rerun=False)
+            touch(collection, previous)
+            collection_changed.send(sender=self.__class__, instances=[self],
+                    collection=collection, previous=[previous] if previous else [])
 
     def remove_from_collection(self):
         """
         Remove feature from FeatureCollection
         """
         collection = self.collection
-        self.collection = None
-        self.save(rerun=False)
-        if collection:
-            collection.save(rerun=True)
+        with coalesced_touches():
+            self.collection = None
+            self.save(rerun=False)
+            if collection:
+                touch(collection)
+                collection_changed.send(sender=self.__class__, instances=[self],
+                        collection=None, previous=[collection])
 
     def unshare_with(self, group):
         """If the object is shared with group, remove it.
@@ -198,33 +213,42 @@ class Feature(models.Model):
         Owner must be a member of the group/groups.
         Group must have 'can_share' permissions else an Exception is raised
         """
+        groups = group_list(groups)
+        if groups:
+            check_sharing_groups([self], groups)
         if not append:
-            # Don't append to existing groups; Wipe the slate clean
+            # Don't append to existing groups; drop the ones not listed
             # Note that this is the default behavior
-            self.sharing_groups.clear()
-
-        if groups is None or groups == []:
-            # Nothing to do here
-            return True
+            stale = list(self.sharing_groups.exclude(pk__in=[g.pk for g in groups]))
+            if stale:
+                self.sharing_groups.remove(*stale)
+        if groups:
+            self.sharing_groups.add(*groups)
+        self.save(rerun=False)
+        return True
 
-        if isinstance(groups,Group):
-            # Only a single group was provided, make a 1-item list
-            groups = [groups]
+    @classmethod
+    def viewable_mask(klass, user, instances):
+        """
+        Returns the subset of ``instances`` (which may mix feature classes)
+        that the specified user may view, in their original order.
+        Ownership is checked in python; the rest costs one shared_with_user
+        query per feature class.
+        """
+        anonymous = user.is_anonymous() or not user.is_authenticated()
+        unowned = {}
+        for instance in instances:
+            if anonymous or instance.user_id != user.pk:
+                unowned.setdefault(instance.__class__, set()).add(instance.pk)
 
-        for group in groups:
-            assert isinstance(group, Group)
-            # Check that the group to be shared with has appropos permissions
-            assert group in self.user.groups.all()
-            try:
-                gp = group.permissions.get(codename='can_share_features')
-            except:
-                raise Exception("The group you are trying to share with "
-                        "does not have can_share permission")
+        shared = {}
+        for model, pks in unowned.items():
+            shared[model] = set(model.objects.shared_with_user(user).filter(
+                pk__in=pks).values_list('pk', flat=True))
 
-            self.sharing_groups.add(group)
-
-        self.save(rerun=False)
-        return True
+        return [i for i in instances
+                if i.pk not in unowned.get(i.__class__, ()) or
+                   i.pk in shared[i.__class__]]
 
     def is_viewable(self, user):
         """
@@ -232,29 +256,18 @@ class Feature(models.Model):
         Either needs to own it or have it shared with them.
         returns : Viewable(boolean), HttpResponse
         """
-        # First, is the user logged in?
-        if user.is_anonymous() or not user.is_authenticated():
-            try:
-                obj = self.__class__.objects.shared_with_user(user).get(pk=self.pk)
-                return True, HttpResponse("Object shared with public, viewable by anonymous user", status=202)
-            except self.__class__.DoesNotExist:
+        anonymous = user.is_anonymous() or not user.is_authenticated()
+        if not self.viewable_mask(user, [self]):
+            if anonymous:
                 # Unless the object is publicly shared, we won't give away anything
                 return False, HttpResponse('You must be logged in', status=401)
-
-        # Does the user own it?
-        if self.user == user:
-            return True, HttpResponse("Object owned by user",status=202)
-
-        # Next see if its shared with the user
-        try:
-            # Instead having the sharing logic here, use the shared_with_user
-            # We need it to return querysets so no sense repeating that logic
-            obj = self.__class__.objects.shared_with_user(user).get(pk=self.pk)
-            return True, HttpResponse("Object shared with user", status=202)
-        except self.__class__.DoesNotExist:
             return False, HttpResponse("Access denied", status=403)
 
-        return False, HttpResponse("Server Error in feature.is_viewable()", status=500)
+        if anonymous:
+            return True, HttpResponse("Object shared with public, viewable by anonymous user", status=202)
+        if self.user_id == user.pk:
+            return True, HttpResponse("Object owned by user",status=202)
+        return True, HttpResponse("Object shared with user", status=202)
 
     def copy(self, user=None):
         """
@@ -266,12 +279,18 @@ class Feature(models.Model):
         # that described in django ticket 4027
         # http://code.djangoproject.com/ticket/4027
         the_feature = self
+        original_pk = self.pk
 
         # Make an inventory of all many-to-many fields in the original feature
         m2m = {}
         for f in the_feature._meta.many_to_many:
             m2m[f.name] = the_feature.__getattribute__(f.name).all()
 
+        from features import copy_on_write
+        shares_geometry = copy_on_write.is_enabled(self.__class__)
+        if shares_geometry:
+            copy_on_write.strip(the_feature)
+
         # The black magic voodoo way,
         # makes a copy but relies on this strange implementation detail of
         # setting the pk & id to null
@@ -296,6 +315,8 @@ class Feature(models.Model):
         the_feature.remove_from_collection()
 
         the_feature.save(rerun=False)
+        if shares_geometry:
+            copy_on_write.share(self.__class__, [(original_pk, the_feature)])
         return the_feature
 
 class SpatialFeature(Feature):
@@ -678,26 +699,50 @@ class FeatureCollection(Feature):
     def remove(self, f):
         """Removes a specified Feature from the Collection"""
         if f.collection == self:
-            f.remove_from_collection()
-            self.save() # This updates the date_modified field of the collection
+            with coalesced_touches():
+                f.remove_from_collection()
+                touch(self) # Keeps this instance's date_modified current
         else:
             raise Exception('Feature `%s` is not in Collection `%s`' % (f.name, self.name))
 
     def save(self, rerun=True, *args, **kwargs):
         super(FeatureCollection, self).save(*args, **kwargs) # Call the "real" save() method
 
+    @property
+    def aggregates(self):
+        """
+        Cached summary of the collection's contents: direct and recursive
+        feature counts, extent, total area and length. None unless the
+        COLLECTION_AGGREGATES setting is on. See features.aggregates.
+        """
+        from features import aggregates
+        if not aggregates.is_enabled():
+            return None
+        return aggregates.get(self).dict()
+
     @property
     def kml(self):
-        features = self.feature_set()
-        kmls = [x.kml for x in features]
+        kmls = [x.kml for x in self.iter_feature_set()]
+        aggregates = self.aggregates
+        extended_data = ''
+        if aggregates is not None:
+            extended_data = """
+          <ExtendedData>
+            <Data name="direct_count"><value>%d</value></Data>
+            <Data name="recursive_count"><value>%d</value></Data>
+            <Data name="area"><value>%s</value></Data>
+            <Data name="length"><value>%s</value></Data>
+          </ExtendedData>""" % (aggregates['direct_count'],
+                aggregates['recursive_count'], aggregates['area'],
+                aggregates['length'])
         return """
         <Folder id="%s">
           <name>%s</name>
           <visibility>0</visibility>
-          <open>0</open>
+          <open>0</open>%s
           %s
         </Folder>
-        """ % (self.uid, self.name, ''.join(kmls))
+        """ % (self.uid, self.name, extended_data, ''.join(kmls))
 
     @property
     def kml_style(self):
@@ -710,11 +755,16 @@ class FeatureCollection(Feature):
     def kml_style_id(self):
         return "%s-default" % self.model_uid()
 
-    def feature_set(self, recurse=False, feature_classes=None):
+    def feature_set(self, recurse=False, feature_classes=None, values=None):
         """
         Returns a list of Features belonging to the Collection
         Optionally recurse into all child containers
         or limit/filter for a list of feature classes
+
+        ``values`` swaps the instances for a projection computed in SQL:
+        'ids' gives pks, 'uids' gives uids and a list of field names gives
+        one dict per feature (foreign keys as ids, as with .values()).
+        Geometry columns are then never loaded unless asked for.
         """
         feature_set = []
 
@@ -722,78 +772,210 @@ class FeatureCollection(Feature):
         if issubclass(feature_classes.__class__, Feature):
             feature_classes = [feature_classes]
 
-        for model_class in self.get_options().get_valid_children():
-            if recurse and issubclass(model_class, FeatureCollection):
-                collections = model_class.objects.filter(
-                    content_type=ContentType.objects.get_for_model(self),
-                    object_id=self.pk
-                )
-                for collection in collections:
-                    feature_list = collection.feature_set(recurse, feature_classes)
-                    if len(feature_list) > 0:
-                        feature_set.extend(feature_list)
+        if recurse:
+            return self._feature_set_tree(feature_classes, values)
 
+        ct = ContentType.objects.get_for_model(self)
+        for model_class in self.get_options().get_valid_children():
             if feature_classes and model_class not in feature_classes:
                 continue
 
-            feature_list = list(
-                model_class.objects.filter(
-                    content_type=ContentType.objects.get_for_model(self),
-                    object_id=self.pk
-                )
+            queryset = model_class.objects.filter(
+                content_type=ct,
+                object_id=self.pk
             )
+            if values is None:
+                feature_list = list(queryset)
+            else:
+                feature_list = [project(model_class, row, values) for row in
+                                queryset.values(*(['pk'] + projection_fields(values)))]
 
             if len(feature_list) > 0:
                 feature_set.extend(feature_list)
 
         return feature_set
 
+    def iter_feature_set(self, recurse=False, feature_classes=None, chunk_size=500):
+        """
+        Generator version of feature_set that keeps memory flat however big
+        the collection: children are streamed per feature class, in pk
+        order, ``chunk_size`` rows per query.
+
+        Feature classes come in the same order as in feature_set, but
+        each class is always in pk order, even when its Meta.ordering says
+        otherwise, so this only matches feature_set's order for classes
+        without one. With recurse the nested collections are loaded up
+        front (there are usually few), then everything is yielded class by
+        class rather than depth first.
+        """
+        if issubclass(feature_classes.__class__, Feature):
+            feature_classes = [feature_classes]
+
+        using = self._state.db or 'default'
+        if recurse:
+            models = descendant_models(self.__class__)
+            collection_models = [m for m in models if issubclass(m, FeatureCollection)]
+            parents = {self.__class__: [self.pk]}
+            for by_model in load_subtree(self, collection_models).values():
+                for model, collections in by_model.items():
+                    parents.setdefault(model, []).extend([c.pk for c in collections])
+        else:
+            models = self.get_options().get_valid_children()
+            parents = {self.__class__: [self.pk]}
+
+        for model in models:
+            if feature_classes and model not in feature_classes:
+                continue
+            queryset = children_queryset(model, parents, using)
+            for instance in iter_chunked(queryset, chunk_size):
+                yield instance
+
+    def _feature_set_tree(self, feature_classes=None, values=None):
+        """
+        feature_set(recurse=True): the whole tree is loaded up front by
+        load_subtree, then walked depth first in python so the result comes
+        out in the same order as a collection-by-collection recursion.
+        """
+        fields = None if values is None else projection_fields(values)
+        children = load_subtree(self, feature_classes, fields=fields)
+        feature_set = []
+        seen = set()
+
+        def walk(collection):
+            key = (ContentType.objects.get_for_model(collection).pk, collection.pk)
+            if key in seen:
+                return
+            seen.add(key)
+            nested = children.get(key, {})
+            for model_class in collection.get_options().get_valid_children():
+                feature_list = nested.get(model_class, [])
+                if issubclass(model_class, FeatureCollection):
+                    for child in feature_list:
+                        walk(child)
+                if feature_classes and model_class not in feature_classes:
+                    continue
+                if values is not None:
+                    feature_list = [project(model_class, item, values)
+                                    for item in feature_list]
+                feature_set.extend(feature_list)
+
+        walk(self)
+        return feature_set
+
     def copy(self, user=None):
         """
         Returns a copy of this feature collection, setting the user to the specified
-        owner. Recursively copies all children.
+        owner. Recursively copies all children, in bulk; see
+        features.bulk.copy_collection.
         """
-        original_feature_set = self.feature_set(recurse=False)
+        return copy_collection(self, user)
 
-        the_collection = self
+    def delete(self, *args, **kwargs):
+        """
+        Delete all features in the set, in bulk; see
+        features.bulk.delete_trees
+        """
+        delete_trees([self])
 
-        # Make an inventory of all many-to-many fields in the original feature
-        m2m = {}
-        for f in the_collection._meta.many_to_many:
-            m2m[f.name] = the_collection.__getattribute__(f.name).all()
+class SharingVisibility(models.Model):
+    """
+    Denormalized sharing index: one row per group a feature is visible to,
+    either through its own sharing_groups or inherited from a collection it
+    is nested in. Maintained by features.visibility when the
+    SHARING_VISIBILITY_INDEX setting is enabled.
+    """
+    group = models.ForeignKey(Group, related_name='+')
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
 
-        # makes a copy but relies on this strange implementation detail of
-        # setting the pk & id to null
-        the_collection.pk = None
-        the_collection.id = None
-        the_collection.save()
+    class Meta:
+        unique_together = (('group', 'content_type', 'object_id'),)
+        index_together = (('content_type', 'object_id'),)
 
-        the_collection.name = the_collection.name + " (copy)"
+    def __unicode__(self):
+        return u"%s_%s -> %s" % (self.content_type_id, self.object_id, self.group_id)
 
-        # Restore the many-to-many fields
-        for fname in m2m.keys():
-            for obj in m2m[fname]:
-                the_collection.__getattribute__(fname).add(obj)
 
-        # Reassign User
-        the_collection.user = user
+class CollectionClosure(models.Model):
+    """
+    Closure table over collection containment: one row for every
+    (collection, feature nested anywhere below it) pair, with ``depth`` 1
+    for direct children. Maintained by features.closure when the
+    COLLECTION_CLOSURE_TABLE setting is enabled.
+    """
+    ancestor_type = models.ForeignKey(ContentType, related_name='+')
+    ancestor_id = models.PositiveIntegerField()
+    descendant_type = models.ForeignKey(ContentType, related_name='+')
+    descendant_id = models.PositiveIntegerField()
+    depth = models.PositiveIntegerField()
 
-        # Clear everything else
-        the_collection.sharing_groups.clear()
-        the_collection.remove_from_collection()
-        the_collection.save()
+    class Meta:
+        unique_together = (('ancestor_type', 'ancestor_id',
+                            'descendant_type', 'descendant_id'),)
+        index_together = (('descendant_type', 'descendant_id'),)
 
-        for child in original_feature_set:
-            new_child = child.copy(user)
-            new_child.add_to_collection(the_collection)
+    def __unicode__(self):
+        return u"%s_%s > %s_%s (%d)" % (self.ancestor_type_id, self.ancestor_id,
+                self.descendant_type_id, self.descendant_id, self.depth)
 
-        the_collection.save()
-        return the_collection
 
-    def delete(self, *args, **kwargs):
-        """
-        Delete all features in the set
-        """
-        for feature in self.feature_set(recurse=False):
-            feature.delete()
-        super(FeatureCollection, self).delete(*args, **kwargs)
+class SharedGeometry(models.Model):
+    """
+    Links a copy of a copy-on-write feature class to the feature whose
+    geometry it borrows until it is first edited. Maintained by
+    features.copy_on_write.
+    """
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+    source_type = models.ForeignKey(ContentType, related_name='+')
+    source_id = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+        index_together = (('source_type', 'source_id'),)
+
+    def __unicode__(self):
+        return u"%s_%s -> %s_%s" % (self.content_type_id, self.object_id,
+                self.source_type_id, self.source_id)
+
+
+class CollectionAggregate(models.Model):
+    """
+    Cached summary of what a FeatureCollection contains: how many features
+    sit directly in it and at any depth below it, the bounding box of their
+    geometry_final and their total area and length (in the units of
+    GEOMETRY_DB_SRID). Maintained by features.aggregates.
+    """
+    content_type = models.ForeignKey(ContentType, related_name='+')
+    object_id = models.PositiveIntegerField()
+    direct_count = models.PositiveIntegerField(default=0)
+    recursive_count = models.PositiveIntegerField(default=0)
+    minx = models.FloatField(null=True, blank=True)
+    miny = models.FloatField(null=True, blank=True)
+    maxx = models.FloatField(null=True, blank=True)
+    maxy = models.FloatField(null=True, blank=True)
+    area = models.FloatField(default=0)
+    length = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    @property
+    def extent(self):
+        if self.minx is None:
+            return None
+        return (self.minx, self.miny, self.maxx, self.maxy)
+
+    def dict(self):
+        return {
+            'direct_count': self.direct_count,
+            'recursive_count': self.recursive_count,
+            'extent': self.extent,
+            'area': self.area,
+            'length': self.length,
+            'srid': settings.GEOMETRY_DB_SRID,
+        }
+
+    def __unicode__(self):
+        return u"%s_%s: %d features" % (self.content_type_id, self.object_id,
+                self.recursive_count)
@@ -2,20 +2,28 @@ import logging
 from django.template.defaultfilters import slugify
 from django.template import loader, TemplateDoesNotExist
 from features.forms import FeatureForm
-from django.core.urlresolvers import reverse
+from features.signals import collection_changed, sharing_changed, \
+    features_deleted
+from django.core.urlresolvers import reverse, get_script_prefix, get_urlconf
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.signals import post_save, class_prepared
+from django.db.models.signals import post_save, post_delete, class_prepared, m2m_changed
+from django.test.signals import setting_changed
+from django.utils.http import urlquote
 from django.dispatch import receiver
-from django.contrib.auth.models import Permission, Group
+from django.contrib.auth.models import Permission, Group, User, AnonymousUser
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
 from django.db.utils import DatabaseError
 import json
+import time
 from nursery.introspection.introspection import get_class
 import sys
 
 registered_models = []
 registered_model_options = {}
 registered_links = []
+registered_model_uids = {}
 logger = logging.getLogger('features')
 
 
@@ -55,9 +63,95 @@ def enable_sharing(group=None):
         # Set up specified group
         group.permissions.add(p)
         group.save()
+
+    sharing_cache.clear()
     return True
 
 
+class SharingCache(object):
+    """
+    Per-process cache of the rows sharing is configured with: the
+    can_share_features Permission and the groups named in
+    SHARING_TO_PUBLIC_GROUPS and SHARING_TO_STAFF_GROUPS.
+
+    These almost never change, so they are resolved once per process and
+    kept until the 'sharing-config' cache version moves on. clear() bumps
+    it, so enable_sharing() or saving or deleting a Permission or Group in
+    any process invalidates every process's copy: immediately in that
+    process, and in the others once SHARING_CACHE_CHECK_INTERVAL seconds
+    have passed since they last looked at the version. Lookups in between
+    never touch the cache backend. ``stats()`` reports hits and misses.
+    """
+    _unset = object()
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._checked = None
+        self._reset()
+
+    def _reset(self):
+        self._permission_id = self._unset
+        self._public_group_ids = self._unset
+        self._staff_group_ids = self._unset
+
+    def clear(self):
+        bump_cache_version('sharing-config')
+        self._reset()
+        self._version = None
+        self._checked = None
+
+    def _check_version(self):
+        now = time.time()
+        interval = getattr(settings, 'SHARING_CACHE_CHECK_INTERVAL', 5)
+        if self._checked is not None and now - self._checked < interval:
+            return
+        version = cache_version('sharing-config')
+        if version != self._version:
+            self._reset()
+            self._version = version
+        self._checked = now
+
+    def _get(self, attr, load):
+        self._check_version()
+        value = getattr(self, attr)
+        if value is self._unset:
+            self.misses += 1
+            value = load()
+            setattr(self, attr, value)
+        else:
+            self.hits += 1
+        return value
+
+    def permission_id(self):
+        """
+        Pk of the can_share_features Permission, or None if sharing has not
+        been enabled.
+        """
+        def load():
+            try:
+                return Permission.objects.get(codename='can_share_features').pk
+            except Permission.DoesNotExist:
+                return None
+        return self._get('_permission_id', load)
+
+    def public_group_ids(self):
+        return self._get('_public_group_ids', lambda: frozenset(
+            Group.objects.filter(name__in=settings.SHARING_TO_PUBLIC_GROUPS
+                ).values_list('pk', flat=True)))
+
+    def staff_group_ids(self):
+        return self._get('_staff_group_ids', lambda: frozenset(
+            Group.objects.filter(name__in=settings.SHARING_TO_STAFF_GROUPS
+                ).values_list('pk', flat=True)))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+sharing_cache = SharingCache()
+
+
 
 
 
@@ -161,6 +255,13 @@ not a string path." % (name,))
         Defaults to True.
         """
 
+        self.copy_on_write = getattr(self._options, 'copy_on_write', False)
+        """
+        Copies borrow the original's geometry until they are first edited,
+        instead of duplicating it. Querysets of such classes refuse spatial
+        queries. See features.copy_on_write. Defaults to False.
+        """
+
         # Add a copy method unless disabled
         if self.enable_copy:
             self.links.insert(0, edit('Copy',
@@ -171,14 +272,12 @@ not a string path." % (name,))
         confirm = "Are you sure you want to delete this feature and it's contents?"
 
         # Add a multi-share generic link
-        # TODO when the share_form view takes multiple instances
-        #  we can make sharing a generic link
-        #self.links.insert(0, edit('Share',
-        #    'features.views.share_form',
-        #    select='multiple single',
-        #    method='POST',
-        #    edits_original=True,
-        #))
+        self.links.insert(0, edit('Share',
+            'features.views.multi_share',
+            select='multiple single',
+            method='POST',
+            edits_original=True,
+        ))
 
         # Add a multi-delete generic link
         self.links.insert(0, edit('Delete',
@@ -313,6 +412,13 @@ not a string path." % (name,))
             raise Exception("%r has no link named %s" % (self._model, linkname))
 
     def get_valid_children(self):
+        index = frozen_registry()
+        if index is not None and self._model in index.valid_children:
+            return index.serve(list(index.valid_children[self._model]),
+                    self._get_valid_children)
+        return self._get_valid_children()
+
+    def _get_valid_children(self):
         if not self.valid_children:
             raise FeatureConfigurationError(
                 "%r is not a properly configured FeatureCollection" % (self._model))
@@ -344,6 +450,13 @@ not a string path." % (name,))
             Array (only valid child is MPA)
             Therefore, Folder is also a potential_parent of MPA
         """
+        index = frozen_registry()
+        if index is not None and self._model in index.potential_parents:
+            return index.serve(list(index.potential_parents[self._model]),
+                    self._get_potential_parents)
+        return self._get_potential_parents()
+
+    def _get_potential_parents(self):
         potential_parents = []
         direct_parents = []
         collection_models = get_collection_models()
@@ -383,19 +496,19 @@ features.forms.FeatureForm." % (self._model.__name__, )),
 
         return klass
 
-    def dict(self,user,is_owner):
+    def dict(self,user,is_owner,group_names=None):
         """
         Returns a json representation of this feature class configuration
-        that can be used to specify client behavior
+        that can be used to specify client behavior. ``group_names`` is
+        passed on to Link.can_user_view.
         """
-        placeholder = "%s_%d" % (self._model.model_uid(), 14)
         link_rels = {
             'id': self._model.model_uid(),
             'title': self.verbose_name,
             'link-relations': {
                 'self': {
-                    'uri-template': reverse("%s_resource" % (self.slug, ),
-                        args=[placeholder]).replace(placeholder, '{uid}'),
+                    'uri-template': uri_template("%s_resource" % (self.slug, ),
+                        uid='{uid}'),
                     'title': settings.TITLES['self'],
                 },
             }
@@ -404,21 +517,21 @@ features.forms.FeatureForm." % (self._model.__name__, )),
         if is_owner:
             lr = link_rels['link-relations']
             lr['create'] = {
-                    'uri-template': reverse("%s_create_form" % (self.slug, ))
+                    'uri-template': uri_template("%s_create_form" % (self.slug, ))
             }
 
             lr['edit'] = [
                     {'title': 'Edit',
-                      'uri-template': reverse("%s_update_form" % (self.slug, ),
-                        args=[placeholder]).replace(placeholder, '{uid}')
+                      'uri-template': uri_template("%s_update_form" % (self.slug, ),
+                        uid='{uid}')
                     },
                     {'title': 'Share',
-                      'uri-template': reverse("%s_share_form" % (self.slug, ),
-                        args=[placeholder]).replace(placeholder, '{uid}')
+                      'uri-template': uri_template("%s_share_form" % (self.slug, ),
+                        uid='{uid}')
                     }]
 
         for link in self.links:
-            if not link.generic and link.can_user_view(user, is_owner):
+            if not link.generic and link.can_user_view(user, is_owner, group_names):
                 if link.rel not in link_rels['link-relations'].keys():
                     if not (user.is_anonymous() and link.rel == 'edit'):
                         link_rels['link-relations'][link.rel] = []
@@ -428,12 +541,12 @@ features.forms.FeatureForm." % (self._model.__name__, )),
             link_rels['collection'] = {
                 'classes': [x.model_uid() for x in self.get_valid_children()],
                 'remove': {
-                    'uri-template': reverse("%s_remove_features" % (self.slug, ),
-                        kwargs={'collection_uid':14,'uids':'xx'}).replace('14', '{collection_uid}').replace('xx','{uid+}')
+                    'uri-template': uri_template("%s_remove_features" % (self.slug, ),
+                        collection_uid='{collection_uid}', uids='{uid+}')
                 },
                 'add': {
-                    'uri-template': reverse("%s_add_features" % (self.slug, ),
-                        kwargs={'collection_uid':14,'uids':'xx'}).replace('14', '{collection_uid}').replace('xx','{uid+}')
+                    'uri-template': uri_template("%s_add_features" % (self.slug, ),
+                        collection_uid='{collection_uid}', uids='{uid+}')
                 }
 
             }
@@ -446,27 +559,27 @@ features.forms.FeatureForm." % (self._model.__name__, )),
         """
         Returns the path to a form for creating new instances of this model
         """
-        return reverse('%s_create_form' % (self.slug, ))
+        return uri_template('%s_create_form' % (self.slug, ))
 
     def get_update_form(self, pk):
         """
         Given a primary key, returns the path to a form for updating a Feature
         Class
         """
-        return reverse('%s_update_form' % (self.slug, ), args=['%s_%d' % (self._model.model_uid(), pk)])
+        return url_for('%s_update_form' % (self.slug, ), uid='%s_%d' % (self._model.model_uid(), pk))
 
     def get_share_form(self, pk):
         """
         Given a primary key, returns path to a form for sharing a Feature inst
         """
-        return reverse('%s_share_form' % (self.slug, ), args=['%s_%d' % (self._model.model_uid(), pk)])
+        return url_for('%s_share_form' % (self.slug, ), uid='%s_%d' % (self._model.model_uid(), pk))
 
     def get_resource(self, pk):
         """
         Returns the primary url for a feature. This url supports GET, POST,
         and DELETE operations.
         """
-        return reverse('%s_resource' % (self.slug, ), args=['%s_%d' % (self._model.model_uid(), pk)])
+        return url_for('%s_resource' % (self.slug, ), uid='%s_%d' % (self._model.model_uid(), pk))
 
 class Link:
     def __init__(self, rel, title, view, method='GET', select='single',
@@ -613,13 +726,17 @@ self.title, ))
 with a valid view. View must take a second argument named instances.' % (
 self.title, ))
 
-    def can_user_view(self, user, is_owner):
+    def can_user_view(self, user, is_owner, group_names=None):
         """
         Returns True/False depending on whether user can view the link.
+        Pass the names of the user's groups as ``group_names`` to save
+        looking them up.
         """
         if self.limit_to_groups:
             # We rely on the auth Group model ensuring unique group names
-            user_groupnames = [x.name for x in user.groups.all()]
+            if group_names is None:
+                group_names = [x.name for x in user.groups.all()]
+            user_groupnames = group_names
             match = False
             for groupname in self.limit_to_groups:
                 if groupname in user_groupnames:
@@ -637,7 +754,7 @@ self.title, ))
     def url_name(self):
         """
         Links are registered with named-urls. This function will return
-        that name so that it can be used in calls to reverse().
+        that name so that it can be used in calls to reverse() or url_for().
         """
         return "%s-%s" % (self.parent_slug, self.slug)
 
@@ -661,7 +778,7 @@ self.title, ))
         if not isinstance(instances,tuple) and not isinstance(instances,list):
             instances = [instances]
         uids = ','.join([instance.uid for instance in instances])
-        return reverse(self.url_name, kwargs={'uids': uids})
+        return url_for(self.url_name, uids=uids)
 
     def __str__(self):
         return self.title
@@ -674,9 +791,7 @@ self.title, ))
             'rel': self.rel,
             'title': self.title,
             'select': self.select,
-            'uri-template': reverse(self.url_name,
-                kwargs={'uids': 'idplaceholder'}).replace(
-                    'idplaceholder', '{uid+}')
+            'uri-template': uri_template(self.url_name, uids='{uid+}')
         }
         if self.rel == 'edit':
             d['method'] = self.method
@@ -732,12 +847,204 @@ def register(model):
         for link in options.links:
             if link not in registered_links:
                 registered_links.append(link)
+        registered_model_uids[model_uid(model)] = model
+        thaw()
     return model
 
+_model_uids = {}
+
+def model_uid(model):
+    """
+    "<app_label>_<model>" of the model's ContentType, derived from _meta so
+    no ContentType has to be looked up.
+    """
+    try:
+        return _model_uids[model]
+    except KeyError:
+        opts = model._meta.concrete_model._meta
+        uid = "%s_%s" % (opts.app_label, opts.model_name)
+        _model_uids[model] = uid
+        return uid
+
+def content_type_id(model):
+    """
+    Pk of the model's ContentType. Served from ContentType's own
+    per-process cache, which is reset whenever the content types are
+    (e.g. on flush), so the ids never go stale.
+    """
+    return ContentType.objects.get_for_model(model).pk
+
+def get_model_by_content_type_id(ct_id):
+    """
+    The registered feature class with ContentType ``ct_id``.
+    """
+    model = ContentType.objects.get_for_id(ct_id).model_class()
+    if model is None or model not in registered_models:
+        raise Exception("No model with content type id == `%s`" % ct_id)
+    return model
+
+class FrozenRegistry(object):
+    """
+    The containment graph and model lists derived from the registered
+    feature classes: every collection's valid children (with their dotted
+    paths resolved), every class' potential parents and the collection and
+    feature model lists. They only change when a class is registered, so
+    they are computed once by freeze() and then served from tuples.
+
+    With the FEATURES_VERIFY_REGISTRY setting every lookup is also
+    recomputed and compared; meant for debugging only.
+    """
+    def __init__(self):
+        self.collection_models = tuple(_get_collection_models())
+        self.feature_models = tuple(_get_feature_models())
+        self.valid_children = {}
+        for model in self.collection_models:
+            self.valid_children[model] = tuple(model.get_options()._get_valid_children())
+        self.potential_parents = {}
+        for model in registered_models:
+            self.potential_parents[model] = tuple(
+                model.get_options()._get_potential_parents())
+
+    def serve(self, value, live):
+        if getattr(settings, 'FEATURES_VERIFY_REGISTRY', False):
+            expected = live()
+            if value != expected:
+                raise FeatureConfigurationError(
+                    "Frozen feature registry is stale: %r != %r" % (value, expected))
+        return value
+
+_frozen_registry = None
+_frozen_once = False
+_freezing = False
+
+def freeze():
+    """
+    Build the FrozenRegistry. Called once the app registry is ready; a
+    class registered afterwards thaws it and it is rebuilt on next use.
+    """
+    global _frozen_registry, _frozen_once, _freezing
+    _frozen_registry = None
+    _freezing = True
+    try:
+        index = FrozenRegistry()
+    finally:
+        _freezing = False
+    _frozen_registry = index
+    _frozen_once = True
+    return index
+
+def thaw():
+    global _frozen_registry
+    _frozen_registry = None
+    _workspace_documents.clear()
+    _uri_templates.clear()
+
+# Paths of the named feature urls with their arguments left as
+# placeholders, keyed by (urlconf, url name, sorted placeholders). They are
+# kept without the script prefix, which belongs to the current request.
+_uri_templates = {}
+
+def uri_template(url_name, **placeholders):
+    """
+    Path of the named url ``url_name`` with each keyword argument left as
+    the given placeholder text, e.g. uri_template('mpa_resource',
+    uid='{uid}') == '/features/mpa/{uid}/'. reverse() runs once per
+    urlconf, url name and set of placeholders; the result is kept until a
+    feature class is registered or ROOT_URLCONF changes.
+    """
+    key = (get_urlconf(), url_name, tuple(sorted(placeholders.items())))
+    # Quoted the way reverse() quotes it
+    prefix = urlquote(get_script_prefix())
+    try:
+        return prefix + _uri_templates[key]
+    except KeyError:
+        pass
+    names = sorted(placeholders)
+    markers = dict((name, 'uritemplate%d' % i) for i, name in enumerate(names))
+    path = reverse(url_name, kwargs=markers, prefix='/')[1:]
+    # Longest markers first so uritemplate1 can't clobber uritemplate10
+    for name in sorted(names, key=lambda n: -len(markers[n])):
+        path = path.replace(markers[name], placeholders[name])
+    _uri_templates[key] = path
+    return prefix + path
+
+def url_for(url_name, **kwargs):
+    """
+    Same as reverse(url_name, kwargs=kwargs), by substituting into the
+    url's uri_template instead of resolving the url again.
+    """
+    path = uri_template(url_name,
+        **dict((name, '{%s}' % name) for name in kwargs))
+    for name, value in kwargs.items():
+        path = path.replace('{%s}' % name, '%s' % value)
+    return path
+
+def frozen_registry():
+    """
+    The current FrozenRegistry, or None before freeze() (and while one is
+    being built), in which case everything is computed live.
+    """
+    if _frozen_registry is None and _frozen_once and not _freezing:
+        freeze()
+    return _frozen_registry
+
+def feature_class(klass):
+    """
+    The registered feature class behind ``klass``, which may be one of the
+    subclasses Django builds for querysets using defer() or only().
+    """
+    if getattr(klass, '_deferred', False):
+        return klass._meta.proxy_for_model
+    return klass
+
 def get_model_options(model_name):
     return registered_model_options[model_name]
 
+# Rendered workspace documents, keyed by workspace_role()
+_workspace_documents = {}
+
+def limit_to_group_names():
+    """
+    Every group name any registered link is limited to.
+    """
+    names = set()
+    for link in registered_links:
+        if link.limit_to_groups:
+            names.update(link.limit_to_groups)
+    return names
+
+def workspace_role(user, is_owner):
+    """
+    Everything about a user the workspace document depends on: whether it
+    is the owner's document, whether the user is anonymous or staff, and
+    which of the groups named in limit_to_groups they belong to.
+    """
+    anonymous = user.is_anonymous()
+    group_names = frozenset()
+    limit = limit_to_group_names()
+    if limit and not anonymous:
+        group_names = frozenset(user.groups.filter(name__in=limit).values_list(
+            'name', flat=True))
+    return (bool(is_owner), anonymous, bool(user.is_staff), group_names)
+
 def workspace_json(user, is_owner, models=None):
+    """
+    The workspace document for ``user``. The full document (``models``
+    unset) is rendered once per workspace_role and shared by every user
+    with that role until a feature class is registered.
+    """
+    role = workspace_role(user, is_owner)
+    if models:
+        return _workspace_json(user, is_owner, models, role[3])
+    # The document holds uri templates, so it depends on the urls too
+    key = role + (get_script_prefix(), get_urlconf())
+    document = _workspace_documents.get(key)
+    if document is None:
+        document = _workspace_json(user, is_owner, models, role[3])
+        _workspace_documents[key] = document
+    return document
+
+def _workspace_json(user, is_owner, models, group_names):
     workspace = {
         'feature-classes': [],
         'generic-links': []
@@ -745,20 +1052,22 @@ def workspace_json(user, is_owner, models=None):
     if not models:
         # Workspace doc gets ALL feature classes and registered links
         for model in registered_models:
-            workspace['feature-classes'].append(model.get_options().dict(user, is_owner))
+            workspace['feature-classes'].append(
+                model.get_options().dict(user, is_owner, group_names))
         for link in registered_links:
-            if link.generic and link.can_user_view(user, is_owner) \
+            if link.generic and link.can_user_view(user, is_owner, group_names) \
                     and not (user.is_anonymous() and link.rel == 'edit'):
                 workspace['generic-links'].append(link.dict(user, is_owner))
     else:
         # Workspace doc only reflects specified feature class models
         for model in models:
-            workspace['feature-classes'].append(model.get_options().dict(user, is_owner))
+            workspace['feature-classes'].append(
+                model.get_options().dict(user, is_owner, group_names))
         for link in registered_links:
             # See if the generic links are relavent to this list
             if link.generic and \
-               [i for i in args if i in link.models] and \
-               link.can_user_view(user, is_owner) and \
+               [i for i in models if i in link.models] and \
+               link.can_user_view(user, is_owner, group_names) and \
                not (user.is_anonymous() and link.rel == 'edit'):
                     workspace['generic-links'].append(link.dict(user, is_owner))
     return json.dumps(workspace, indent=2)
@@ -768,6 +1077,12 @@ def get_collection_models():
     Utility function returning models for
     registered and valid FeatureCollections
     """
+    index = frozen_registry()
+    if index is not None:
+        return index.serve(list(index.collection_models), _get_collection_models)
+    return _get_collection_models()
+
+def _get_collection_models():
     from features.models import FeatureCollection
     registered_collections = []
     for model in registered_models:
@@ -785,6 +1100,12 @@ def get_feature_models():
     Utility function returning models for
     registered and valid Features excluding Collections
     """
+    index = frozen_registry()
+    if index is not None:
+        return index.serve(list(index.feature_models), _get_feature_models)
+    return _get_feature_models()
+
+def _get_feature_models():
     from features.models import Feature, FeatureCollection
     registered_features = []
     for model in registered_models:
@@ -797,59 +1118,316 @@ def user_sharing_groups(user):
     Returns a list of groups that user is member of and
     and group must have sharing permissions
     """
-    try:
-        p = Permission.objects.get(codename='can_share_features')
-    except Permission.DoesNotExist:
-        return Permission.objects.none()
+    perm_id = sharing_cache.permission_id()
+    if perm_id is None:
+        return Group.objects.none()
 
-    groups = user.groups.filter(permissions=p).distinct()
+    groups = user.groups.filter(permissions=perm_id).distinct()
     return groups
 
-def groups_users_sharing_with(user, include_public=False):
+SHARING_GROUPS_CACHE_PREFIX = 'features:sharing-groups'
+SHARING_GROUPS_CACHE_TIMEOUT = getattr(settings, 'SHARING_GROUPS_CACHE_TIMEOUT', 60 * 60)
+
+def cache_version(name):
+    """
+    Current value of a named version counter kept in the Django cache.
+    Cache keys that embed it are invalidated together by bump_cache_version.
+    """
+    key = 'features:version:%s' % name
+    version = cache.get(key)
+    if version is None:
+        version = 1
+        cache.add(key, version, None)
+    return version
+
+def bump_cache_version(name):
+    key = 'features:version:%s' % name
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, cache_version(name) + 1, None)
+
+def _sharing_groups_key(user_pk, is_staff, generation=None):
+    if generation is None:
+        generation = cache_version('sharing-groups')
+    return '%s:%s:%s:%d' % (SHARING_GROUPS_CACHE_PREFIX, generation,
+                            user_pk or 'anon', bool(is_staff))
+
+def invalidate_sharing_groups(user_pks=None):
+    """
+    Drop the cached group sets of the given users, or of everybody
+    (including anonymous users) if no pks are given.
+    """
+    if user_pks is None:
+        bump_cache_version('sharing-groups')
+        return
+    generation = cache_version('sharing-groups')
+    keys = []
+    for pk in user_pks:
+        keys.append(_sharing_groups_key(pk, False, generation))
+        keys.append(_sharing_groups_key(pk, True, generation))
+    cache.delete_many(keys)
+
+def _resolve_sharing_group_ids(user, anonymous):
+    perm_id = sharing_cache.permission_id()
+    if perm_id is None:
+        print("ERROR: Feature sharing not enabled. Please run `manage.py enable_sharing`")
+        return []
+
+    public_ids = sharing_cache.public_group_ids()
+    staff_ids = sharing_cache.staff_group_ids()
+    if anonymous:
+        # public users get special treatment -
+        # ONLY get to see anything shared with a public group
+        groups = Group.objects.filter(pk__in=public_ids)
+    elif user.is_staff:
+        # Staff users get their groups, plus 'shared_to_staff_groups', plus public groups
+        groups = Group.objects.filter(
+                    Q(user=user) | Q(pk__in=public_ids | staff_ids))
+    else:
+        # Non-staff authenticated users get their groups plus public groups, MINUS shared_to_staff groups
+        groups = Group.objects.filter(
+                    Q(user=user) | Q(pk__in=public_ids)
+                ).exclude(pk__in=staff_ids)
+
+    return sorted(set(groups.filter(permissions=perm_id).values_list('pk', flat=True)))
+
+def sharing_group_ids(user):
+    """
+    Returns the sorted pks of the groups whose shares are visible to user,
+    restricted to groups holding the can_share_features permission.
+
+    The result is cached per user and staff flag (and once for all anonymous
+    users) until group membership, group permissions or the groups
+    themselves change.
+    """
+    anonymous = user.is_anonymous() or not user.is_authenticated()
+    if anonymous:
+        key = _sharing_groups_key(None, False)
+    else:
+        key = _sharing_groups_key(user.pk, user.is_staff)
+    group_ids = cache.get(key)
+    if group_ids is None:
+        group_ids = _resolve_sharing_group_ids(user, anonymous)
+        cache.set(key, group_ids, SHARING_GROUPS_CACHE_TIMEOUT)
+    return group_ids
+
+@receiver(m2m_changed, sender=User.groups.through)
+def _user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_sharing_groups([instance.pk])
+    elif pk_set:
+        invalidate_sharing_groups(pk_set)
+    else:
+        # group.user_set.clear(); we no longer know who was in it
+        invalidate_sharing_groups()
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def _group_permissions_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_sharing_groups()
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def _group_changed(sender, **kwargs):
+    # Renames can move a group in or out of the public/staff sharing groups
+    sharing_cache.clear()
+    invalidate_sharing_groups()
+
+def _sharing_changed(sender, action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        bump_cache_version('sharing')
+
+@receiver(features_deleted)
+def _features_deleted(sender, **kwargs):
+    bump_cache_version('sharing')
+
+@receiver(collection_changed)
+def _collection_changed(sender, **kwargs):
+    bump_cache_version('sharing')
+
+def _publicly_visible(instance):
+    return instance is not None and instance.__class__.objects.shared_with_user(
+        AnonymousUser()).filter(pk=instance.pk).exists()
+
+def _public_sharing_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Bump the 'public' cache version, which keys the depth of the publicly
+    visible tree, when a share touches one of the public groups.
+    """
+    public_ids = sharing_cache.public_group_ids()
+    if reverse:
+        # Changed from the Group side
+        changed = action.startswith('post_') and instance.pk in public_ids
+    elif action == 'pre_clear':
+        instance._public_pre_clear = instance.sharing_groups.filter(
+            pk__in=public_ids).exists()
+        changed = False
+    elif action == 'post_clear':
+        changed = getattr(instance, '_public_pre_clear', True)
+    else:
+        changed = action.startswith('post_') and bool(public_ids & set(pk_set or ()))
+    if changed:
+        bump_cache_version('public')
+
+@receiver(sharing_changed)
+def _shares_changed(sender, added, removed, **kwargs):
+    bump_cache_version('sharing')
+    if sharing_cache.public_group_ids() & (set(added) | set(removed)):
+        bump_cache_version('public')
+
+def _public_feature_saved(sender, instance, created, **kwargs):
+    if created and instance.object_id is not None and \
+            _publicly_visible(instance.collection):
+        bump_cache_version('public')
+
+@receiver(collection_changed)
+def _public_collection_changed(sender, instances, collection, previous, **kwargs):
+    if any(_publicly_visible(c) for c in [collection] + list(previous)):
+        bump_cache_version('public')
+
+def connect_signals():
+    """
+    Keep the 'sharing' and 'public' cache versions current for every
+    registered feature class; called once the app registry is ready.
+    """
+    for model in registered_models:
+        uid = 'features.registry.%s' % model.__name__
+        m2m_changed.connect(_sharing_changed,
+                sender=model._meta.get_field('sharing_groups').rel.through,
+                dispatch_uid=uid)
+        post_delete.connect(_sharing_changed, sender=model, dispatch_uid=uid)
+        m2m_changed.connect(_public_sharing_changed,
+                sender=model._meta.get_field('sharing_groups').rel.through,
+                dispatch_uid=uid + '.public')
+        post_save.connect(_public_feature_saved, sender=model,
+                dispatch_uid=uid + '.public')
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def _permission_changed(sender, instance, **kwargs):
+    if instance.codename == 'can_share_features':
+        sharing_cache.clear()
+        invalidate_sharing_groups()
+
+@receiver(setting_changed)
+def _urlconf_changed(setting, **kwargs):
+    if setting == 'ROOT_URLCONF':
+        _uri_templates.clear()
+        _workspace_documents.clear()
+
+def groups_users_sharing_with(user, include_public=False, use_cache=False):
     """
     Get a dict of groups and users that are currently sharing items with a given user
     If spatial_only is True, only models which inherit from the Feature class will be reflected here
     returns something like {'our_group': {'group': <Group our_group>, 'users': [<user1>, <user2>,...]}, ... }
+
+    Each feature class costs a single query returning distinct
+    (group, owner) pairs. With use_cache, the result is cached until the
+    user's sharing groups or any share change.
     """
-    groups_sharing = {}
+    public_ids = sharing_cache.public_group_ids()
+    staff_ids = sharing_cache.staff_group_ids()
+    groups = {}
+    for group in user.groups.all():
+        # Unless overridden, public shares don't show up here
+        if group.pk in public_ids and not include_public:
+            continue
+        # User has to be staff to see these
+        if group.pk in staff_ids and not user.is_staff:
+            continue
+        groups[group.pk] = group
+    if not groups:
+        return None
+
+    if use_cache:
+        key = 'features:sharing-with:%s:%s:%d:%s' % (user.pk,
+                ','.join([str(pk) for pk in sharing_group_ids(user)]),
+                bool(include_public), cache_version('sharing'))
+        groups_sharing = cache.get(key)
+        if groups_sharing is None:
+            groups_sharing = _groups_users_sharing_with(user, groups)
+            cache.set(key, groups_sharing, SHARING_GROUPS_CACHE_TIMEOUT)
+        return groups_sharing or None
 
+    return _groups_users_sharing_with(user, groups) or None
+
+def _groups_users_sharing_with(user, groups):
+    pairs = set()
     for model_class in registered_models:
-        shared_objects = model_class.objects.shared_with_user(user)
-        for group in user.groups.all():
-            # Unless overridden, public shares don't show up here
-            if group.name in settings.SHARING_TO_PUBLIC_GROUPS and not include_public:
-                continue
-            # User has to be staff to see these
-            if group.name in settings.SHARING_TO_STAFF_GROUPS and not user.is_staff:
-                continue
-            group_objects = shared_objects.filter(sharing_groups=group)
-
-            user_list = []
-            for gobj in group_objects:
-                if gobj.user not in user_list and gobj.user != user:
-                    user_list.append(gobj.user)
-
-            if len(user_list) > 0:
-                if group.name in groups_sharing.keys():
-                    for user in user_list:
-                        if user not in groups_sharing[group.name]['users']:
-                            groups_sharing[group.name]['users'].append(user)
-                else:
-                    groups_sharing[group.name] = {'group':group, 'users': user_list}
-    if len(groups_sharing.keys()) > 0:
-        return groups_sharing
-    else:
-        return None
+        rows = model_class.objects.shared_with_user(user).filter(
+                sharing_groups__in=list(groups)).exclude(user=user).values_list(
+                'sharing_groups', 'user').distinct()
+        # Keep to the user's groups; a shared_with_user join on
+        # sharing_groups may be the one reused for the values() column
+        pairs.update([(gid, uid) for gid, uid in rows if gid in groups])
+
+    users = User.objects.in_bulk(set([uid for gid, uid in pairs]))
+    groups_sharing = {}
+    for gid, uid in sorted(pairs):
+        group = groups[gid]
+        entry = groups_sharing.setdefault(group.name, {'group': group, 'users': []})
+        entry['users'].append(users[uid])
+    return groups_sharing
 
 def get_model_by_uid(muid):
-    for model in registered_models:
-        if model.model_uid() == muid:
-            return model
-    raise Exception("No model with model_uid == `%s`" % muid)
+    try:
+        return registered_model_uids[muid]
+    except KeyError:
+        raise Exception("No model with model_uid == `%s`" % muid)
 
 def get_feature_by_uid(uid):
-    applabel, modelname, id = uid.split('_')
-    id = int(id)
-    model = get_model_by_uid("%s_%s" % (applabel,modelname))
+    muid, id = uid.rsplit('_', 1)
+    model = get_model_by_uid(muid)
     instance = model.objects.get(pk=int(id))
     return instance
+
+def parse_uid(uid):
+    """
+    Splits a feature uid into its model uid and pk. Raises ValueError if
+    it is malformed.
+    """
+    muid, id = uid.rsplit('_', 1)
+    return muid, int(id)
+
+def get_features_by_uids(uids, select_related=None, defer=None):
+    """
+    Fetch the features behind ``uids`` with one query per feature class
+    (per 500 uids), optionally with select_related() and defer() applied.
+    Deferred instances are of Django's deferred subclasses; feature_class()
+    maps them back to the registered class.
+
+    Returns an (instances, missing) pair: the instances found, in the order
+    of ``uids``, and the uids that matched no instance or no registered
+    feature class. Raises ValueError for a malformed uid.
+    """
+    parsed = [(uid,) + parse_uid(uid) for uid in uids]
+    by_model = {}
+    for uid, muid, pk in parsed:
+        by_model.setdefault(muid, set()).add(pk)
+
+    found = {}
+    for muid, pks in by_model.items():
+        model = registered_model_uids.get(muid)
+        if model is None:
+            continue
+        queryset = model.objects.all()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if defer:
+            queryset = queryset.defer(*defer)
+        pks = sorted(pks)
+        for i in range(0, len(pks), 500):
+            for instance in queryset.filter(pk__in=pks[i:i + 500]):
+                found[(muid, instance.pk)] = instance
+
+    instances = []
+    missing = []
+    for uid, muid, pk in parsed:
+        if (muid, pk) in found:
+            instances.append(found[(muid, pk)])
+        else:
+            missing.append(uid)
+    return instances, missing
@@ -0,0 +1,21 @@
+"""
+Signals sent by the features app.
+
+These cover changes that don't go through a plain save()/delete() of a single
+instance, so caches and denormalized tables can keep up with them.
+"""
+from django.dispatch import Signal
+
+# Sent after instances of ``sender`` have been moved into ``collection``
+# (or out of any collection, when ``collection`` is None). ``previous`` lists
+# the distinct collections they were removed from.
+collection_changed = Signal(providing_args=['instances', 'collection', 'previous'])
+
+# Sent after the sharing_groups of ``instances`` (all of class ``sender``)
+# were rewritten in bulk, bypassing m2m_changed. ``added`` and ``removed`` are
+# the sets of group ids that gained or lost at least one of the instances.
+sharing_changed = Signal(providing_args=['instances', 'added', 'removed'])
+
+# Sent after instances of ``sender`` with the given ``pks`` were deleted in
+# bulk, bypassing pre_delete/post_delete.
+features_deleted = Signal(providing_args=['pks'])
@@ -0,0 +1,142 @@
+"""
+Coalesced date_modified updates for collections.
+
+A collection's date_modified feeds Feature.hash, and with it report
+caching, so it has to move whenever the contents change. Rather than
+save() the collection after every change, callers ``touch`` it. Inside a
+``coalesced_touches`` block the touches are only recorded, and each
+collection gets a single UPDATE just before the block commits, however
+often it was touched. Outside of one, ``touch`` writes straight away.
+
+With the TOUCH_COLLECTION_ANCESTORS setting, every collection above a
+touched one is bumped too.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from features.registry import content_type_id, get_model_by_content_type_id
+
+_local = threading.local()
+
+# Keeps ``__in`` lists under SQLite's bind variable limit
+CHUNK_SIZE = 500
+
+
+def include_ancestors():
+    return getattr(settings, 'TOUCH_COLLECTION_ANCESTORS', False)
+
+
+def _chunks(items):
+    items = sorted(items)
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+def touch(*collections):
+    """
+    Bump the date_modified of ``collections`` (None entries are skipped),
+    now or when the enclosing coalesced_touches block commits.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = {}
+        _record(pending, collections)
+        with transaction.atomic():
+            flush(pending)
+    else:
+        _record(pending, collections)
+
+
+def _record(pending, collections):
+    for collection in collections:
+        if collection is not None:
+            key = (content_type_id(collection.__class__), collection.pk)
+            pending.setdefault(key, []).append(collection)
+
+
+@contextmanager
+def coalesced_touches():
+    """
+    Run the block in a transaction and defer every touch made in it to a
+    single UPDATE per collection model at the end. Nested blocks join the
+    outermost one; nothing is written if the block raises.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+    _local.pending = {}
+    try:
+        with transaction.atomic():
+            yield
+            pending, _local.pending = _local.pending, None
+            flush(pending)
+    finally:
+        _local.pending = None
+
+
+def ancestor_keys(keys):
+    """
+    (content type id, pk) of every collection above any of ``keys``.
+    Costs one query per collection model and level, or one per model with
+    the closure table.
+    """
+    from features import closure
+    from features.models import CollectionClosure
+
+    by_ct = {}
+    for ct_id, pk in keys:
+        by_ct.setdefault(ct_id, set()).add(pk)
+    found = set()
+    if closure.is_enabled():
+        for ct_id, pks in by_ct.items():
+            for batch in _chunks(pks):
+                found.update(CollectionClosure.objects.filter(
+                    descendant_type=ct_id, descendant_id__in=batch,
+                ).values_list('ancestor_type_id', 'ancestor_id'))
+        return found
+
+    seen = set(keys)
+    while by_ct:
+        parents = set()
+        for ct_id, pks in by_ct.items():
+            model = get_model_by_content_type_id(ct_id)
+            for batch in _chunks(pks):
+                parents.update([(pct, poid) for pct, poid in
+                                model.objects.filter(pk__in=batch).values_list(
+                                    'content_type_id', 'object_id')
+                                if pct and poid])
+        # Already visited collections stop a containment cycle
+        parents -= seen
+        seen.update(parents)
+        found.update(parents)
+        by_ct = {}
+        for ct_id, pk in parents:
+            by_ct.setdefault(ct_id, set()).add(pk)
+    return found
+
+
+def flush(pending):
+    """
+    Write the touches recorded in ``pending``, a dict mapping (content type
+    id, pk) keys to the instances touched: one UPDATE per collection model.
+    """
+    if not pending:
+        return
+    keys = set(pending.keys())
+    if include_ancestors():
+        keys.update(ancestor_keys(keys))
+    now = timezone.now()
+    by_ct = {}
+    for ct_id, pk in keys:
+        by_ct.setdefault(ct_id, set()).add(pk)
+    for ct_id, pks in by_ct.items():
+        model = get_model_by_content_type_id(ct_id)
+        for batch in _chunks(pks):
+            model.objects.filter(pk__in=batch).update(date_modified=now)
+    for instances in pending.values():
+        for instance in instances:
+            instance.date_modified = now
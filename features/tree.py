@@ -0,0 +1,347 @@
+"""
+SQL helpers for walking FeatureCollection hierarchies.
+
+Containment is only stored as the generic ``content_type``/``object_id``
+pointer on each child, so "everything below these collections" is a graph
+walk. On backends with recursive common table expressions the whole walk is
+pushed into a single statement; callers keep their python implementation as
+the fallback for everything else.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models.sql.where import AND
+
+CTE_VENDORS = ('sqlite', 'postgresql')
+
+
+def supports_recursive_cte(using='default'):
+    """
+    True if the database behind ``using`` can run WITH RECURSIVE queries
+    (SpatiaLite/SQLite >= 3.8.3 and PostGIS) and the USE_RECURSIVE_CTE
+    setting has not switched the feature off.
+    """
+    if not getattr(settings, 'USE_RECURSIVE_CTE', True):
+        return False
+    connection = connections[using]
+    if connection.vendor not in CTE_VENDORS:
+        return False
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 8, 3)
+    return True
+
+
+def quote(connection, *names):
+    """
+    Quote and dot-join a table/column reference.
+    """
+    return '.'.join([connection.ops.quote_name(n) for n in names])
+
+
+def edges_sql(collection_models, connection):
+    """
+    Returns a UNION ALL of ``(ct, oid, pct, poid)`` rows, one per instance of
+    each collection model: its own content type id and pk, followed by the
+    content type id and pk of the collection containing it.
+    """
+    selects = []
+    for model in collection_models:
+        opts = model._meta
+        ct = ContentType.objects.get_for_model(model)
+        selects.append(
+            "SELECT %d AS ct, %s AS oid, %s AS pct, %s AS poid FROM %s" % (
+                ct.pk,
+                quote(connection, opts.pk.column),
+                quote(connection, opts.get_field('content_type').column),
+                quote(connection, opts.get_field('object_id').column),
+                quote(connection, opts.db_table)))
+    return ' UNION ALL '.join(selects)
+
+
+def subtree_cte(anchor_sql, collection_models, connection):
+    """
+    Returns a WITH clause defining ``tree(ct, oid)``: the ``(ct, oid)`` rows
+    selected by ``anchor_sql`` plus every instance of ``collection_models``
+    nested (at any depth) below them. UNION rather than UNION ALL keeps the
+    walk finite even if the data contains a containment cycle.
+    """
+    anchor = "SELECT ct, oid FROM (%s) anchor" % anchor_sql
+    if not collection_models:
+        return "WITH tree(ct, oid) AS (%s) " % anchor
+    return ("WITH RECURSIVE edges(ct, oid, pct, poid) AS (%s), "
+            "tree(ct, oid) AS (%s UNION SELECT edges.ct, edges.oid FROM edges "
+            "INNER JOIN tree ON edges.pct = tree.ct AND edges.poid = tree.oid) "
+            % (edges_sql(collection_models, connection), anchor))
+
+
+def unrolled_subtree_sql(anchor_sql, collection_models, depth, connection):
+    """
+    Stand-in for subtree_cte on backends without recursive queries: a
+    SELECT of the ``(ct, oid)`` anchor rows plus every instance of
+    ``collection_models`` nested up to ``depth`` levels below them. Each
+    level joins the collection pointers against the level above, so the
+    statement grows with ``depth``, never with the number of rows.
+    """
+    level = "SELECT ct, oid FROM (%s) anchor" % anchor_sql
+    levels = [level]
+    edges = edges_sql(collection_models, connection)
+    for i in range(depth):
+        level = ("SELECT DISTINCT edges.ct, edges.oid FROM (%s) edges "
+                 "INNER JOIN (%s) parent "
+                 "ON edges.pct = parent.ct AND edges.poid = parent.oid" % (
+                     edges, level))
+        levels.append(level)
+    return ' UNION '.join(levels)
+
+
+def contained_pks_sql(model, anchor_sql, collection_models, connection,
+                      depth=None, parent_models=None):
+    """
+    Returns a self-contained SELECT of the pks of ``model`` instances whose
+    collection is one of the anchor rows or any collection nested below them.
+    Suitable for use inside ``<pk> IN (...)``.
+
+    The walk is a recursive CTE unless ``depth`` is given, in which case it
+    is unrolled to that many levels (see unrolled_subtree_sql). With
+    ``parent_models`` only instances contained directly in one of those
+    collection classes are selected.
+    """
+    opts = model._meta
+    if depth is None:
+        prefix, tree = subtree_cte(anchor_sql, collection_models, connection), 'tree'
+    else:
+        prefix, tree = '', '(%s) tree' % unrolled_subtree_sql(
+            anchor_sql, collection_models, depth, connection)
+    sql = ("%sSELECT %s FROM %s child INNER JOIN %s "
+           "ON %s = tree.ct AND %s = tree.oid" % (
+               prefix,
+               quote(connection, 'child', opts.pk.column),
+               quote(connection, opts.db_table),
+               tree,
+               quote(connection, 'child',
+                     opts.get_field('content_type').column),
+               quote(connection, 'child',
+                     opts.get_field('object_id').column)))
+    if parent_models:
+        sql += " WHERE tree.ct IN (%s)" % ', '.join([
+            str(ContentType.objects.get_for_model(m).pk)
+            for m in set(parent_models)])
+    return sql
+
+
+class PkInSubqueries(object):
+    """
+    WHERE node matching rows whose pk is selected by any of ``sqls``, each
+    a self-contained subquery. Unlike a table-qualified extra(where=...) it
+    follows the query's alias for the table, so the queryset can still be
+    nested in another query without turning into a correlated subquery.
+    """
+    def __init__(self, alias, column, sqls, params):
+        self.alias = alias
+        self.column = column
+        self.sqls = sqls
+        self.params = params
+
+    def as_sql(self, qn, connection):
+        ref = '%s.%s' % (qn(self.alias), connection.ops.quote_name(self.column))
+        return '(%s)' % ' OR '.join(['%s IN (%s)' % (ref, sql) for sql in self.sqls]), \
+            list(self.params)
+
+    def relabel_aliases(self, change_map):
+        self.alias = change_map.get(self.alias, self.alias)
+
+    def clone(self):
+        return self.__class__(self.alias, self.column, self.sqls, self.params)
+
+
+def filter_pk_in(queryset, sqls, params=()):
+    """
+    Restrict ``queryset`` to the rows whose pk is selected by any of the
+    subqueries ``sqls``; see PkInSubqueries.
+    """
+    queryset = queryset._clone()
+    query = queryset.query
+    query.where.add(PkInSubqueries(query.get_initial_alias(),
+            queryset.model._meta.pk.column, list(sqls), list(params)), AND)
+    return queryset
+
+
+def pointer_in_sql(model, collection_model, pks, connection):
+    """
+    Returns a WHERE fragment matching ``model`` instances contained directly
+    in the ``collection_model`` instances with the given pks. The integer pks
+    are inlined so large lists don't run into the backend's parameter limit.
+    """
+    opts = model._meta
+    return "(%s = %d AND %s IN (%s))" % (
+        quote(connection, opts.db_table, opts.get_field('content_type').column),
+        ContentType.objects.get_for_model(collection_model).pk,
+        quote(connection, opts.db_table, opts.get_field('object_id').column),
+        ', '.join([str(int(pk)) for pk in pks]))
+
+
+def descendant_models(model):
+    """
+    Every feature class that may be nested, at any depth, below instances
+    of the collection class ``model``; in discovery order.
+    """
+    from features.models import FeatureCollection
+    found = []
+    pending = [model]
+    while pending:
+        for child in pending.pop(0).get_options().get_valid_children():
+            if child not in found:
+                found.append(child)
+                if issubclass(child, FeatureCollection):
+                    pending.append(child)
+    return found
+
+
+def _ordered(queryset):
+    if queryset.model._meta.ordering:
+        return queryset
+    return queryset.order_by('pk')
+
+
+def load_subtree(root, feature_classes=None, use_closure=True, fields=None):
+    """
+    Loads everything nested below the collection ``root``, at any depth.
+
+    With the collection closure table enabled that is one query per feature
+    class below ``root``. Otherwise descendant collections are found with a
+    recursive CTE where the backend supports one, or else breadth first
+    with one query per collection class per level; leaf features are then
+    fetched with one query per class. Classes not in ``feature_classes``
+    (when given) are skipped. ``use_closure=False`` forces a walk over the
+    containment pointers.
+
+    Returns a dict mapping the (content type id, pk) of each collection in
+    the tree to a dict of {feature class: [direct children]}, each list in
+    pk order (or the class's Meta.ordering). Collections are always full
+    instances; with ``fields``, leaf features are instead dicts holding
+    only 'pk', 'content_type', 'object_id' and the named fields.
+    """
+    from features.models import FeatureCollection
+    using = root._state.db or 'default'
+    connection = connections[using]
+    models = descendant_models(root.__class__)
+    collection_models = [m for m in models if issubclass(m, FeatureCollection)]
+    leaf_models = [m for m in models if m not in collection_models and
+                   (not feature_classes or m in feature_classes)]
+
+    results = []
+    def fetch(model, queryset):
+        if fields is not None and model not in collection_models:
+            queryset = queryset.values(*(['pk', 'content_type', 'object_id'] +
+                                         [f for f in fields if f != 'pk']))
+        rows = list(_ordered(queryset))
+        results.append((model, rows))
+        return rows
+
+    from features import closure
+    if use_closure and closure.is_enabled():
+        for model in collection_models + leaf_models:
+            fetch(model, model.objects.using(using).filter(
+                pk__in=closure.descendant_pks(root, model)))
+    elif supports_recursive_cte(using):
+        anchor = "SELECT %d AS ct, %d AS oid" % (
+            ContentType.objects.get_for_model(root).pk, root.pk)
+        for model in collection_models + leaf_models:
+            opts = model._meta
+            fetch(model, model.objects.using(using).extra(where=[
+                "%s IN (%s)" % (quote(connection, opts.db_table, opts.pk.column),
+                    contained_pks_sql(model, anchor, collection_models, connection))]))
+    else:
+        collection_pks = dict((m, set()) for m in collection_models)
+        collection_pks.setdefault(root.__class__, set()).add(root.pk)
+        frontier = {root.__class__: set([root.pk])}
+        while frontier:
+            next_frontier = {}
+            for model in collection_models:
+                clauses = [pointer_in_sql(model, parent, pks, connection)
+                           for parent, pks in frontier.items()]
+                found = list(_ordered(model.objects.using(using).extra(
+                    where=[' OR '.join(clauses)])))
+                # Already loaded collections stop a containment cycle
+                found = [c for c in found if c.pk not in collection_pks[model]]
+                if found:
+                    results.append((model, found))
+                    collection_pks[model].update([c.pk for c in found])
+                    next_frontier[model] = set([c.pk for c in found])
+            frontier = next_frontier
+        for model in leaf_models:
+            clauses = [pointer_in_sql(model, parent, pks, connection)
+                       for parent, pks in collection_pks.items() if pks]
+            fetch(model, model.objects.using(using).extra(
+                where=[' OR '.join(clauses)]))
+
+    children = {}
+    for model, rows in results:
+        for row in rows:
+            if isinstance(row, dict):
+                key = (row['content_type'], row['object_id'])
+            else:
+                key = (row.content_type_id, row.object_id)
+            children.setdefault(key, {}).setdefault(model, []).append(row)
+    return children
+
+
+def project(model, item, values):
+    """
+    Apply a feature_set ``values`` projection to an instance, or to a dict
+    row from load_subtree(fields=...).
+    """
+    if isinstance(item, dict):
+        pk = item['pk']
+        get = item.get
+    else:
+        pk = item.pk
+        get = lambda name: getattr(item, model._meta.get_field(name).attname)
+    if values == 'ids':
+        return pk
+    if values == 'uids':
+        return "%s_%s" % (model.model_uid(), pk)
+    return dict((name, pk if name == 'pk' else get(name)) for name in values)
+
+
+def projection_fields(values):
+    """
+    The columns a feature_set ``values`` projection needs besides the pk.
+    """
+    if values in ('ids', 'uids'):
+        return []
+    return list(values)
+
+
+def iter_chunked(queryset, chunk_size=500):
+    """
+    Iterates over ``queryset`` in pk order, ``chunk_size`` rows per query,
+    using the last pk seen as the starting point of the next chunk. Only
+    one chunk is held in memory at a time. Any ordering on the queryset,
+    including the model's Meta.ordering, is replaced by pk order.
+    """
+    last = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        count = 0
+        for instance in chunk[:chunk_size].iterator():
+            count += 1
+            last = instance.pk
+            yield instance
+        if count < chunk_size:
+            return
+
+
+def children_queryset(model, parents, using='default'):
+    """
+    A queryset of the ``model`` instances contained directly in any of
+    ``parents``, a dict mapping collection classes to lists of pks.
+    """
+    connection = connections[using]
+    clauses = [pointer_in_sql(model, parent, pks, connection)
+               for parent, pks in parents.items() if pks]
+    if not clauses:
+        return model.objects.using(using).none()
+    return model.objects.using(using).extra(where=[' OR '.join(clauses)])
@@ -43,6 +43,10 @@ for model in registered_models:
         url(r'^%s/(?P<uid>[\w_]+)/share/$' % (options.slug, ), 
             'share_form', kwargs={'model': model}, 
             name='%s_share_form' % (options.slug,)),
+
+        url(r'^%s/shared.json$' % (options.slug, ),
+            'shared_json', kwargs={'model': model},
+            name='%s_shared_json' % (options.slug,)),
     )
 
 for model in get_collection_models():
@@ -1,7 +1,9 @@
 from features.registry import registered_models
 from features.models import FeatureCollection, SpatialFeature, Feature
 from features.registry import user_sharing_groups
-from features.registry import workspace_json, get_feature_by_uid
+from features.registry import workspace_json, get_features_by_uids, parse_uid, \
+    feature_class
+from features.bulk import share_features, delete_features, move_features
 import json
 import logging
 
@@ -10,7 +12,8 @@ from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.gdal import DataSource
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseForbidden, \
+    HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext, Context
 from django.template import loader, TemplateDoesNotExist
@@ -45,24 +48,10 @@ def get_object_for_editing(request, uid, target_klass=None):
         return instance
 
     """
-    if target_klass and not target_klass.model_uid() in uid:
-        return HttpResponse("Target class %s doesn't match the provided uid %s" % 
-                            (target_klass, uid),
-                            status=401)
-    try:
-        instance = get_feature_by_uid(uid)
-    except ValueError:
-        return HttpResponse("Uid not valid: %s" % uid, status=401)
-    except:
-        return HttpResponse("Feature not found - %s" % uid, status=404)
-
-    if not request.user.is_authenticated():
-        return HttpResponse('You must be logged in.', status=401)
-    # Check that user owns the object or is staff
-    if not request.user.is_staff and request.user != instance.user:
-        return HttpResponseForbidden(
-            'You do not have permission to modify this object.')
-    return instance
+    instances = get_objects_for_editing(request, [uid], target_klass)
+    if isinstance(instances, HttpResponse):
+        return instances
+    return instances[0]
 
 def get_object_for_viewing(request, uid, target_klass=None):
     """
@@ -80,22 +69,76 @@ def get_object_for_viewing(request, uid, target_klass=None):
         return instance
 
     """
-    if target_klass and not target_klass.model_uid() in uid:
-        return HttpResponse("Target class %s doesn't match the provided uid %s" % 
-                            (target_klass, uid),
-                            status=401)
-    try:
-        instance = get_feature_by_uid(uid)
-    except ValueError:
-        return HttpResponse("Uid not valid: %s" % uid, status=401)
-    except:
-        return HttpResponse("Feature not found - %s" % uid, status=404)
+    instances = get_objects_for_viewing(request, [uid], target_klass)
+    if isinstance(instances, HttpResponse):
+        return instances
+    return instances[0]
 
-    viewable, response = instance.is_viewable(request.user) 
-    if viewable:
-        return instance
-    else:
-        return response
+def _load_features(uids, target_klass=None):
+    """
+    Fetch the features behind ``uids`` with one query per feature class.
+    Returns a list holding, in the order of ``uids``, either the instance or
+    the error response get_object_for_viewing/editing give for that uid.
+    """
+    valid = []
+    for uid in uids:
+        try:
+            parse_uid(uid)
+            valid.append(uid)
+        except ValueError:
+            pass
+    instances, missing = get_features_by_uids(valid)
+    missing = set(missing)
+    found = dict(zip([uid for uid in valid if uid not in missing], instances))
+
+    results = []
+    for uid in uids:
+        if target_klass and not target_klass.model_uid() in uid:
+            results.append(HttpResponse(
+                "Target class %s doesn't match the provided uid %s" %
+                (target_klass, uid), status=401))
+        elif uid in found:
+            results.append(found[uid])
+        elif uid in missing:
+            results.append(HttpResponse("Feature not found - %s" % uid, status=404))
+        else:
+            results.append(HttpResponse("Uid not valid: %s" % uid, status=401))
+    return results
+
+def get_objects_for_editing(request, uids, target_klass=None):
+    """
+    Batch version of get_object_for_editing: returns the instances behind
+    ``uids``, in order, or the response get_object_for_editing would have
+    given for the first uid that fails.
+    """
+    instances = _load_features(uids, target_klass)
+    for instance in instances:
+        if isinstance(instance, HttpResponse):
+            return instance
+        if not request.user.is_authenticated():
+            return HttpResponse('You must be logged in.', status=401)
+        # Check that user owns the object or is staff
+        if not request.user.is_staff and request.user.pk != instance.user_id:
+            return HttpResponseForbidden(
+                'You do not have permission to modify this object.')
+    return instances
+
+def get_objects_for_viewing(request, uids, target_klass=None):
+    """
+    Batch version of get_object_for_viewing: returns the instances behind
+    ``uids``, in order, or the response get_object_for_viewing would have
+    given for the first uid that fails. Permissions cost one query per
+    feature class.
+    """
+    instances = _load_features(uids, target_klass)
+    viewable = set([(i.__class__, i.pk) for i in Feature.viewable_mask(request.user,
+            [i for i in instances if not isinstance(i, HttpResponse)])])
+    for instance in instances:
+        if isinstance(instance, HttpResponse):
+            return instance
+        if (instance.__class__, instance.pk) not in viewable:
+            return instance.is_viewable(request.user)[1]
+    return instances
 
 # RESTful Generic Views
 
@@ -133,31 +176,27 @@ def handle_link(request, uids, link=None):
         return HttpResponse(
             'Not Supported Error: Requested %s for single instance' % (
             link.title, ), status=400)
-    instances = []
-    for uid in uids:
-        if link.rel == 'edit':
-            if link.method.lower() == 'post' and request.method == 'GET':
-                resp = HttpResponse('Invalid Method', status=405)
-                resp['Allow'] = 'POST'
-                return resp
-            if link.edits_original is False:
-                # users who can view the object can then make copies
-                inst = get_object_for_viewing(request, uid)
-            else:
-                inst = get_object_for_editing(request, uid)
+    if link.rel == 'edit':
+        if link.method.lower() == 'post' and request.method == 'GET':
+            resp = HttpResponse('Invalid Method', status=405)
+            resp['Allow'] = 'POST'
+            return resp
+        if link.edits_original is False:
+            # users who can view the object can then make copies
+            instances = get_objects_for_viewing(request, uids)
         else:
-            inst = get_object_for_viewing(request, uid)
+            instances = get_objects_for_editing(request, uids)
+    else:
+        instances = get_objects_for_viewing(request, uids)
 
-        if isinstance(inst, HttpResponse):
-            return inst
-        else:
-            instances.append(inst)
+    if isinstance(instances, HttpResponse):
+        return instances
     for instance in instances:
-        if link.generic and instance.__class__ not in link.models:
+        if link.generic and feature_class(instance.__class__) not in link.models:
             return HttpResponse(
                 'Not Supported Error: Requested for "%s" feature class. This \
 generic link only supports requests for feature classes %s' % (
-                instance.__class__.__name__, 
+                feature_class(instance.__class__).__name__, 
                 ', '.join([m.__name__ for m in link.models])), status=400)
 
     if link.select is 'single':
@@ -197,12 +236,8 @@ def multi_delete(request, instances):
     """ 
     Generic view to delete multiple instances 
     """
-    deleted = []
     if request.method == 'DELETE':
-        for instance in instances:
-            uid = instance.uid
-            instance.delete()
-            deleted.append(uid)
+        delete_features(instances)
         return HttpResponse('{"status": 200}')
     else:
         return HttpResponse('DELETE http method must be used to delete', 
@@ -604,10 +639,10 @@ def kml_core(request, instances, kmz):
         except AttributeError:
             pass
 
+    viewable = set(Feature.viewable_mask(user, instances))
     for instance in instances:
-        viewable, response = instance.is_viewable(user)
-        if not viewable:
-            return viewable, response
+        if instance not in viewable:
+            return instance.is_viewable(user)[1]
 
         if isinstance(instance, FeatureCollection):
             collections.append(instance)
@@ -685,7 +720,10 @@ def share_form(request,model=None, uid=None):
             'action': request.build_absolute_uri()}) 
 
     elif request.method == 'POST':
-        group_ids = [int(x) for x in request.POST.getlist('sharing_groups')]
+        try:
+            group_ids = [int(x) for x in request.POST.getlist('sharing_groups')]
+        except ValueError:
+            return HttpResponseBadRequest("Invalid sharing_groups parameter.")
         groups = Group.objects.filter(pk__in=group_ids)
 
         try:
@@ -704,30 +742,44 @@ def share_form(request,model=None, uid=None):
         return HttpResponse("Received unexpected " + request.method + 
                 " request.", status=400)
 
+def multi_share(request, instances):
+    """
+    Generic view to share multiple instances with the POSTed sharing_groups,
+    replacing whatever they were shared with before
+    """
+    if request.method != 'POST':
+        return HttpResponse('POST http method must be used to share',
+                status=405)
+
+    try:
+        group_ids = [int(x) for x in request.POST.getlist('sharing_groups')]
+    except ValueError:
+        return HttpResponseBadRequest("Invalid sharing_groups parameter.")
+    groups = Group.objects.filter(pk__in=group_ids)
+    try:
+        share_features(instances, groups)
+    except Exception as e:
+        return HttpResponse(
+                'Unable to share objects with those specified groups: %r.' % e,
+                status=500)
+    return to_response(status=200, select=instances)
+
 def manage_collection(request, action, uids, collection_model, collection_uid):
     config = collection_model.get_options()
     collection_instance = get_object_for_editing(request, collection_uid,
             target_klass=collection_model)
     if isinstance(collection_instance, HttpResponse):
-        return instance
+        return collection_instance
 
     if request.method == 'POST':
-        uids = uids.split(',')
-        instances = []
-        for uid in uids:
-            inst = get_object_for_editing(request, uid)
-
-            if isinstance(inst, HttpResponse):
-                return inst
-            else:
-                instances.append(inst)
+        instances = get_objects_for_editing(request, uids.split(','))
+        if isinstance(instances, HttpResponse):
+            return instances
 
         if action == 'remove':
-            for instance in instances:
-                instance.remove_from_collection()
+            move_features(instances, None)
         elif action == 'add':
-            for instance in instances:
-                instance.add_to_collection(collection_instance)
+            move_features(instances, collection_instance)
         else:
             return HttpResponse("Invalid action %s." % action, status=500)
 
@@ -739,7 +791,35 @@ def manage_collection(request, action, uids, collection_model, collection_uid):
     else:
         return HttpResponse("Invalid http method.", status=405)
 
-@cache_page(60 * 60)
+def shared_json(request, model):
+    """
+    Pages through the instances of ``model`` shared with the requesting
+    user. Pass the ``next`` value of one response as the ``after`` query
+    parameter of the next request; it is null on the last page.
+    """
+    if request.method != 'GET':
+        return HttpResponse("Invalid http method.", status=405)
+
+    max_page_size = getattr(settings, 'SHARED_JSON_MAX_PAGE_SIZE', 1000)
+    try:
+        page_size = min(int(request.GET.get('page_size', 100)), max_page_size)
+        assert page_size > 0
+        instances, next_cursor = model.objects.shared_with_user_page(
+            request.user, page_size, after=request.GET.get('after'))
+    except (ValueError, AssertionError):
+        return HttpResponse("Invalid page_size or after parameter.", status=400)
+
+    features = [{
+        'uid': instance.uid,
+        'name': instance.name,
+        'user': instance.user.username,
+        'date_modified': instance.date_modified.isoformat(),
+    } for instance in instances]
+    res = HttpResponse(json.dumps({'features': features, 'next': next_cursor}),
+                       status=200)
+    res['Content-Type'] = mimetypes.JSON
+    return res
+
 def workspace(request, username, is_owner):
     user = request.user
     if request.method == 'GET':
@@ -904,7 +984,10 @@ def geojson_link(request, instances):
             if issubclass(i.__class__, FeatureCollection):
                 if strategy == 'nest_feature_set':
                     # collections are treated as null geoms with 'feature_set' property
-                    props['feature_set'] = [x.uid for x in i.feature_set()]
+                    aggregates = i.aggregates
+                    if aggregates is not None:
+                        props['aggregates'] = aggregates
+                    props['feature_set'] = i.feature_set(values='uids')
                     gj = get_feature_json('null', json.dumps(props))
                 else:  # assume 'flat' strategy and recurse
                     feats = [f for f in i.feature_set(recurse=True) 
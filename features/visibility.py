@@ -0,0 +1,319 @@
+"""
+Materialized sharing visibility index.
+
+When the SHARING_VISIBILITY_INDEX setting is enabled, every feature that is
+shared with a group -- directly through its sharing_groups, or by being
+nested in a collection that is -- gets one SharingVisibility row per group.
+"What can this user see" then becomes an indexed lookup instead of a walk
+over groups, permissions and containers.
+
+The index is kept current by the receivers below. ``rebuild_index`` and
+``check_index`` back the ``rebuild_visibility_index`` management command.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from features.models import FeatureCollection, SharingVisibility, \
+    CollectionClosure
+from features.registry import registered_models
+from features.signals import collection_changed, sharing_changed, features_deleted
+
+
+def is_enabled():
+    return getattr(settings, 'SHARING_VISIBILITY_INDEX', False)
+
+
+def visible_pks(model, group_ids):
+    """
+    Returns a values queryset of the pks of ``model`` instances visible to
+    any of ``group_ids``; usable as a ``pk__in`` subquery.
+    """
+    return SharingVisibility.objects.filter(
+        content_type=ContentType.objects.get_for_model(model),
+        group__in=group_ids,
+    ).values('object_id')
+
+
+def inherited_group_ids(instance):
+    """
+    Group ids an instance is shared with through its ancestor collections.
+    """
+    from features import closure
+    if closure.is_enabled():
+        by_type = {}
+        for ct_id, pk in closure.ancestor_keys(instance):
+            by_type.setdefault(ct_id, []).append(pk)
+        group_ids = set()
+        for ct_id, pks in by_type.items():
+            field = ContentType.objects.get_for_id(ct_id).model_class(
+                )._meta.get_field('sharing_groups')
+            group_ids.update(field.rel.through.objects.filter(
+                **{'%s__in' % field.m2m_field_name(): pks}
+            ).values_list(field.m2m_reverse_field_name(), flat=True))
+        return group_ids
+
+    group_ids = set()
+    seen = set()
+    collection = instance.collection
+    while collection is not None and collection not in seen:
+        seen.add(collection)
+        group_ids.update(collection.sharing_groups.values_list('pk', flat=True))
+        collection = collection.collection
+    return group_ids
+
+
+def refresh(instance):
+    """
+    Recompute the index rows for an instance and, if it is a collection,
+    everything nested below it.
+    """
+    refresh_subtrees([instance])
+
+
+def _subtree_keys(roots):
+    """
+    Keys of ``roots`` and of everything nested below them, read from the
+    closure table when it is enabled and otherwise walked a level at a
+    time, with one query per feature class per level.
+    """
+    from features import closure
+    from features.bulk import chunks
+    from features.registry import get_model_by_content_type_id
+    from features.tree import children_queryset
+    keys = set(roots)
+    if closure.is_enabled():
+        by_type = {}
+        for ct_id, pk in roots:
+            by_type.setdefault(ct_id, []).append(pk)
+        for ct_id, pks in by_type.items():
+            for batch in chunks(pks):
+                keys.update(CollectionClosure.objects.filter(
+                    ancestor_type=ct_id, ancestor_id__in=batch,
+                ).values_list('descendant_type_id', 'descendant_id'))
+        return keys
+
+    frontier = set(roots)
+    while frontier:
+        parents = {}
+        for ct_id, pk in frontier:
+            model = get_model_by_content_type_id(ct_id)
+            if issubclass(model, FeatureCollection):
+                parents.setdefault(model, []).append(pk)
+        children = set()
+        for model in registered_models:
+            valid = dict((parent, pks) for parent, pks in parents.items()
+                         if model in parent.get_options().get_valid_children())
+            if valid:
+                ct_id = ContentType.objects.get_for_model(model).pk
+                children.update((ct_id, pk) for pk in children_queryset(
+                    model, valid).values_list('pk', flat=True))
+        frontier = children - keys
+        keys.update(frontier)
+    return keys
+
+
+def refresh_subtrees(instances):
+    """
+    Recompute the index rows of ``instances`` and of everything nested
+    below them, set-wise: the containment pointers and sharing_groups of
+    the whole subtree are read a chunk at a time per feature class, and
+    the rows are rewritten with one DELETE per group and class and one
+    bulk_create.
+    """
+    from features.bulk import chunks
+    from features.registry import get_model_by_content_type_id
+    instances = list(instances)
+    if not instances:
+        return
+    keys = _subtree_keys([_key(i) for i in instances])
+    by_type = {}
+    for ct_id, pk in keys:
+        by_type.setdefault(ct_id, []).append(pk)
+
+    parents = {}
+    direct = {}
+    existing = {}
+    for ct_id, pks in by_type.items():
+        model = get_model_by_content_type_id(ct_id)
+        field = model._meta.get_field('sharing_groups')
+        for batch in chunks(pks):
+            for pk, pct, poid in model.objects.filter(pk__in=batch).values_list(
+                    'pk', 'content_type_id', 'object_id'):
+                parents[(ct_id, pk)] = (pct, poid) if pct else None
+            for pk, gid in field.rel.through.objects.filter(
+                    **{'%s__in' % field.m2m_field_name(): batch}).values_list(
+                    field.m2m_field_name(), field.m2m_reverse_field_name()):
+                direct.setdefault((ct_id, pk), set()).add(gid)
+            for gid, pk in SharingVisibility.objects.filter(
+                    content_type=ct_id, object_id__in=batch).values_list(
+                    'group_id', 'object_id'):
+                existing.setdefault((ct_id, pk), set()).add(gid)
+
+    # Groups inherited from above the subtrees, once per outside parent
+    outside = {}
+    for instance in instances:
+        parent = parents.get(_key(instance))
+        if parent is not None and parent not in keys and parent not in outside:
+            collection = instance.collection
+            outside[parent] = inherited_group_ids(collection) | set(
+                collection.sharing_groups.values_list('pk', flat=True))
+
+    effective = {}
+    for key in parents:
+        chain = []
+        node = key
+        while node in keys and node not in effective and node not in chain:
+            chain.append(node)
+            node = parents.get(node)
+        group_ids = effective.get(node, outside.get(node, frozenset()))
+        for node in reversed(chain):
+            group_ids = group_ids | direct.get(node, frozenset())
+            effective[node] = group_ids
+
+    stale = {}
+    rows = []
+    for (ct_id, pk), group_ids in effective.items():
+        current = existing.get((ct_id, pk), set())
+        for gid in current - group_ids:
+            stale.setdefault((gid, ct_id), []).append(pk)
+        rows.extend([SharingVisibility(group_id=gid, content_type_id=ct_id, object_id=pk)
+                     for gid in group_ids - current])
+    for (gid, ct_id), pks in stale.items():
+        for batch in chunks(pks):
+            SharingVisibility.objects.filter(group=gid, content_type=ct_id,
+                                             object_id__in=batch).delete()
+    SharingVisibility.objects.bulk_create(rows)
+
+
+def _key(instance):
+    return ContentType.objects.get_for_model(instance).pk, instance.pk
+
+
+def expected_rows():
+    """
+    Computes the full index from scratch as a set of
+    (group_id, content_type_id, object_id) tuples. Only pks, containment
+    pointers and sharing_groups through rows are loaded.
+    """
+    direct = {}
+    parents = {}
+    for model in registered_models:
+        ct_id = ContentType.objects.get_for_model(model).pk
+        for pk, pct, poid in model.objects.values_list(
+                'pk', 'content_type_id', 'object_id'):
+            parents[(ct_id, pk)] = (pct, poid) if pct else None
+        field = model._meta.get_field('sharing_groups')
+        through = field.rel.through
+        for pk, gid in through.objects.values_list(
+                field.m2m_field_name(), field.m2m_reverse_field_name()):
+            direct.setdefault((ct_id, pk), set()).add(gid)
+
+    effective = {}
+    rows = set()
+    for key in parents:
+        # Walk up until we hit a resolved ancestor, then resolve downwards
+        chain = []
+        node = key
+        while node is not None and node not in effective and node not in chain:
+            chain.append(node)
+            node = parents.get(node)
+        group_ids = effective.get(node, frozenset())
+        for node in reversed(chain):
+            group_ids = group_ids | direct.get(node, frozenset())
+            effective[node] = group_ids
+        for gid in effective[key]:
+            rows.add((gid, key[0], key[1]))
+    return rows
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Replace the entire index. Returns the number of rows written.
+    """
+    rows = expected_rows()
+    with transaction.atomic():
+        SharingVisibility.objects.all()._raw_delete(SharingVisibility.objects.db)
+        SharingVisibility.objects.bulk_create([
+            SharingVisibility(group_id=gid, content_type_id=ct_id, object_id=oid)
+            for gid, ct_id, oid in rows], batch_size=batch_size)
+    return len(rows)
+
+
+def check_index():
+    """
+    Compare the index against a from-scratch computation.
+    Returns a (missing, stale) pair of row sets; both empty when consistent.
+    """
+    expected = expected_rows()
+    actual = set(SharingVisibility.objects.values_list(
+        'group_id', 'content_type_id', 'object_id'))
+    return expected - actual, actual - expected
+
+
+def sharing_groups_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not is_enabled():
+        return
+
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            refresh(instance)
+        return
+
+    # Changed from the Group side; instance is the group, model the feature class
+    if action == 'pre_clear':
+        instance._visibility_pre_clear = list(
+            model.objects.filter(sharing_groups=instance))
+    elif action == 'post_clear':
+        refresh_subtrees(getattr(instance, '_visibility_pre_clear', []))
+        instance._visibility_pre_clear = []
+    elif action in ('post_add', 'post_remove'):
+        refresh_subtrees(model.objects.filter(pk__in=pk_set))
+
+
+def feature_saved(sender, instance, created, **kwargs):
+    if created and is_enabled() and instance.object_id is not None:
+        refresh(instance)
+
+
+def feature_deleted(sender, instance, **kwargs):
+    if is_enabled():
+        SharingVisibility.objects.filter(
+            content_type=ContentType.objects.get_for_model(sender),
+            object_id=instance.pk).delete()
+
+
+@receiver(features_deleted)
+def features_removed(sender, pks, **kwargs):
+    if is_enabled():
+        SharingVisibility.objects.filter(
+            content_type=ContentType.objects.get_for_model(sender),
+            object_id__in=pks).delete()
+
+
+@receiver(collection_changed)
+def membership_changed(sender, instances, **kwargs):
+    if is_enabled():
+        refresh_subtrees(instances)
+
+
+@receiver(sharing_changed)
+def shares_changed(sender, instances, **kwargs):
+    if is_enabled():
+        refresh_subtrees(instances)
+
+
+def connect_signals():
+    """
+    Hook the index up to every registered feature class. Receivers are
+    connected per sender so unrelated models keep Django's fast-delete path.
+    """
+    for model in registered_models:
+        uid = 'features.visibility.%s' % model.__name__
+        post_save.connect(feature_saved, sender=model, dispatch_uid=uid)
+        post_delete.connect(feature_deleted, sender=model, dispatch_uid=uid)
+        m2m_changed.connect(sharing_groups_changed,
+                sender=model._meta.get_field('sharing_groups').rel.through,
+                dispatch_uid=uid)
@@ -3,7 +3,7 @@ from models import TestNoGeoJSON, TestMpa, TestForGeoJSON, \
     CreateTestFeature, UpdateFormTestFeature, Pipeline, LinkTestFeature, \
     RenewableEnergySite, UpdateTestFeature, GenericLinksTestFeature, \
     OtherGenericLinksTestFeature, Shipwreck, MockMultiPoly, TestFolder, \
-    TestArray
+    TestArray, SharedWreck
 
 from features.forms import FeatureForm
 
@@ -98,6 +98,11 @@ class ShipwreckForm(FeatureForm):
         model = Shipwreck
 
 
+class SharedWreckForm(FeatureForm):
+    class Meta:
+        model = SharedWreck
+
+
 class MockMultiPolyForm(FeatureForm):
     class Meta:
         model = MockMultiPoly
@@ -327,6 +327,14 @@ class Shipwreck(PointFeature):
         form = 'tests.forms.ShipwreckForm'
 
 
+@register
+class SharedWreck(PointFeature):
+    class Options:
+        verbose_name = 'Shipwreck (copy-on-write)'
+        form = 'tests.forms.SharedWreckForm'
+        copy_on_write = True
+
+
 @register
 class MockMultiPoly(MultiPolygonFeature):
     class Options:
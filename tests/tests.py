@@ -2,7 +2,7 @@ from django.test import TestCase
 
 from features.registry import register, alternate, edit, edit_form, related, \
     workspace_json, FeatureConfigurationError, enable_sharing, Link, \
-    user_sharing_groups, groups_users_sharing_with
+    user_sharing_groups, groups_users_sharing_with, cache_version
 from features.models import Feature, PointFeature, LineFeature, PolygonFeature, \
     FeatureCollection, MultiPolygonFeature
 from features.forms import FeatureForm
@@ -13,7 +13,10 @@ import os
 import shutil
 import json
 from django.test.client import Client
+from django.test.utils import override_settings
 from django.contrib.auth.models import *
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
 from forms import TestFeatureForm
 
 from django.core.urlresolvers import reverse
@@ -30,7 +33,7 @@ from models import TestMpa, TestForGeoJSON, TestNoGeomFinal, TestNoGeoJSON, \
     GenericLinksTestFeature, CreateFormTestFeature, CreateTestFeature, \
     UpdateFormTestFeature, UpdateTestFeature, LinkTestFeature, \
     OtherGenericLinksTestFeature, LastGenericLinksTestFeature, Shipwreck, \
-    Pipeline, TestArray
+    Pipeline, TestArray, SharedWreck
 
 # used by some of the tests to temporarily create a template file
 from nursery.kml.kml import kml_errors
@@ -90,6 +93,69 @@ class FeatureOptionsTest(TestCase):
 
             TestFeature.get_options()
 
+    def test_frozen_registry(self):
+        from features.registry import frozen_registry, get_collection_models, \
+            get_feature_models
+        index = frozen_registry()
+        self.assertNotEqual(index, None)
+        self.assertEqual(index.valid_children[TestArray],
+                         tuple(TestArray.get_options()._get_valid_children()))
+        self.assertEqual(list(index.potential_parents[TestMpa]),
+                         TestMpa.get_options()._get_potential_parents())
+        with override_settings(FEATURES_VERIFY_REGISTRY=True):
+            self.assertTrue(TestFolder in get_collection_models())
+            self.assertTrue(TestMpa in get_feature_models())
+            self.assertTrue(TestFolder in TestMpa.get_options().get_potential_parents())
+
+    def test_model_uid(self):
+        from features.registry import get_model_by_uid, get_feature_by_uid, \
+            content_type_id, get_model_by_content_type_id
+        ct = ContentType.objects.get_for_model(TestMpa)
+        with self.assertNumQueries(0):
+            self.assertEqual(TestMpa.model_uid(), "%s_%s" % (ct.app_label, ct.model))
+            self.assertEqual(get_model_by_uid(TestMpa.model_uid()), TestMpa)
+        self.assertEqual(content_type_id(TestMpa), ct.pk)
+        self.assertEqual(get_model_by_content_type_id(ct.pk), TestMpa)
+        with self.assertNumQueries(0):
+            self.assertEqual(content_type_id(TestMpa), ct.pk)
+            self.assertEqual(get_model_by_content_type_id(ct.pk), TestMpa)
+        self.assertRaises(Exception, get_model_by_uid, 'tests_nosuchmodel')
+        self.assertRaises(Exception, get_model_by_content_type_id,
+                          ContentType.objects.get_for_model(User).pk)
+
+        # Nothing is kept past a reset of the content types
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(content_type_id(TestMpa), ct.pk)
+
+        user = User.objects.create_user('uidtest', 'uidtest@madrona.org', password='pword')
+        mpa = TestMpa(user=user, name="Uid Mpa")
+        mpa.save()
+        self.assertEqual(get_feature_by_uid(mpa.uid), mpa)
+        self.assertRaises(ValueError, get_feature_by_uid, 'tests_testmpa_x')
+
+    def test_get_features_by_uids(self):
+        from features.registry import get_features_by_uids
+        user = User.objects.create_user('uidtest', 'uidtest@madrona.org', password='pword')
+        mpa = TestMpa(user=user, name="Uid Mpa")
+        mpa.save()
+        folder = TestFolder(user=user, name="Uid Folder")
+        folder.save()
+        gone = '%s_%d' % (TestMpa.model_uid(), mpa.pk + 1000)
+        uids = [folder.uid, gone, mpa.uid, 'tests_nosuchmodel_1', folder.uid]
+        with self.assertNumQueries(2):
+            instances, missing = get_features_by_uids(uids, defer=['date_created'])
+        self.assertEqual(instances, [folder, mpa, folder])
+        self.assertEqual(missing, [gone, 'tests_nosuchmodel_1'])
+        self.assertRaises(ValueError, get_features_by_uids, [mpa.uid, 'nonsense'])
+
+        # Deferred instances still resolve to their feature class
+        deferred = instances[1]
+        self.assertTrue(deferred._deferred)
+        self.assertEqual(deferred.get_options(), TestMpa.get_options())
+        self.assertEqual(deferred.get_absolute_url(), mpa.get_absolute_url())
+        self.assertEqual(instances[0].get_absolute_url(), folder.get_absolute_url())
+
     def test_slug(self):
         self.assertEqual(TestSlugFeature.get_options().slug, 'testslugfeature')
 
@@ -240,6 +306,65 @@ class DeleteTest(TestCase):
         self.assertEqual(TestDeleteFeature.objects.all().count(), 0)
 
 
+    def test_bulk_delete_tree(self):
+        from features.bulk import delete_features
+        group = Group.objects.create(name="Delete Group")
+        folder = TestFolder(user=self.user, name="My Folder")
+        folder.save()
+        subfolder = TestFolder(user=self.user, name="My Subfolder")
+        subfolder.save()
+        folder.add(subfolder)
+        self.test_instance.add_to_collection(subfolder)
+        self.test_instance.sharing_groups.add(group)
+        through = TestDeleteFeature._meta.get_field('sharing_groups').rel.through
+
+        delete_features([folder])
+        self.assertEqual(TestFolder.objects.filter(
+            pk__in=[folder.pk, subfolder.pk]).count(), 0)
+        self.assertEqual(TestDeleteFeature.objects.count(), 0)
+        self.assertEqual(through.objects.filter(group=group).count(), 0)
+
+    def test_bulk_delete_signals(self):
+        from django.db import connection
+        from django.db.models.signals import post_delete
+        from django.test.utils import CaptureQueriesContext
+        from features.bulk import can_raw_delete, delete_features
+        from features.signals import features_deleted
+        self.assertTrue(can_raw_delete(TestDeleteFeature))
+        self.assertTrue(can_raw_delete(TestFolder))
+        group = Group.objects.create(name="Delete Group")
+        deleted = []
+        def record(sender, **kwargs):
+            deleted.append((sender, sorted(kwargs.get('pks', []))))
+        features_deleted.connect(record)
+        post_delete.connect(record)
+        try:
+            queries = []
+            for size in (1, 5):
+                folder = TestFolder(user=self.user, name="My Folder")
+                folder.save()
+                features = []
+                for i in range(size):
+                    feature = TestDeleteFeature(user=self.user, name="Feature %d" % i)
+                    feature.save()
+                    feature.sharing_groups.add(group)
+                    feature.add_to_collection(folder)
+                    features.append(feature)
+                del deleted[:]
+                with CaptureQueriesContext(connection) as context:
+                    delete_features([folder])
+                queries.append(len(context.captured_queries))
+                self.assertEqual(sorted(deleted), sorted([
+                    (TestFolder, [folder.pk]),
+                    (TestDeleteFeature, sorted(f.pk for f in features))]))
+        finally:
+            features_deleted.disconnect(record)
+            post_delete.disconnect(record)
+        # A fixed number of statements, whatever the size of the tree
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(TestDeleteFeature.objects.filter(
+            sharing_groups=group).count(), 0)
+
 class CreateFormTest(TestCase):
     def setUp(self):
         self.client = Client()
@@ -711,6 +836,51 @@ class JsonSerializationTest(TestCase):
         self.assertEquals(fcdict['link-relations']['related'][0]['title'],
                           'Habitat Spreadsheet')
 
+    def test_workspace_shared_by_role(self):
+        other = User.objects.create_user(
+            'othertest', 'othertest@madrona.org', password='pword')
+        self.assertTrue(workspace_json(other, True) is workspace_json(self.user, True))
+        self.assertFalse(workspace_json(other, False) is workspace_json(other, True))
+        with self.assertNumQueries(1):
+            # Only the user's limit_to_groups memberships are looked up
+            workspace_json(other, True)
+
+    def test_uri_templates(self):
+        from features.registry import uri_template, url_for
+        slug = TestMpa.get_options().slug
+        self.assertEqual(url_for('%s_resource' % slug, uid='tests_testmpa_3'),
+                         reverse('%s_resource' % slug, args=['tests_testmpa_3']))
+        self.assertEqual(uri_template('%s_resource' % slug, uid='{uid}'),
+                         reverse('%s_resource' % slug, args=['xx']).replace('xx', '{uid}'))
+        link = TestMpa.get_options().get_link('Export KML')
+        self.assertEqual(url_for(link.url_name, uids='tests_testmpa_3,tests_testmpa_4'),
+                         reverse(link.url_name,
+                                 kwargs={'uids': 'tests_testmpa_3,tests_testmpa_4'}))
+        folder_slug = TestFolder.get_options().slug
+        self.assertEqual(
+            uri_template('%s_add_features' % folder_slug,
+                         collection_uid='{collection_uid}', uids='{uid+}'),
+            reverse('%s_add_features' % folder_slug,
+                    kwargs={'collection_uid': 'aa', 'uids': 'bb'}).replace(
+                'aa', '{collection_uid}').replace('bb', '{uid+}'))
+
+    def test_uri_templates_script_prefix(self):
+        from django.core.urlresolvers import set_script_prefix, get_script_prefix
+        from features.registry import uri_template, url_for
+        slug = TestMpa.get_options().slug
+        path = url_for('%s_resource' % slug, uid='tests_testmpa_3')
+        old_prefix = get_script_prefix()
+        set_script_prefix('/sub/')
+        try:
+            # Cached before the prefix changed, served with the new one
+            self.assertEqual(url_for('%s_resource' % slug, uid='tests_testmpa_3'),
+                             '/sub' + path)
+            self.assertEqual(uri_template('%s_resource' % slug, uid='{uid}'),
+                             reverse('%s_resource' % slug, args=['xx']).replace('xx', '{uid}'))
+        finally:
+            set_script_prefix(old_prefix)
+        self.assertEqual(url_for('%s_resource' % slug, uid='tests_testmpa_3'), path)
+
     def test_owner_url(self):
         client = Client()
         client.login(username='featuretest', password='pword')
@@ -846,6 +1016,104 @@ class SpatialTest(TestCase):
         self.assertFalse(errors, "invalid KML %s" % str(errors))
 
 
+class CopyOnWriteTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'featuretest', 'featuretest@madrona.org', password='pword')
+        self.g1 = GEOSGeometry('SRID=4326;POINT(-120.45 34.32)')
+        self.g1.transform(settings.GEOMETRY_DB_SRID)
+        self.g2 = GEOSGeometry('SRID=4326;POINT(-119.45 33.32)')
+        self.g2.transform(settings.GEOMETRY_DB_SRID)
+        wreck = SharedWreck(user=self.user, name="Wreck", geometry_final=self.g1)
+        wreck.save()
+        self.pk = wreck.pk
+
+    def copy(self, pk=None):
+        # Feature.copy turns the instance it is called on into the copy
+        return SharedWreck.objects.get(pk=pk or self.pk).copy(self.user)
+
+    def stored(self, pk):
+        from features.copy_on_write import stored
+        return stored(SharedWreck).filter(pk=pk).values_list(
+            'geometry_final', flat=True)[0]
+
+    def test_copy_borrows_geometry(self):
+        copy = self.copy()
+        self.assertEqual(self.stored(copy.pk), None)
+        self.assertTrue(copy.geometry_final.equals(self.g1))
+        self.assertTrue(SharedWreck.objects.get(pk=copy.pk).geometry_final.equals(self.g1))
+
+        # Copies of copies borrow from the owner
+        copy2 = self.copy(copy.pk)
+        self.assertEqual(self.stored(copy2.pk), None)
+        self.assertTrue(SharedWreck.objects.get(pk=copy2.pk).geometry_final.equals(self.g1))
+
+    def test_bulk_insert_after_newest_deleted(self):
+        from django.db import transaction
+        from features.bulk import clone, _insert
+        from features import copy_on_write
+        newest = SharedWreck(user=self.user, name="Newest", geometry_final=self.g2)
+        newest.save()
+        newest_pk = newest.pk
+        newest.delete()
+        original = SharedWreck.objects.get(pk=self.pk)
+        clones = [clone(original, self.user), clone(original, self.user)]
+        for new in clones:
+            copy_on_write.strip(new)
+        with transaction.atomic():
+            _insert(SharedWreck, clones)
+        pks = [new.pk for new in clones]
+        self.assertTrue(all(pk > newest_pk for pk in pks))
+        self.assertEqual(sorted(SharedWreck.objects.filter(pk__in=pks).values_list(
+            'pk', flat=True)), sorted(pks))
+
+    def test_edit_materializes(self):
+        copy = SharedWreck.objects.get(pk=self.copy().pk)
+        copy.geometry_final = self.g2
+        copy.save()
+        self.assertTrue(self.stored(copy.pk).equals(self.g2))
+        self.assertTrue(self.stored(self.pk).equals(self.g1))
+
+        # A rename keeps borrowing, as does a save of the borrowed geometry
+        copy = SharedWreck.objects.get(pk=self.copy().pk)
+        copy.name = "Renamed"
+        copy.save()
+        self.assertEqual(self.stored(copy.pk), None)
+        self.assertTrue(copy.geometry_final.equals(self.g1))
+        self.assertTrue(SharedWreck.objects.get(pk=copy.pk).geometry_final.equals(self.g1))
+
+        # ... until the owner's geometry changes under it
+        wreck = SharedWreck.objects.get(pk=self.pk)
+        wreck.geometry_final = self.g2
+        wreck.save()
+        self.assertTrue(self.stored(copy.pk).equals(self.g1))
+
+    def test_spatial_queries_refused(self):
+        from features.copy_on_write import CopyOnWriteError
+        self.copy()
+        self.assertRaises(CopyOnWriteError, SharedWreck.objects.filter,
+                          geometry_final__intersects=self.g1)
+        self.assertRaises(CopyOnWriteError, SharedWreck.objects.exclude,
+                          Q(name='Wreck') | Q(geometry_final__isnull=True))
+        self.assertRaises(CopyOnWriteError, SharedWreck.objects.values_list,
+                          'pk', 'geometry_final')
+        self.assertRaises(CopyOnWriteError, SharedWreck.objects.values)
+        self.assertRaises(CopyOnWriteError, SharedWreck.objects.all().extent)
+        self.assertEqual(SharedWreck.objects.filter(name='Wreck').count(), 1)
+        self.assertEqual(len(SharedWreck.objects.values_list('pk', flat=True)), 2)
+
+    def test_owner_changes_dont_leak(self):
+        copy = self.copy()
+        wreck = SharedWreck.objects.get(pk=self.pk)
+        wreck.geometry_final = self.g2
+        wreck.save()
+        self.assertTrue(SharedWreck.objects.get(pk=copy.pk).geometry_final.equals(self.g1))
+
+        copy = self.copy()
+        SharedWreck.objects.get(pk=self.pk).delete()
+        self.assertTrue(self.stored(copy.pk).equals(self.g2))
+
+
 class CollectionTest(TestCase):
     def setUp(self):
         self.client = Client()
@@ -891,6 +1159,60 @@ class CollectionTest(TestCase):
 
         self.assertRaises(AssertionError, self.folder1.add, self.mpa3)
 
+    def test_move_features(self):
+        from features.bulk import move_features
+        self.folder2.add(self.mpa2)
+        move_features([self.mpa1, self.mpa2, self.folder2], self.folder1)
+        self.assertEqual(set(self.folder1.feature_set()),
+                         set([self.mpa1, self.mpa2, self.folder2]))
+        self.assertEqual(self.folder2.feature_set(), [])
+        self.assertEqual(TestMpa.objects.get(pk=self.mpa2.pk).collection, self.folder1)
+
+        # Nothing moves if any instance fails the checks
+        self.assertRaises(AssertionError, move_features,
+                          [self.mpa1, self.mpa3], self.folder2)
+        self.assertRaises(Exception, move_features, [self.folder1], self.folder1)
+        self.assertEqual(TestMpa.objects.get(pk=self.mpa1.pk).collection, self.folder1)
+
+        move_features([self.mpa1, self.mpa2], None)
+        self.assertEqual(set(self.folder1.feature_set()), set([self.folder2]))
+        self.assertEqual(TestMpa.objects.get(pk=self.mpa1.pk).collection, None)
+
+    def test_coalesced_touches(self):
+        from features.touch import touch, coalesced_touches
+        self.folder1.add(self.folder2)
+        self.folder2.add(self.mpa1)
+        before = TestFolder.objects.get(pk=self.folder1.pk).date_modified
+
+        with coalesced_touches():
+            self.folder2.remove(self.mpa1)
+            touch(self.folder2)
+            # Nothing is written until the block ends
+            self.assertEqual(TestFolder.objects.get(pk=self.folder2.pk).date_modified,
+                             self.folder2.date_modified)
+        self.assertEqual(TestFolder.objects.get(pk=self.folder2.pk).date_modified,
+                         self.folder2.date_modified)
+        self.assertEqual(TestFolder.objects.get(pk=self.folder1.pk).date_modified, before)
+
+        with override_settings(TOUCH_COLLECTION_ANCESTORS=True):
+            self.folder2.add(self.mpa1)
+        self.assertTrue(TestFolder.objects.get(pk=self.folder1.pk).date_modified > before)
+
+    def test_manage_collection(self):
+        self.client.login(username='user1', password='pword')
+        url = reverse('%s_add_features' % TestFolder.get_options().slug, kwargs={
+            'collection_uid': self.folder1.uid,
+            'uids': ','.join([self.mpa1.uid, self.mpa2.uid])})
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(set(self.folder1.feature_set()), set([self.mpa1, self.mpa2]))
+
+        url = reverse('%s_remove_features' % TestFolder.get_options().slug, kwargs={
+            'collection_uid': self.folder1.uid, 'uids': self.mpa1.uid})
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.folder1.feature_set(), [self.mpa2])
+
     def test_feature_set(self):
         """
         When checking which mpas belong to folder1 we can:
@@ -975,6 +1297,184 @@ class CollectionTest(TestCase):
         self.assertTrue(mpa5 in recursive_children)
         self.assertTrue(folder4 in recursive_children)
 
+    def test_recursive_feature_set_order(self):
+        """
+        The single-pass tree walk returns the same features, in the same
+        order, as recursing collection by collection
+        """
+        def naive(collection, feature_classes=None):
+            result = []
+            for model_class in collection.get_options().get_valid_children():
+                children = list(model_class.objects.filter(
+                    content_type=ContentType.objects.get_for_model(collection),
+                    object_id=collection.pk).order_by('pk'))
+                if issubclass(model_class, FeatureCollection):
+                    for child in children:
+                        result.extend(naive(child, feature_classes))
+                if not feature_classes or model_class in feature_classes:
+                    result.extend(children)
+            return result
+
+        folder3 = TestFolder(user=self.user1, name="My Folder 3")
+        folder3.save()
+        mpa3 = TestMpa(user=self.user1, name="My Mpa 3")
+        mpa3.save()
+        self.folder1.add(self.folder2)
+        self.folder1.add(self.mpa2)
+        self.folder1.add(folder3)
+        self.folder2.add(self.mpa1)
+        folder3.add(mpa3)
+
+        for use_cte in (True, False):
+            with override_settings(USE_RECURSIVE_CTE=use_cte):
+                self.assertEqual(self.folder1.feature_set(recurse=True),
+                                 naive(self.folder1))
+                self.assertEqual(
+                    self.folder1.feature_set(recurse=True, feature_classes=[TestMpa]),
+                    naive(self.folder1, [TestMpa]))
+
+    @override_settings(COLLECTION_CLOSURE_TABLE=True)
+    def test_closure_table(self):
+        from features.closure import rebuild_closure, check_closure, ancestor_keys
+        rebuild_closure()
+        self.folder2.add(self.mpa2)
+        self.folder1.add(self.mpa1)
+        self.folder1.add(self.folder2)
+        self.assertEqual(check_closure(), (set(), set()))
+        self.assertEqual(ancestor_keys(self.mpa2), [
+            (ContentType.objects.get_for_model(TestFolder).pk, self.folder2.pk),
+            (ContentType.objects.get_for_model(TestFolder).pk, self.folder1.pk)])
+        self.assertEqual(set(self.folder1.feature_set(recurse=True)),
+                         set([self.mpa1, self.folder2, self.mpa2]))
+
+        # Cycles are refused
+        self.assertRaises(Exception, self.folder2.add, self.folder1)
+        self.assertRaises(Exception, self.folder1.add, self.folder1)
+
+        self.folder1.remove(self.folder2)
+        self.assertEqual(check_closure(), (set(), set()))
+        self.assertEqual(self.folder1.feature_set(recurse=True), [self.mpa1])
+        self.mpa2.delete()
+        self.assertEqual(check_closure(), (set(), set()))
+
+    @override_settings(COLLECTION_CLOSURE_TABLE=True)
+    def test_closure_bulk_move(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from features.bulk import move_features
+        from features.closure import rebuild_closure, check_closure, move_subtrees
+        rebuild_closure()
+        self.folder2.add(self.mpa2)
+        # A root moved along with the collection it was in
+        move_features([self.mpa1, self.mpa2, self.folder2], self.folder1)
+        self.assertEqual(check_closure(), (set(), set()))
+
+        mpas = [TestMpa.objects.create(user=self.user1, name="Mpa %d" % i)
+                for i in range(5)]
+        queries = []
+        for instances in (mpas[:1], mpas):
+            with CaptureQueriesContext(connection) as context:
+                move_subtrees(instances, self.folder2)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+        TestMpa.objects.filter(pk__in=[m.pk for m in mpas]).update(
+            content_type=ContentType.objects.get_for_model(TestFolder),
+            object_id=self.folder2.pk)
+        self.assertEqual(check_closure(), (set(), set()))
+
+    def test_feature_set_projections(self):
+        self.folder1.add(self.mpa1)
+        self.folder1.add(self.folder2)
+        self.folder2.add(self.mpa2)
+        for recurse in (False, True):
+            features = self.folder1.feature_set(recurse=recurse)
+            self.assertEqual(self.folder1.feature_set(recurse=recurse, values='ids'),
+                             [f.pk for f in features])
+            self.assertEqual(self.folder1.feature_set(recurse=recurse, values='uids'),
+                             [f.uid for f in features])
+            self.assertEqual(
+                self.folder1.feature_set(recurse=recurse, values=['pk', 'name', 'user']),
+                [{'pk': f.pk, 'name': f.name, 'user': f.user_id} for f in features])
+
+    def test_iter_feature_set(self):
+        self.folder1.add(self.mpa1)
+        self.folder1.add(self.folder2)
+        self.folder2.add(self.mpa2)
+        self.assertEqual(list(self.folder1.iter_feature_set(chunk_size=1)),
+                         self.folder1.feature_set())
+        self.assertEqual(
+            set(self.folder1.iter_feature_set(recurse=True, chunk_size=1)),
+            set(self.folder1.feature_set(recurse=True)))
+        self.assertEqual(
+            list(self.folder1.iter_feature_set(recurse=True, feature_classes=[TestMpa])),
+            [self.mpa1, self.mpa2])
+
+    @override_settings(COLLECTION_AGGREGATES=True)
+    def test_collection_aggregates(self):
+        self.folder1.add(self.mpa1)
+        self.folder2.add(self.mpa2)
+        self.folder1.add(self.folder2)
+        aggregates = self.folder1.aggregates
+        self.assertEqual(aggregates['direct_count'], 2)
+        self.assertEqual(aggregates['recursive_count'], 3)
+        self.assertEqual(self.folder2.aggregates['recursive_count'], 1)
+
+        # Changes below a collection are carried up the tree
+        self.folder2.remove(self.mpa2)
+        self.assertEqual(self.folder1.aggregates['recursive_count'], 2)
+        self.folder2.delete()
+        self.assertEqual(self.folder1.aggregates['direct_count'], 1)
+        self.assertEqual(self.folder1.aggregates['recursive_count'], 1)
+
+        from features.aggregates import rebuild_aggregates
+        rebuild_aggregates()
+        self.assertEqual(self.folder1.aggregates['recursive_count'], 1)
+
+    @override_settings(COLLECTION_AGGREGATES=True)
+    def test_incremental_aggregates(self):
+        from features.aggregates import summarize
+        small = GEOSGeometry('SRID=%s;POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))' %
+                             settings.GEOMETRY_DB_SRID)
+        large = GEOSGeometry('SRID=%s;POLYGON((0 0, 20 0, 20 20, 0 20, 0 0))' %
+                             settings.GEOMETRY_DB_SRID)
+        self.folder1.add(self.folder2)
+        self.folder2.add(self.mpa1)
+        self.assertEqual(self.folder1.aggregates['extent'], None)
+
+        # Deltas are carried up without recomputing the rows
+        self.mpa1.geometry_final = large
+        self.mpa1.save()
+        self.folder2.add(self.mpa2)
+        self.mpa2.geometry_final = small
+        self.mpa2.save()
+        aggregates = self.folder1.aggregates
+        self.assertEqual(aggregates['recursive_count'], 3)
+        self.assertEqual(aggregates['area'], 500.0)
+        self.assertEqual(aggregates['extent'], (0.0, 0.0, 20.0, 20.0))
+
+        # Shrinking the extent recomputes the rows it reached
+        self.mpa1.geometry_final = small
+        self.mpa1.save()
+        self.assertEqual(self.folder1.aggregates['extent'], (0.0, 0.0, 10.0, 10.0))
+        self.assertEqual(self.folder1.aggregates['area'], 200.0)
+
+        self.mpa2.delete()
+        self.folder2.remove(self.mpa1)
+        aggregates = self.folder1.aggregates
+        self.assertEqual(aggregates['recursive_count'], 1)
+        self.assertEqual(aggregates['area'], 0.0)
+        self.assertEqual(aggregates['extent'], None)
+        for collection in (self.folder1, self.folder2):
+            expected = summarize(collection)
+            row = self.folder1.__class__.objects.get(pk=collection.pk).aggregates
+            self.assertEqual(row['recursive_count'], expected['recursive_count'])
+            self.assertEqual(row['area'], expected['area'])
+
+    def test_aggregates_off_by_default(self):
+        self.folder1.add(self.mpa1)
+        self.assertEqual(self.folder1.aggregates, None)
+        self.assertFalse('ExtendedData' in self.folder2.kml)
+
     def test_potential_parents(self):
         """
             Folder (of which TestArray is a valid child but Pipeline is NOT)
@@ -1028,6 +1528,50 @@ class CollectionTest(TestCase):
                          "Folder1_copy should contain copies folder2, mpa1, mpa2 but doesn't")
 
 
+    def test_bulk_copy_collection(self):
+        """
+        TestArray has no copy() override, so its whole tree is cloned in bulk
+        """
+        my_array = TestArray(user=self.user1, name="My Array")
+        my_array.save()
+        my_array.add(self.mpa1)
+        my_array.add(self.mpa2)
+        my_array.add(self.pipeline)
+        array_copy = my_array.copy(self.user2)
+        self.assertNotEqual(array_copy.pk, my_array.pk)
+        self.assertEqual(array_copy.name, "My Array (copy)")
+        self.assertEqual(array_copy.user, self.user2)
+
+        children = array_copy.feature_set(recurse=True)
+        self.assertEqual(sorted([c.name for c in children]),
+                         ["My Mpa (copy)", "My Mpa 2 (copy)", "My Pipeline (copy)"])
+        self.assertTrue(all(c.user == self.user2 for c in children))
+        self.assertFalse(set(children) & set(my_array.feature_set()))
+        # The originals stay where they were
+        self.assertEqual(len(my_array.feature_set()), 3)
+
+    def test_bulk_copy_custom_save(self):
+        """
+        A save() override can't run on bulk inserted rows, so children whose
+        class has one are copied one at a time with it
+        """
+        from features.bulk import has_custom_save
+        self.assertFalse(has_custom_save(self.mpa1))
+        self.assertFalse(has_custom_save(self.folder1))
+        saved = []
+        def save(instance, *args, **kwargs):
+            saved.append(instance.name)
+            return super(TestMpa, instance).save(*args, **kwargs)
+        TestMpa.save = save
+        try:
+            self.assertTrue(has_custom_save(self.mpa1))
+            self.folder1.add(self.mpa1)
+            folder_copy = self.folder1.copy(self.user1)
+        finally:
+            del TestMpa.save
+        self.assertTrue("My Mpa (copy)" in saved)
+        self.assertEqual([c.name for c in folder_copy.feature_set()], ["My Mpa (copy)"])
+
 class SharingTestCase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -1125,6 +1669,296 @@ class SharingTestCase(TestCase):
         viewable, response = self.pipeline1.is_viewable(self.user3)
         self.assertEquals(viewable, False)
 
+    def test_nested_sharing_without_cte(self):
+        """
+        The recursive CTE and the python fallback must agree on what
+        a nested share exposes
+        """
+        self.folder1.share_with(self.group1)
+        with_cte = set(TestMpa.objects.shared_with_user(self.user2))
+        with override_settings(USE_RECURSIVE_CTE=False):
+            without_cte = set(TestMpa.objects.shared_with_user(self.user2))
+        self.assertEquals(with_cte, set([self.mpa1]))
+        self.assertEquals(with_cte, without_cte)
+        self.assertEquals(
+            len(Pipeline.objects.shared_with_user(self.user3)), 0)
+
+    def test_deep_sharing_without_cte(self):
+        """
+        The unrolled walk reaches as deep as the CTE does, and its SQL
+        doesn't grow with the number of visible collections
+        """
+        # folder1
+        #     |-array1
+        #     |-folder2
+        #       |-folder3
+        #         |-mpa2
+        #         |-array2
+        #           |-mpa3
+        folder2 = TestFolder.objects.create(user=self.user1, name="Folder 2")
+        folder3 = TestFolder.objects.create(user=self.user1, name="Folder 3")
+        array2 = TestArray.objects.create(user=self.user1, name="Array 2")
+        self.folder1.add(folder2)
+        folder2.add(folder3)
+        folder3.add(self.mpa2)
+        folder3.add(array2)
+        array2.add(self.mpa3)
+        self.folder1.share_with(self.group1)
+
+        with_cte = set(TestMpa.objects.shared_with_user(self.user2))
+        with override_settings(USE_RECURSIVE_CTE=False):
+            without_cte = TestMpa.objects.shared_with_user(self.user2)
+            self.assertEquals(set(without_cte), with_cte)
+            self.assertEquals(with_cte, set([self.mpa1, self.mpa2, self.mpa3]))
+            sql = str(without_cte.query)
+            # Another folder at a depth already walked leaves the SQL as is
+            folder2.add(TestFolder.objects.create(user=self.user1, name="Folder 4"))
+            self.assertEquals(
+                str(TestMpa.objects.shared_with_user(self.user2).query), sql)
+            self.assertEquals(
+                set(TestMpa.objects.filter(pk__in=without_cte.values('pk'))),
+                with_cte)
+            self.assertEquals(
+                len(Pipeline.objects.shared_with_user(self.user3)), 0)
+
+    @override_settings(SHARING_VISIBILITY_INDEX=True)
+    def test_visibility_index(self):
+        from features.visibility import check_index, rebuild_index
+        rebuild_index()
+        self.folder1.share_with(self.group1)
+        self.assertEquals(
+            list(TestMpa.objects.shared_with_user(self.user2)), [self.mpa1])
+        self.assertEquals(check_index(), (set(), set()))
+
+        # Moving mpa1 out of the shared folder hides it again
+        self.mpa1.remove_from_collection()
+        self.assertEquals(len(TestMpa.objects.shared_with_user(self.user2)), 0)
+        self.assertEquals(check_index(), (set(), set()))
+
+        self.folder1.share_with(None)
+        self.assertEquals(len(Pipeline.objects.shared_with_user(self.user2)), 0)
+        self.assertEquals(check_index(), (set(), set()))
+
+    @override_settings(SHARING_VISIBILITY_INDEX=True)
+    def test_visibility_refresh_is_set_wise(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from features.closure import rebuild_closure
+        from features.visibility import check_index, rebuild_index, refresh_subtrees
+        for use_closure in (False, True):
+            with override_settings(COLLECTION_CLOSURE_TABLE=use_closure):
+                rebuild_closure()
+                rebuild_index()
+                queries = []
+                for size in (1, 5):
+                    folder = TestFolder.objects.create(user=self.user1, name="Folder")
+                    subfolder = TestFolder.objects.create(user=self.user1, name="Sub")
+                    subfolder.add_to_collection(folder)
+                    for i in range(size):
+                        TestMpa.objects.create(user=self.user1, name="Mpa %d" % i
+                            ).add_to_collection(subfolder)
+                    folder.sharing_groups.add(self.group1)
+                    with CaptureQueriesContext(connection) as context:
+                        refresh_subtrees([folder])
+                    queries.append(len(context.captured_queries))
+                    self.assertEquals(check_index(), (set(), set()))
+                self.assertEquals(queries[0], queries[1])
+
+    def test_sharing_group_cache_invalidation(self):
+        from features.registry import sharing_group_ids
+        self.mpa2.share_with(self.group1)
+        self.assertEquals(sharing_group_ids(self.user3), [])
+        self.assertEquals(len(TestMpa.objects.shared_with_user(self.user3)), 0)
+
+        # Joining a group shows up right away
+        self.user3.groups.add(self.group1)
+        self.assertEquals(sharing_group_ids(self.user3), [self.group1.pk])
+        self.assertEquals(len(TestMpa.objects.shared_with_user(self.user3)), 1)
+
+        # ... as does a group gaining sharing permission
+        enable_sharing(self.group2)
+        self.assertEquals(sharing_group_ids(self.user3),
+                          sorted([self.group1.pk, self.group2.pk]))
+
+        self.group1.user_set.remove(self.user3)
+        self.assertEquals(sharing_group_ids(self.user3), [self.group2.pk])
+
+    def test_sharing_cache(self):
+        from features.registry import sharing_cache
+        perm = Permission.objects.get(codename='can_share_features')
+        sharing_cache.clear()
+        before = sharing_cache.stats()
+        self.assertEquals(sharing_cache.permission_id(), perm.pk)
+        self.assertEquals(sharing_cache.permission_id(), perm.pk)
+        after = sharing_cache.stats()
+        self.assertEquals(after['misses'] - before['misses'], 1)
+        self.assertEquals(after['hits'] - before['hits'], 1)
+
+        public = Group.objects.get(name=settings.SHARING_TO_PUBLIC_GROUPS[0])
+        self.assertEquals(sharing_cache.public_group_ids(), frozenset([public.pk]))
+        public.name = 'No longer public'
+        public.save()
+        self.assertEquals(sharing_cache.public_group_ids(), frozenset())
+
+    @override_settings(SHARING_CACHE_CHECK_INTERVAL=60)
+    def test_sharing_cache_across_processes(self):
+        from features import registry
+        from features.registry import sharing_cache, SharingCache
+        # Another worker's cache, already loaded
+        other = SharingCache()
+        public = Group.objects.get(name=settings.SHARING_TO_PUBLIC_GROUPS[0])
+        self.assertEquals(other.public_group_ids(), frozenset([public.pk]))
+        # Hits stay in process, without a cache round trip
+        cache_version = registry.cache_version
+        registry.cache_version = None
+        try:
+            with self.assertNumQueries(0):
+                other.public_group_ids()
+        finally:
+            registry.cache_version = cache_version
+        Group.objects.filter(pk=public.pk).update(name='No longer public')
+        sharing_cache.clear()
+        # Seen once the other worker next checks the version
+        self.assertEquals(other.public_group_ids(), frozenset([public.pk]))
+        with override_settings(SHARING_CACHE_CHECK_INTERVAL=0):
+            self.assertEquals(other.public_group_ids(), frozenset())
+
+    def test_viewable_mask(self):
+        self.array1.share_with(self.group1)
+        instances = [self.mpa3, self.pipeline1, self.mpa2, self.mpa1,
+                     self.folder1]
+        self.assertEquals(Feature.viewable_mask(self.user2, instances),
+                          [self.pipeline1, self.mpa2, self.mpa1])
+        self.assertEquals(Feature.viewable_mask(self.user3, instances),
+                          [self.mpa3])
+        self.assertEquals(
+            Feature.viewable_mask(AnonymousUser(), instances), [])
+
+    def test_public_snapshot(self):
+        public = Group.objects.get(name=settings.SHARING_TO_PUBLIC_GROUPS[0])
+        enable_sharing(public)
+        self.user1.groups.add(public)
+        self.user2.groups.add(public)
+        anon = AnonymousUser()
+        self.assertEquals(len(TestMpa.objects.shared_with_user(anon)), 0)
+
+        self.mpa2.share_with(public)
+        self.assertEquals(list(TestMpa.objects.shared_with_user(anon)), [self.mpa2])
+
+        # Sharing with a non-public group leaves the snapshot alone
+        version = cache_version('public')
+        self.mpa1.share_with(self.group1)
+        self.assertEquals(cache_version('public'), version)
+
+        # Nested features follow their public collection
+        self.array1.share_with(public)
+        self.assertEquals(set(TestMpa.objects.shared_with_user(anon)),
+                          set([self.mpa1, self.mpa2]))
+        self.mpa1.remove_from_collection()
+        self.assertEquals(list(TestMpa.objects.shared_with_user(anon)), [self.mpa2])
+
+        # The statement doesn't grow with the number of public features
+        for use_cte in (True, False):
+            with override_settings(USE_RECURSIVE_CTE=use_cte):
+                sql = str(TestMpa.objects.shared_with_user(anon).query)
+                self.mpa3.share_with(public)
+                self.assertEquals(str(TestMpa.objects.shared_with_user(anon).query), sql)
+                self.mpa3.share_with(None)
+
+        self.mpa2.share_with(None)
+        self.assertEquals(len(TestMpa.objects.shared_with_user(anon)), 0)
+
+    def test_iter_shared_with_user(self):
+        self.mpa1.share_with(self.group1)
+        self.mpa2.share_with(self.group1)
+        page, after = TestMpa.objects.shared_with_user_page(self.user2, 1)
+        self.assertEquals(len(page), 1)
+        self.assertNotEqual(after, None)
+        rest, last = TestMpa.objects.shared_with_user_page(self.user2, 1, after)
+        self.assertEquals(last, None)
+        self.assertEquals(set(page + rest), set([self.mpa1, self.mpa2]))
+        self.assertEquals(list(TestMpa.objects.iter_shared_with_user(self.user2, 1)),
+                          page + rest)
+
+        self.client.login(username='user2', password=self.password)
+        url = reverse('%s_shared_json' % TestMpa.get_options().slug)
+        response = self.client.get(url, {'page_size': 1})
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEquals([f['uid'] for f in data['features']], [page[0].uid])
+        response = self.client.get(url, {'page_size': 1, 'after': data['next']})
+        data = json.loads(response.content)
+        self.assertEquals([f['uid'] for f in data['features']], [rest[0].uid])
+        self.assertEquals(data['next'], None)
+        response = self.client.get(url, {'after': 'bogus'})
+        self.assertEquals(response.status_code, 400)
+
+    def test_shared_page_before_epoch(self):
+        from datetime import datetime
+        from features.managers import encode_cursor, decode_cursor
+        self.mpa1.share_with(self.group1)
+        self.mpa2.share_with(self.group1)
+        TestMpa.objects.filter(pk=self.mpa1.pk).update(
+            date_modified=datetime(1960, 5, 1, 12, 30, 15, 250000))
+        page, after = TestMpa.objects.shared_with_user_page(self.user2, 1)
+        self.assertEquals(page, [self.mpa1])
+        self.assertEquals(decode_cursor(after),
+                          (page[0].date_modified, self.mpa1.pk))
+        self.assertEquals(encode_cursor(page[0]), after)
+        # Owners come along with the page
+        with self.assertNumQueries(0):
+            self.assertEquals(page[0].user.username, self.user1.username)
+        rest, last = TestMpa.objects.shared_with_user_page(self.user2, 1, after)
+        self.assertEquals((rest, last), ([self.mpa2], None))
+
+    def test_share_features(self):
+        from features.bulk import share_features
+        share_features([self.mpa1, self.mpa2, self.pipeline1], self.group1)
+        self.assertEquals(set(TestMpa.objects.shared_with_user(self.user2)),
+                          set([self.mpa1, self.mpa2]))
+        share_features([self.mpa1, self.mpa2], [self.group1], append=True)
+        self.assertEquals(list(self.mpa2.sharing_groups.all()), [self.group1])
+
+        share_features([self.mpa1, self.mpa2], None)
+        self.assertEquals(len(TestMpa.objects.shared_with_user(self.user2)), 0)
+        self.assertEquals(list(self.pipeline1.sharing_groups.all()), [self.group1])
+
+        # user3 isn't in group1; nothing is written
+        self.assertRaises(AssertionError, share_features,
+                          [self.mpa1, self.mpa3], [self.group1])
+        self.assertEquals(len(self.mpa1.sharing_groups.all()), 0)
+
+    def test_multi_share_link(self):
+        link = TestMpa.get_options().get_link('Share')
+        self.client.login(username='user1', password=self.password)
+        response = self.client.post(link.reverse([self.mpa1, self.pipeline1]),
+                                    {'sharing_groups': [self.group1.pk]})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(list(self.mpa1.sharing_groups.all()), [self.group1])
+        self.assertEquals(list(self.pipeline1.sharing_groups.all()), [self.group1])
+        # Only the owner may share
+        response = self.client.post(link.reverse([self.mpa2]),
+                                    {'sharing_groups': [self.group1.pk]})
+        self.assertEquals(response.status_code, 403)
+        response = self.client.post(link.reverse([self.mpa1]),
+                                    {'sharing_groups': ['bogus']})
+        self.assertEquals(response.status_code, 400)
+
+    def test_share_with_sends_m2m_changed(self):
+        from django.db.models.signals import m2m_changed
+        through = TestMpa._meta.get_field('sharing_groups').rel.through
+        actions = []
+        def record(sender, action, pk_set, **kwargs):
+            actions.append((action, set(pk_set or ())))
+        m2m_changed.connect(record, sender=through)
+        try:
+            self.mpa1.share_with(self.group1)
+            self.mpa1.share_with(None)
+        finally:
+            m2m_changed.disconnect(record, sender=through)
+        self.assertTrue(('post_add', set([self.group1.pk])) in actions)
+        self.assertTrue(('post_remove', set([self.group1.pk])) in actions)
+
     def test_user_sharing_groups(self):
         sgs = user_sharing_groups(self.user1)
         self.assertEquals(len(sgs), 1)
@@ -1248,6 +2082,17 @@ class SharingTestCase(TestCase):
         sw = groups_users_sharing_with(self.user3)
         self.assertEquals(sw, None)
 
+    def test_groups_users_sharing_with_cached(self):
+        self.assertEquals(groups_users_sharing_with(self.user2, use_cache=True),
+                          None)
+        self.mpa1.share_with(self.group1)
+        sw = groups_users_sharing_with(self.user2, use_cache=True)
+        self.assertEquals([x.username for x in sw['Test Group 1']['users']],
+                          ['user1'])
+        self.mpa1.unshare_with(self.group1)
+        self.assertEquals(groups_users_sharing_with(self.user2, use_cache=True),
+                          None)
+
     def test_get_share_form_401(self):
         # Need to log in
         response = self.client.get(self.folder1_share_url)